@@ -0,0 +1,29 @@
+import uuid
+
+from django.db import models
+
+from horizon.manager import HorizontalManager
+from horizon.models import AbstractHorizontalMetadata, AbstractHorizontalModel
+
+
+class Metadata(AbstractHorizontalMetadata):
+    pass
+
+
+class ShardedEntry(AbstractHorizontalModel):
+    user = models.IntegerField()
+    spam = models.CharField(max_length=15)
+
+    objects = HorizontalManager()  # For Django<1.10
+
+    class Meta(object):
+        horizontal_group = 'bench'
+        horizontal_key = 'user'
+
+
+class PlainEntry(models.Model):
+    """Same fields as ``ShardedEntry`` in the default database, the baseline."""
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.IntegerField()
+    spam = models.CharField(max_length=15)
@@ -0,0 +1,40 @@
+"""Django settings for benchmarks."""
+
+SECRET_KEY = 'fake-key'
+INSTALLED_APPS = [
+    'django.contrib.contenttypes',
+    'horizon',
+    'benchmarks',
+]
+
+SHARDS = 4
+
+
+def _sqlite(name):
+    return {
+        'NAME': name,
+        'ENGINE': 'django.db.backends.sqlite3',
+        'TEST': {
+            'NAME': 'file:memorydb_benchmark_%s?mode=memory&cache=shared' % name,
+        },
+    }
+
+
+DATABASES = {'default': _sqlite('default')}
+DATABASES.update(('shard%d' % index, _sqlite('shard%d' % index)) for index in range(1, SHARDS + 1))
+DATABASE_ROUTERS = (
+    'horizon.routers.HorizontalRouter',
+)
+
+
+HORIZONTAL_CONFIG = {
+    'GROUPS': {
+        'bench': {
+            'DATABASES': {
+                index: {'write': 'shard%d' % index}
+                for index in range(1, SHARDS + 1)
+            },
+        },
+    },
+    'METADATA_MODEL': 'benchmarks.Metadata',
+}
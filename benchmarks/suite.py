@@ -0,0 +1,211 @@
+"""Benchmarks of routing, metadata resolution and queries of horizontal models.
+
+Each benchmark has a setup, which is not measured, and a run doing one operation per key.
+Runs are timed as is, then repeated on a sample of the keys to count the queries per
+operation on every connection, including those of worker threads (Django 2.0 or later).
+"""
+import platform
+import threading
+from collections import OrderedDict
+
+import django
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.backends.signals import connection_created
+
+from horizon.cache import monotonic
+from horizon.utils import (
+    clear_index_cache,
+    get_or_create_index,
+    get_or_create_indexes,
+)
+
+from .models import Metadata, PlainEntry, ShardedEntry
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name, setup=None):
+    """Register ``func(keys)`` as a benchmark, ``setup(keys)`` prepares its data."""
+    def decorator(func):
+        BENCHMARKS[name] = (setup, func)
+        return func
+    return decorator
+
+
+def reset():
+    for connection in connections.all():
+        for model in (ShardedEntry, PlainEntry, Metadata):
+            model._base_manager.using(connection.alias).all().delete()
+    clear_index_cache()
+
+
+def create_metadata(keys):
+    get_or_create_indexes(ShardedEntry, keys)
+    clear_index_cache()
+
+
+def warm_index_cache(keys):
+    get_or_create_indexes(ShardedEntry, keys)
+
+
+def create_entries(keys):
+    PlainEntry.objects.bulk_create([PlainEntry(user=key, spam='spam') for key in keys])
+    ShardedEntry.objects.bulk_create([ShardedEntry(user=key, spam='spam') for key in keys])
+
+
+@benchmark('filter.plain', setup=create_entries)
+def filter_plain(keys):
+    for key in keys:
+        list(PlainEntry.objects.filter(user=key))
+
+
+@benchmark('filter.horizontal', setup=create_entries)
+def filter_horizontal(keys):
+    for key in keys:
+        list(ShardedEntry.objects.filter(user=key))
+
+
+@benchmark('filter_in.horizontal', setup=create_entries)
+def filter_in_horizontal(keys):
+    for start in range(len(keys)):
+        list(ShardedEntry.objects.filter(user__in=keys[start:start + 10]))
+
+
+@benchmark('get_or_create_index.cold')
+def get_or_create_index_cold(keys):
+    for key in keys:
+        get_or_create_index(ShardedEntry, key)
+
+
+@benchmark('get_or_create_index.metadata', setup=create_metadata)
+def get_or_create_index_metadata(keys):
+    for key in keys:
+        get_or_create_index(ShardedEntry, key)
+
+
+@benchmark('get_or_create_index.warm', setup=warm_index_cache)
+def get_or_create_index_warm(keys):
+    for key in keys:
+        get_or_create_index(ShardedEntry, key)
+
+
+@benchmark('get_or_create_indexes.cold')
+def get_or_create_indexes_cold(keys):
+    get_or_create_indexes(ShardedEntry, keys)
+
+
+@benchmark('create.plain')
+def create_plain(keys):
+    for key in keys:
+        PlainEntry.objects.create(user=key, spam='spam')
+
+
+@benchmark('create.horizontal', setup=warm_index_cache)
+def create_horizontal(keys):
+    for key in keys:
+        ShardedEntry.objects.create(user=key, spam='spam')
+
+
+@benchmark('save.horizontal', setup=create_entries)
+def save_horizontal(keys):
+    entries = list(ShardedEntry.objects.all_shards())
+    for entry in entries:
+        entry.spam = 'egg'
+        entry.save()
+
+
+@benchmark('bulk_create.plain')
+def bulk_create_plain(keys):
+    PlainEntry.objects.bulk_create([PlainEntry(user=key, spam='spam') for key in keys])
+
+
+@benchmark('bulk_create.horizontal', setup=warm_index_cache)
+def bulk_create_horizontal(keys):
+    ShardedEntry.objects.bulk_create([ShardedEntry(user=key, spam='spam') for key in keys])
+
+
+@benchmark('bulk_create.horizontal_cold')
+def bulk_create_horizontal_cold(keys):
+    ShardedEntry.objects.bulk_create([ShardedEntry(user=key, spam='spam') for key in keys])
+
+
+class QueryCounter(object):
+    """Execute wrapper counting the queries of the connections it is installed on."""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, sender=None, connection=None, **kwargs):
+        if connection not in self.connections:
+            self.connections.append(connection)
+            connection.execute_wrappers.append(self)
+
+    def __enter__(self):
+        self.connections = []
+        connection_created.connect(self.install)
+        for connection in connections.all():
+            self.install(connection=connection)
+        return self
+
+    def __exit__(self, *exc_info):
+        connection_created.disconnect(self.install)
+        for connection in self.connections:
+            connection.execute_wrappers.remove(self)
+
+
+def count_queries(func, keys):
+    """Return the number of queries of ``func(keys)``, ``None`` before Django 2.0."""
+    if not hasattr(connections[DEFAULT_DB_ALIAS], 'execute_wrappers'):
+        func(keys)
+        return None
+    with QueryCounter() as counter:
+        func(keys)
+    return counter.count
+
+
+def run_benchmark(name, number=1000, sample=100):
+    """Return the wall time and queries per operation of a benchmark of ``number`` keys."""
+    setup, func = BENCHMARKS[name]
+    keys = list(range(1, number + 1))
+    sample_keys = keys[:sample]
+
+    reset()
+    if setup is not None:
+        setup(keys)
+    started_at = monotonic()
+    func(keys)
+    seconds = monotonic() - started_at
+
+    reset()
+    if setup is not None:
+        setup(sample_keys)
+    queries = count_queries(func, sample_keys)
+
+    return OrderedDict([
+        ('operations', number),
+        ('seconds', seconds),
+        ('operations_per_second', number / seconds if seconds else None),
+        ('microseconds_per_operation', seconds * 10 ** 6 / number),
+        ('queries_per_operation',
+         float(queries) / len(sample_keys) if queries is not None else None),
+    ])
+
+
+def run_benchmarks(names=None, number=1000, sample=100):
+    """Run the benchmarks, all by default, and return the results as a JSON-able dict."""
+    results = OrderedDict()
+    for name in names or BENCHMARKS:
+        results[name] = run_benchmark(name, number=number, sample=min(sample, number))
+    reset()
+    return OrderedDict([
+        ('python', platform.python_version()),
+        ('django', django.get_version()),
+        ('number', number),
+        ('results', results),
+    ])
@@ -1,3 +1,5 @@
 __author__ = """UNCOVER TRUTH Inc."""
 __email__ = 'develop@uncovertruth.co.jp'
 __version__ = '1.1.2'
+
+default_app_config = 'horizon.apps.HorizonConfig'
@@ -0,0 +1,147 @@
+"""Asyncio API of horizontal models, on Python 3.6 or later.
+
+Not imported by the rest of horizon. Database calls run on a thread pool of ``MAX_WORKERS``
+threads so that they never block the event loop, and the shards of a query across shards are
+queried concurrently. Worker threads keep their connections as ``CONN_MAX_AGE`` allows.
+
+Database calls use the write pins of the calling task on Python 3.7 or later. On Python 3.6,
+pins are shared by the coroutines of a thread, see ``pin_writes()``.
+"""
+import asyncio
+import functools
+
+from django.db.models.manager import Manager
+
+from .pinning import get_pins
+from .query import QuerySet
+from .utils import (
+    call_in_worker,
+    get_executor,
+    get_group_from_model,
+    get_index_cache,
+    get_or_create_index,
+    get_or_create_indexes,
+    get_placement_from_group,
+)
+
+
+async def run_in_executor(func, *args, **kwargs):
+    """Call ``func`` on the thread pool and return its result, with the current write pins."""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        get_executor(),
+        functools.partial(call_in_worker, functools.partial(func, *args, **kwargs), get_pins()),
+    )
+
+
+def _is_index_cached(model, horizontal_key):
+    horizontal_group = get_group_from_model(model)
+    if not get_placement_from_group(horizontal_group).uses_metadata:
+        return True
+    return get_index_cache().peek(horizontal_group, horizontal_key) is not None
+
+
+async def aget_or_create_index(model, horizontal_key):
+    """Like ``get_or_create_index()``, without leaving the event loop for cached keys."""
+    if _is_index_cached(model, horizontal_key):
+        return get_or_create_index(model, horizontal_key)
+    return await run_in_executor(get_or_create_index, model, horizontal_key)
+
+
+async def aget_or_create_indexes(model, horizontal_keys):
+    """Like ``get_or_create_indexes()``, without leaving the event loop for cached keys."""
+    horizontal_keys = list(horizontal_keys)
+    if all(_is_index_cached(model, key) for key in horizontal_keys):
+        return get_or_create_indexes(model, horizontal_keys)
+    return await run_in_executor(get_or_create_indexes, model, horizontal_keys)
+
+
+class AsyncQuerySetMixin(object):
+    """Coroutine versions of the QuerySet methods that query databases.
+
+    ``filter()`` and the other methods returning a new QuerySet do not query, chain them
+    before awaiting, e.g. ``await SomeModel.objects.filter(user=user).acount()``.
+    """
+
+    async def _agather(self, func):
+        """Call ``func`` with the QuerySet of each shard concurrently, return the results."""
+        querysets = await run_in_executor(self._get_shard_querysets)
+        return querysets, await asyncio.gather(*[
+            run_in_executor(func, queryset) for queryset in querysets
+        ])
+
+    async def afetch(self):
+        """Return the list of rows of the QuerySet."""
+        if self._result_cache is not None:
+            return self._result_cache
+        if not self._is_horizontal_scatter():
+            return await run_in_executor(list, self)
+        querysets, shard_rows = await self._agather(list)
+        self._result_cache = list(self._merge_shard_rows(querysets, shard_rows))
+        return self._result_cache
+
+    async def aiterate(self):
+        """Iterate over the rows of the QuerySet, which are fetched at once."""
+        for row in await self.afetch():
+            yield row
+
+    async def aget(self, *args, **kwargs):
+        return await run_in_executor(self.get, *args, **kwargs)
+
+    async def afirst(self):
+        return await run_in_executor(self.first)
+
+    async def acreate(self, **kwargs):
+        return await run_in_executor(self.create, **kwargs)
+
+    async def aget_or_create(self, defaults=None, **kwargs):
+        return await run_in_executor(self.get_or_create, defaults=defaults, **kwargs)
+
+    async def aupdate_or_create(self, defaults=None, **kwargs):
+        return await run_in_executor(self.update_or_create, defaults=defaults, **kwargs)
+
+    async def abulk_create(self, objs, batch_size=None, **kwargs):
+        return await run_in_executor(self.bulk_create, objs, batch_size=batch_size, **kwargs)
+
+    async def acount(self):
+        if self._result_cache is not None or not self._is_horizontal_scatter():
+            return await run_in_executor(self.count)
+        querysets, counts = await self._agather(lambda queryset: queryset.count())
+        return self._combine_counts(counts)
+
+    async def aexists(self):
+        if self._result_cache is not None or not self._is_horizontal_scatter():
+            return await run_in_executor(self.exists)
+        querysets, results = await self._agather(lambda queryset: queryset.exists())
+        return any(results)
+
+    async def aaggregate(self, *args, **kwargs):
+        if not self._is_horizontal_scatter():
+            return await run_in_executor(self.aggregate, *args, **kwargs)
+        partials, combiners = self._split_aggregates(args, kwargs)
+        querysets, results = await self._agather(
+            lambda queryset: queryset.aggregate(**partials))
+        return {alias: combine(results) for alias, combine in combiners.items()}
+
+    async def aupdate(self, **kwargs):
+        return await run_in_executor(self.update, **kwargs)
+    aupdate.alters_data = True
+
+    async def adelete(self):
+        return await run_in_executor(self.delete)
+    adelete.alters_data = True
+    adelete.queryset_only = True
+
+
+class AsyncQuerySet(AsyncQuerySetMixin, QuerySet):
+    pass
+
+
+class AsyncHorizontalManager(Manager.from_queryset(AsyncQuerySet)):
+    """``HorizontalManager`` with the coroutine methods of ``AsyncQuerySetMixin``."""
+
+    use_for_related_fields = True
+    use_in_migrations = True
+
+    def __init__(self):
+        super(AsyncHorizontalManager, self).__init__()
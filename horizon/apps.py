@@ -0,0 +1,26 @@
+import logging
+
+from django.apps import AppConfig
+from django.db import DatabaseError
+
+logger = logging.getLogger(__name__)
+
+
+class HorizonConfig(AppConfig):
+    name = 'horizon'
+    verbose_name = 'Django Horizon'
+
+    def ready(self):
+        from .routing import get_routing_table
+        from .settings import get_config
+        from .utils import warm_index_cache
+
+        get_routing_table()  # Fail at boot on an invalid HORIZONTAL_CONFIG
+        config = get_config()
+        if not config['WARMUP']:
+            return
+        groups = None if config['WARMUP'] is True else config['WARMUP']
+        try:
+            warm_index_cache(groups, limit=config['WARMUP_LIMIT'])
+        except DatabaseError:
+            logger.warning("Failed to warm the index cache", exc_info=True)
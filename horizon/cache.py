@@ -0,0 +1,189 @@
+import threading
+from collections import OrderedDict, namedtuple
+
+from django.core.cache import caches
+from django.utils.encoding import force_text
+
+try:
+    from time import monotonic
+except ImportError:  # Python 2
+    from time import time as monotonic
+
+CacheInfo = namedtuple('CacheInfo', ('hits', 'misses', 'max_size', 'size'))
+
+# Index of keys known to have no metadata yet
+EMPTY = -1
+
+
+class IndexCache(object):
+    """Thread-safe LRU cache of horizontal key to database index assignments.
+
+    Entries are keyed by ``(group, key)``. ``max_size`` bounds the number of entries
+    (``None`` for unbounded) and ``timeout`` is an optional time to live in seconds.
+    Keys known to have no index are cached as ``EMPTY``, which ``get()`` returns only when
+    asked with ``empty=True``.
+    """
+
+    def __init__(self, max_size=None, timeout=None):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(group, key):
+        return group, force_text(key)
+
+    def get(self, group, key, empty=False):
+        cache_key = self.make_key(group, key)
+        with self._lock:
+            entry = self._entries.pop(cache_key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            index, expires_at = entry
+            if expires_at is not None and expires_at <= monotonic():
+                self.misses += 1
+                return None
+
+            self._entries[cache_key] = entry  # Move to the most recently used end
+            if index == EMPTY and not empty:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return index
+
+    def peek(self, group, key, empty=False):
+        """Like ``get()``, without counting a hit or a miss nor marking the entry as used."""
+        with self._lock:
+            entry = self._entries.get(self.make_key(group, key))
+        if entry is None:
+            return None
+        index, expires_at = entry
+        if expires_at is not None and expires_at <= monotonic():
+            return None
+        if index == EMPTY and not empty:
+            return None
+        return index
+
+    def set(self, group, key, index, timeout=None):
+        if self.max_size == 0:
+            return
+
+        cache_key = self.make_key(group, key)
+        if timeout is None:
+            timeout = self.timeout
+        expires_at = None
+        if timeout is not None:
+            expires_at = monotonic() + timeout
+
+        with self._lock:
+            self._entries.pop(cache_key, None)
+            self._entries[cache_key] = (index, expires_at)
+            if self.max_size is not None:
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+
+    def set_empty(self, group, key, timeout=None):
+        """Cache that the key has no index, e.g. no metadata, for ``timeout`` seconds."""
+        self.set(group, key, EMPTY, timeout=timeout)
+
+    def delete(self, group, key):
+        with self._lock:
+            self._entries.pop(self.make_key(group, key), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.max_size, len(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SingleFlight(object):
+    """Run a function once at a time for each key, concurrent callers share its result."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event()}
+
+        if not leader:
+            call['done'].wait()
+            if 'error' in call:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = func()
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+
+    def __len__(self):
+        return len(self._calls)
+
+
+class SharedIndexCache(object):
+    """Horizontal key to database index assignments stored in a Django cache.
+
+    Backed by the cache ``alias`` from ``CACHES`` so that assignments are shared between
+    processes. Entries are stored with ``version`` so that changing it invalidates
+    every entry written with a previous version, e.g. after rebalancing.
+    """
+
+    key_prefix = 'horizon:index'
+
+    def __init__(self, alias, timeout=None, version=None):
+        self.alias = alias
+        self.timeout = timeout
+        self.version = version
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def make_key(self, group, key):
+        return '%s:%s:%s' % (self.key_prefix, group, force_text(key))
+
+    def get(self, group, key):
+        return self.cache.get(self.make_key(group, key), version=self.version)
+
+    def set(self, group, key, index):
+        self.cache.set(
+            self.make_key(group, key), index, timeout=self.timeout, version=self.version)
+
+    def get_many(self, group, keys):
+        cache_keys = {self.make_key(group, key): key for key in keys}
+        found = self.cache.get_many(list(cache_keys), version=self.version)
+        return {cache_keys[cache_key]: index for cache_key, index in found.items()}
+
+    def set_many(self, group, indexes):
+        self.cache.set_many(
+            {self.make_key(group, key): index for key, index in indexes.items()},
+            timeout=self.timeout,
+            version=self.version,
+        )
+
+    def delete(self, group, key):
+        self.cache.delete(self.make_key(group, key), version=self.version)
@@ -0,0 +1,83 @@
+import threading
+import time
+
+from django.core.cache import caches
+from django.db import OperationalError
+from django.utils.encoding import force_text
+
+from .cache import monotonic
+from .settings import get_config
+
+# Expiry of the keys frozen by this process, by group and key
+_frozen_keys = {}
+_frozen_keys_lock = threading.Lock()
+
+
+def _get_freeze_cache_key(group, key):
+    return 'horizon:frozen:%s:%s' % (group, force_text(key))
+
+
+def freeze_key(group, key, timeout=None):
+    """Hold writes of a horizontal key, e.g. while it is moved to another database.
+
+    The freeze is shared between processes through the ``FREEZE_CACHE`` cache alias, or
+    held in this process only when it is not set. It expires after ``timeout`` seconds
+    (``FREEZE_TIMEOUT`` by default) in case the mover dies. Freezing a frozen key again
+    extends the freeze.
+    """
+    config = get_config()
+    if timeout is None:
+        timeout = config['FREEZE_TIMEOUT']
+    if config['FREEZE_CACHE']:
+        caches[config['FREEZE_CACHE']].set(_get_freeze_cache_key(group, key), True, timeout)
+    with _frozen_keys_lock:
+        _frozen_keys[(group, force_text(key))] = monotonic() + timeout
+
+
+def unfreeze_key(group, key):
+    config = get_config()
+    if config['FREEZE_CACHE']:
+        caches[config['FREEZE_CACHE']].delete(_get_freeze_cache_key(group, key))
+    with _frozen_keys_lock:
+        _frozen_keys.pop((group, force_text(key)), None)
+
+
+def get_frozen_keys(group, keys):
+    """Return the set of the keys that are frozen, looked up at once."""
+    config = get_config()
+    if config['FREEZE_CACHE']:
+        cache_keys = {_get_freeze_cache_key(group, key): key for key in keys}
+        frozen = caches[config['FREEZE_CACHE']].get_many(list(cache_keys))
+        return {cache_keys[cache_key] for cache_key, value in frozen.items() if value}
+    if not _frozen_keys:
+        return set()
+    now = monotonic()
+    return {
+        key for key in keys
+        if _frozen_keys.get((group, force_text(key)), now) > now
+    }
+
+
+def is_frozen(group, key):
+    return bool(get_frozen_keys(group, [key]))
+
+
+def wait_until_unfrozen(group, keys, interval=0.05):
+    """Block while any of the keys is frozen, return the set of the keys that were.
+
+    Raises ``OperationalError`` if a key is still frozen after ``FREEZE_TIMEOUT`` seconds.
+    """
+    keys = list(keys)
+    frozen = get_frozen_keys(group, keys)
+    if not frozen:
+        return frozen
+
+    timeout_at = monotonic() + get_config()['FREEZE_TIMEOUT']
+    waiting = frozen
+    while waiting:
+        if monotonic() >= timeout_at:
+            raise OperationalError(
+                "Horizontal key '%s' of '%s' is being moved" % (next(iter(waiting)), group))
+        time.sleep(interval)
+        waiting = get_frozen_keys(group, waiting)
+    return frozen
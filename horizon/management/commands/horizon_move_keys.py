@@ -0,0 +1,65 @@
+from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError
+from django.db.utils import NotSupportedError
+
+from horizon.relocation import move_keys
+
+
+def add_mover_arguments(parser):
+    parser.add_argument(
+        '--batch-size', type=int, default=500,
+        help="Number of rows to copy with each query.",
+    )
+    parser.add_argument(
+        '--rate', type=float, default=None,
+        help="Max number of rows to copy per second.",
+    )
+    parser.add_argument(
+        '--settle', type=float, default=None,
+        help="Seconds to hold writes after the metadata is updated, "
+             "INDEX_CACHE_TIMEOUT by default.",
+    )
+    parser.add_argument(
+        '--no-verify', action='store_false', dest='verify',
+        help="Do not verify the copied rows before the metadata is updated.",
+    )
+    parser.add_argument(
+        '--single-process', action='store_true',
+        help="Allow moving without FREEZE_CACHE and INDEX_CACHE_TIMEOUT, when no other "
+             "process uses the group.",
+    )
+
+
+def get_mover_options(options):
+    return {
+        'batch_size': options['batch_size'],
+        'rate': options['rate'],
+        'settle': options['settle'],
+        'verify': options['verify'],
+        'single_process': options['single_process'],
+    }
+
+
+class Command(BaseCommand):
+    help = "Move every row of horizontal keys to another database index of their group."
+
+    def add_arguments(self, parser):
+        parser.add_argument('group', help="Horizontal group of the keys.")
+        parser.add_argument('index', type=int, help="Database index to move the keys to.")
+        parser.add_argument('keys', nargs='+', help="Horizontal keys to move.")
+        add_mover_arguments(parser)
+
+    def handle(self, group, index, keys, **options):
+        try:
+            results = move_keys(group, keys, index, **get_mover_options(options))
+        except (
+            ImproperlyConfigured, NotSupportedError, ObjectDoesNotExist, OperationalError,
+        ) as e:
+            raise CommandError(e)
+
+        for result in results:
+            self.stdout.write(
+                "Moved '%s' from %s to %s (%d rows copied)"
+                % (result.key, result.source, result.target, result.rows)
+            )
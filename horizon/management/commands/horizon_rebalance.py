@@ -0,0 +1,110 @@
+from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError
+from django.db.utils import NotSupportedError
+
+from horizon.placement import get_pickable_weights
+from horizon.relocation import (
+    Checkpoint,
+    KeyMover,
+    check_movable,
+    plan_rebalance,
+    rebalance,
+)
+from horizon.utils import get_config_from_group
+
+from .horizon_move_keys import add_mover_arguments, get_mover_options
+
+
+def parse_weights(value):
+    try:
+        return dict(
+            (int(index), float(weight))
+            for index, weight in (item.split('=') for item in value.split(','))
+        )
+    except ValueError:
+        raise CommandError("Weights must be of the form 'index=weight,...', got '%s'" % value)
+
+
+class Command(BaseCommand):
+    help = "Move keys between the database indexes of a group to match a target distribution."
+
+    def add_arguments(self, parser):
+        parser.add_argument('group', help="Horizontal group to rebalance.")
+        parser.add_argument(
+            '--weights', default=None,
+            help="Target distribution as 'index=weight,...', the PICKABLES by default. "
+                 "Indexes without weight are emptied.",
+        )
+        parser.add_argument(
+            '--limit', type=int, default=None,
+            help="Max number of keys to move.",
+        )
+        parser.add_argument(
+            '--keys-per-move', type=int, default=100,
+            help="Number of keys moved together, with a single freeze and settle.",
+        )
+        parser.add_argument(
+            '--checkpoint', default=None,
+            help="JSON file to record the plan and progress in, to resume an interrupted run "
+                 "with the recorded plan.",
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help="Show the moves without applying them.",
+        )
+        add_mover_arguments(parser)
+
+    def handle(self, group, **options):
+        if not get_config_from_group(group):
+            raise CommandError("Unknown horizontal group '%s'" % group)
+        try:
+            check_movable(group)
+        except NotSupportedError as e:
+            raise CommandError(e)
+        if not options['dry_run']:
+            try:
+                KeyMover(group, **get_mover_options(options))  # Check options before planning
+            except ImproperlyConfigured as e:
+                raise CommandError(e)
+
+        checkpoint = None
+        moves = None
+        if options['checkpoint']:
+            checkpoint = Checkpoint(options['checkpoint'])
+            if checkpoint.load():
+                if checkpoint.group != group:
+                    raise CommandError(
+                        "Checkpoint is for group '%s', not '%s'" % (checkpoint.group, group))
+                if options['weights'] or options['limit'] is not None:
+                    raise CommandError(
+                        "Checkpoint '%s' already has a plan, --weights and --limit cannot "
+                        "change it" % options['checkpoint'])
+                moves = checkpoint.moves
+                self.stdout.write(
+                    "Resume %d of %d moves" % (len(moves) - len(checkpoint.done), len(moves)))
+
+        if moves is None:
+            if options['weights']:
+                weights = parse_weights(options['weights'])
+            else:
+                weights = get_pickable_weights(get_config_from_group(group))
+            moves = plan_rebalance(group, weights, limit=options['limit'])
+            if checkpoint is not None and not options['dry_run']:
+                checkpoint.group = group
+                checkpoint.moves = moves
+                checkpoint.save()
+
+        if options['dry_run']:
+            for key, source, target in moves:
+                self.stdout.write("Move '%s' from %s to %s" % (key, source, target))
+            return
+
+        try:
+            moved = rebalance(
+                group, moves, checkpoint=checkpoint, keys_per_move=options['keys_per_move'],
+                **get_mover_options(options)
+            )
+        except (ImproperlyConfigured, ObjectDoesNotExist, OperationalError) as e:
+            raise CommandError(e)
+        self.stdout.write("Moved %d keys" % moved)
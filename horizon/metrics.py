@@ -0,0 +1,90 @@
+import threading
+from collections import defaultdict
+
+from django.dispatch import Signal
+from django.utils import six
+from django.utils.lru_cache import lru_cache
+from django.utils.module_loading import import_string
+
+from .settings import get_config
+
+# Sent by ``send_signal`` with ``event`` and the data of the event
+metric_recorded = Signal()
+
+
+@lru_cache()
+def get_metric_sinks():
+    """Return the callables of ``METRICS_SINKS``, called with each event and its data.
+
+    Events are:
+
+    * ``'route'`` with ``model``, ``operation`` (``'read'`` or ``'write'``), ``index`` and
+      ``database`` for each database selected for a horizontal model.
+    * ``'index'`` with ``group``, ``counts`` of keys per source (``'local_cache'``,
+      ``'shared_cache'``, ``'metadata'`` or ``'placement'``) and ``duration`` in seconds for
+      each resolution of the indexes of one or many keys.
+    * ``'index_created'`` with ``group`` and ``count`` for keys assigned a new index, when
+      the backend reports the inserted rows.
+
+    With no sinks, events are not built at all.
+    """
+    return tuple(
+        import_string(sink) if isinstance(sink, six.string_types) else sink
+        for sink in get_config()['METRICS_SINKS']
+    )
+
+
+def emit(event, **data):
+    for sink in get_metric_sinks():
+        sink(event, **data)
+
+
+def send_signal(event, **data):
+    """Sink sending ``metric_recorded``."""
+    metric_recorded.send(sender=event, event=event, **data)
+
+
+class Counters(object):
+    """Sink aggregating events in this process.
+
+    Counts routes per model label and operation, routes per database alias and operation,
+    resolved keys per group and source, created keys per group and the total time spent
+    resolving indexes per group.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.routes = defaultdict(int)
+            self.databases = defaultdict(int)
+            self.indexes = defaultdict(int)
+            self.created = defaultdict(int)
+            self.durations = defaultdict(float)
+
+    def __call__(self, event, **data):
+        with self._lock:
+            if event == 'route':
+                self.routes[(data['model']._meta.label, data['operation'])] += 1
+                self.databases[(data['database'], data['operation'])] += 1
+            elif event == 'index':
+                for source, count in data['counts'].items():
+                    self.indexes[(data['group'], source)] += count
+                self.durations[data['group']] += data['duration']
+            elif event == 'index_created':
+                self.created[data['group']] += data['count']
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'routes': dict(self.routes),
+                'databases': dict(self.databases),
+                'indexes': dict(self.indexes),
+                'created': dict(self.created),
+                'durations': dict(self.durations),
+            }
+
+
+counters = Counters()
@@ -1,19 +1,24 @@
 import uuid
 
+from django.conf import settings
 from django.core import checks
 from django.core.exceptions import FieldDoesNotExist
 from django.db import models
 from django.db.migrations import state
 from django.db.migrations.operations import models as migrate_models
-from django.db.models import options
+from django.db.models import options, signals
 from django.utils.functional import cached_property
 
 from .manager import HorizontalManager
+from .routing import HorizontalRouting, check_config
+from .settings import get_config
 from .utils import (
     get_config_from_model,
     get_group_from_model,
     get_key_field_name_from_model,
     get_or_create_index,
+    get_routing_from_model,
+    invalidate_index,
 )
 
 _HORIZON_OPTIONS = (
@@ -28,6 +33,14 @@ state.DEFAULT_NAMES += _HORIZON_OPTIONS
 migrate_models.AlterModelOptions.ALTER_OPTION_KEYS += list(_HORIZON_OPTIONS)
 
 
+@checks.register('horizon')
+def check_horizontal_config(app_configs=None, **kwargs):
+    return [
+        checks.Error(message, obj='HORIZONTAL_CONFIG', id='horizon.E004')
+        for message in check_config(get_config(), settings.DATABASES)
+    ]
+
+
 class AbstractHorizontalMetadata(models.Model):
     group = models.CharField(max_length=15)
     key = models.CharField(max_length=32)
@@ -40,6 +53,28 @@ class AbstractHorizontalMetadata(models.Model):
         )
 
 
+def _invalidate_index_from_metadata(sender, instance, **kwargs):
+    invalidate_index(instance.group, instance.key)
+
+
+def _connect_metadata_signals(sender, **kwargs):
+    if not issubclass(sender, AbstractHorizontalMetadata):
+        return
+    signals.post_save.connect(_invalidate_index_from_metadata, sender=sender)
+    signals.post_delete.connect(_invalidate_index_from_metadata, sender=sender)
+
+
+signals.class_prepared.connect(_connect_metadata_signals)
+
+
+def _attach_horizontal_routing(sender, **kwargs):
+    if get_group_from_model(sender) and get_key_field_name_from_model(sender):
+        sender._meta.horizontal_routing = HorizontalRouting.from_model(sender)
+
+
+signals.class_prepared.connect(_attach_horizontal_routing)
+
+
 class AbstractHorizontalModel(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
 
@@ -139,8 +174,7 @@ class AbstractHorizontalModel(models.Model):
 
     @cached_property
     def _horizontal_key(self):
-        key_field = self._meta.get_field(get_key_field_name_from_model(self))
-        return getattr(self, key_field.attname)
+        return getattr(self, get_routing_from_model(self).key_attname)
 
     @cached_property
     def _horizontal_database_index(self):
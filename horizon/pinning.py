@@ -0,0 +1,122 @@
+import threading
+from contextlib import contextmanager
+
+from django.utils.encoding import force_text
+
+from .cache import monotonic
+from .settings import get_config
+
+try:
+    from contextvars import ContextVar
+except ImportError:  # Python 3.6 or earlier
+    ContextVar = None
+
+# Pins of the current context, i.e. the thread or the asyncio task, or of the thread before
+# Python 3.7, where coroutines of the same event loop share them
+if ContextVar is not None:
+    _pins = ContextVar('horizon_pins', default=None)
+else:
+    _local = threading.local()
+
+
+class WritePins(object):
+    """Shards (or keys of them) written to recently, which are read from their primary.
+
+    A write pins the shard, or only the written key when ``by_key`` is set and the key is
+    known, for ``timeout`` seconds (``None`` for the rest of the scope).
+    """
+
+    def __init__(self, timeout=None, by_key=False):
+        self.timeout = timeout
+        self.by_key = by_key
+        self._expires_at = {}
+
+    def pin(self, group, index, key=None):
+        expires_at = None
+        if self.timeout is not None:
+            expires_at = monotonic() + self.timeout
+        if not self.by_key or key is None:
+            key = None
+        else:
+            key = force_text(key)
+        self._expires_at[(group, index, key)] = expires_at
+
+    def is_pinned(self, group, index, key=None):
+        """Return whether to read from the primary of the shard.
+
+        Without ``key``, e.g. for reads of many keys, any pin of the shard counts.
+        """
+        now = monotonic()
+        if key is not None:
+            key = force_text(key)
+        for (pinned_group, pinned_index, pinned_key), expires_at in list(self._expires_at.items()):
+            if pinned_group != group or pinned_index != index:
+                continue
+            if key is not None and pinned_key is not None and pinned_key != key:
+                continue
+            if expires_at is None or now < expires_at:
+                return True
+        return False
+
+    def __len__(self):
+        return len(self._expires_at)
+
+
+def get_pins():
+    """Return the pins of the current scope, or ``None`` outside of ``pin_writes()``."""
+    if ContextVar is not None:
+        return _pins.get()
+    return getattr(_local, 'pins', None)
+
+
+@contextmanager
+def use_pins(pins):
+    if ContextVar is not None:
+        token = _pins.set(pins)
+        try:
+            yield pins
+        finally:
+            _pins.reset(token)
+        return
+
+    previous_pins = get_pins()
+    _local.pins = pins
+    try:
+        yield pins
+    finally:
+        _local.pins = previous_pins
+
+
+@contextmanager
+def pin_writes(timeout=None, by_key=None):
+    """Read from the primary of the shards written to in the block.
+
+    ``timeout`` and ``by_key`` default to the ``PIN_TIMEOUT`` and ``PIN_BY`` settings.
+    Nested blocks share the pins of the outermost one.
+
+    Pins are kept per asyncio task on Python 3.7 or later. Before, they are kept per thread,
+    so do not use ``pin_writes()`` in coroutines running concurrently on an event loop.
+    """
+    pins = get_pins()
+    if pins is not None:
+        yield pins
+        return
+
+    config = get_config()
+    if timeout is None:
+        timeout = config['PIN_TIMEOUT']
+    if by_key is None:
+        by_key = config['PIN_BY'] == 'key'
+    with use_pins(WritePins(timeout=timeout, by_key=by_key)) as pins:
+        yield pins
+
+
+class ReadYourWritesMiddleware(object):
+    """Pin writes of each request, so that the request reads what it has written."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with pin_writes():
+            return self.get_response(request)
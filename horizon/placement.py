@@ -0,0 +1,159 @@
+import hashlib
+import random
+import threading
+from bisect import bisect
+from collections import OrderedDict
+
+from django.db.models import Count
+from django.utils.encoding import force_bytes, force_text
+
+from .cache import monotonic
+
+
+def get_weights(pickables):
+    """Return an ordered dict of index to weight from ``PICKABLES``.
+
+    ``PICKABLES`` is either a list of indexes of the same weight or a dict of index to
+    weight, e.g. ``{2: 3, 3: 1}``. Indexes with a weight of zero are never picked.
+    """
+    if isinstance(pickables, dict):
+        weights = OrderedDict(sorted(pickables.items()))
+    else:
+        weights = OrderedDict((index, 1) for index in pickables)
+    return OrderedDict((index, weight) for index, weight in weights.items() if weight > 0)
+
+
+def get_pickable_weights(group_config):
+    """Return the ordered dict of index to weight of the ``PICKABLES`` of a group config.
+
+    Every database of the group is pickable with the same weight by default.
+    """
+    return get_weights(group_config.get(
+        'PICKABLES', [int(index) for index in group_config.get('DATABASES', {})]))
+
+
+def get_read_weights(member):
+    """Return the ordered dict of alias to weight of the ``read`` of a database of a group.
+
+    The ``write`` alias is read from by default.
+    """
+    return get_weights(member.get('read', [member['write']]))
+
+
+def get_cumulative_weights(weights):
+    """Return the list of members of a dict of weights and the list of their running totals.
+
+    A member is picked in proportion to its weight with
+    ``members[bisect(totals, random.random() * totals[-1])]``.
+    """
+    members, totals = [], []
+    total = 0
+    for member, weight in weights.items():
+        total += weight
+        members.append(member)
+        totals.append(total)
+    return members, totals
+
+
+class BasePlacement(object):
+    """Decide the database index of new horizontal keys in a group.
+
+    Placements with ``uses_metadata`` store the index picked for each key in the metadata
+    model, others must always compute the same index for a key.
+    """
+
+    uses_metadata = True
+
+    def __init__(self, group, config):
+        self.group = group
+        self.config = config
+        self.weights = get_pickable_weights(config)
+
+    def pick(self, key):
+        raise NotImplementedError('subclasses of BasePlacement must provide a pick() method')
+
+
+class RandomPlacement(BasePlacement):
+    """Pick a random index from ``PICKABLES`` in proportion to their weights."""
+
+    def __init__(self, group, config):
+        super(RandomPlacement, self).__init__(group, config)
+        self._indexes, self._totals = get_cumulative_weights(self.weights)
+
+    def pick(self, key):
+        return self._indexes[bisect(self._totals, random.random() * self._totals[-1])]
+
+
+class ConsistentHashPlacement(BasePlacement):
+    """Compute the index from the key on a hash ring of ``PICKABLES``, without metadata.
+
+    Each index has ``vnodes`` points on the ring for each unit of weight, so that keys are
+    spread in proportion to the weights and adding an index moves only the keys that fall
+    into its points.
+    """
+
+    uses_metadata = False
+
+    def __init__(self, group, config, vnodes=100):
+        super(ConsistentHashPlacement, self).__init__(group, config)
+        ring = sorted(
+            (self.hash('%s-%s' % (index, vnode)), index)
+            for index, weight in self.weights.items()
+            for vnode in range(int(vnodes * weight))
+        )
+        self._hashes = [point for point, index in ring]
+        self._indexes = [index for point, index in ring]
+
+    @staticmethod
+    def hash(value):
+        return int(hashlib.md5(force_bytes(value)).hexdigest()[:16], 16)
+
+    def pick(self, key):
+        position = bisect(self._hashes, self.hash(force_text(key)))
+        return self._indexes[position % len(self._indexes)]
+
+
+class LeastPopulatedPlacement(BasePlacement):
+    """Pick the index of ``PICKABLES`` with the fewest keys for its weight.
+
+    Key counts per index are read from the metadata model and cached for ``timeout``
+    seconds. Picks made in the meantime are added to the cached counts, so that a burst of
+    new keys is not assigned to the same index.
+    """
+
+    def __init__(self, group, config, timeout=60):
+        super(LeastPopulatedPlacement, self).__init__(group, config)
+        self.timeout = timeout
+        self._counts = None
+        self._expires_at = None
+        self._lock = threading.Lock()
+
+    def get_counts(self):
+        from .utils import get_metadata_model
+
+        counts = dict.fromkeys(self.weights, 0)
+        counts.update(
+            (row['index'], row['count'])
+            for row in (
+                get_metadata_model().objects
+                .filter(group=self.group, index__in=list(self.weights))
+                .values('index')
+                .annotate(count=Count('pk'))
+                .order_by()
+            )
+        )
+        return counts
+
+    def clear(self):
+        with self._lock:
+            self._counts = None
+
+    def pick(self, key):
+        with self._lock:
+            if self._counts is None or self._expires_at <= monotonic():
+                self._counts = self.get_counts()
+                self._expires_at = monotonic() + self.timeout
+
+            index = min(self.weights, key=lambda i: float(self._counts[i]) / self.weights[i])
+            self._counts[index] += 1
+            return index
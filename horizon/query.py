@@ -1,14 +1,142 @@
-from django.db.models import Model
+import heapq
+from collections import OrderedDict
+from decimal import Decimal
+from itertools import chain, islice
+
+import django
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connections, transaction
+from django.db.models import Avg, Count, F, Max, Min, Model, Sum
+from django.db.models.expressions import OrderBy
+from django.db.models.lookups import In
+from django.db.models.query import Prefetch
 from django.db.models.query import QuerySet as DjangoQuerySet
-from django.db.utils import ProgrammingError
+from django.db.models.sql.where import AND
+from django.db.utils import NotSupportedError, ProgrammingError
+
+from .freezing import wait_until_unfrozen
+from .settings import get_config
+from .utils import (
+    get_db_for_read_from_model_index,
+    get_db_for_write_from_model_index,
+    get_indexes,
+    get_key_field_name_from_model,
+    get_or_create_indexes,
+    get_routing_from_model,
+    prime,
+    run_in_parallel,
+)
+
+
+class _OrderingKey(object):
+    """Sort key of a row from the ordering values and their directions."""
+
+    __slots__ = ('values', 'descendings', 'nulls_largest')
+
+    def __init__(self, values, descendings, nulls_largest):
+        self.values = values
+        self.descendings = descendings
+        self.nulls_largest = nulls_largest
+
+    def __eq__(self, other):
+        return self.values == other.values
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __lt__(self, other):
+        for value, other_value, descending in zip(self.values, other.values, self.descendings):
+            if value == other_value:
+                continue
+            if value is None:
+                less = not self.nulls_largest
+            elif other_value is None:
+                less = self.nulls_largest
+            else:
+                less = value < other_value
+            return less != descending
+        return False
+
+
+def _sum_values(values):
+    values = [value for value in values if value is not None]
+    return sum(values) if values else None
+
+
+def _min_values(values):
+    values = [value for value in values if value is not None]
+    return min(values) if values else None
 
-from .utils import get_key_field_name_from_model
+
+def _max_values(values):
+    values = [value for value in values if value is not None]
+    return max(values) if values else None
+
+
+def _split_aggregate(alias, aggregate):
+    """Split an aggregate into partial aggregates for each shard and a function combining them.
+
+    The function takes the list of per-shard results of the partial aggregates.
+    """
+    extra = {}
+    if getattr(aggregate, 'filter', None) is not None:
+        extra['filter'] = aggregate.filter
+    expressions = aggregate.source_expressions
+
+    if isinstance(aggregate, Count):
+        if getattr(aggregate, 'distinct', False) or aggregate.extra.get('distinct'):
+            raise NotSupportedError("Count(distinct=True) across shards is not supported")
+        return {alias: aggregate}, lambda results: sum(result[alias] for result in results)
+
+    if isinstance(aggregate, Sum):
+        return (
+            {alias: aggregate},
+            lambda results: _sum_values(result[alias] for result in results),
+        )
+
+    if isinstance(aggregate, Min):
+        return (
+            {alias: aggregate},
+            lambda results: _min_values(result[alias] for result in results),
+        )
+
+    if isinstance(aggregate, Max):
+        return (
+            {alias: aggregate},
+            lambda results: _max_values(result[alias] for result in results),
+        )
+
+    if isinstance(aggregate, Avg):
+        sum_alias = '%s__horizontal_sum' % alias
+        count_alias = '%s__horizontal_count' % alias
+
+        def combine(results):
+            total = _sum_values(result[sum_alias] for result in results)
+            count = sum(result[count_alias] for result in results)
+            if not count:
+                return None
+            if isinstance(total, Decimal):
+                return total / count
+            return float(total) / count
+
+        return (
+            {
+                sum_alias: Sum(*expressions, **extra),
+                count_alias: Count(*expressions, **extra),
+            },
+            combine,
+        )
+
+    raise NotSupportedError(
+        "Aggregate '%s' across shards is not supported" % type(aggregate).__name__)
 
 
 class HorizontalQuerySetMixin(object):
     def __init__(self, model=None, **kwargs):
         super(HorizontalQuerySetMixin, self).__init__(model=model, **kwargs)
         self._horizontal_key = None
+        self._horizontal_keys = None
+        self._horizontal_all_shards = False
 
     @classmethod
     def _get_horizontal_key_from_lookup_value(cls, lookup_value):
@@ -22,10 +150,46 @@ class HorizontalQuerySetMixin(object):
         if self._horizontal_key is not None:
             return
 
-        key_field = self.model._meta.get_field(get_key_field_name_from_model(self.model))
-        lookup_value = kwargs.get(key_field.attname, None) or kwargs.get(key_field.name, None)
+        routing = get_routing_from_model(self.model)
+        lookup_value = kwargs.get(routing.key_attname, None) or kwargs.get(routing.key_name, None)
         self._horizontal_key = self._get_horizontal_key_from_lookup_value(lookup_value)
 
+    def _get_key_field(self):
+        return self.model._meta.get_field(get_routing_from_model(self.model).key_name)
+
+    def _set_horizontal_keys_from_params(self, kwargs):
+        if self._horizontal_key is not None:
+            return
+
+        routing = get_routing_from_model(self.model)
+        for lookup in ('%s__in' % routing.key_attname, '%s__in' % routing.key_name):
+            if lookup in kwargs:
+                break
+        else:
+            return
+        lookup_values = kwargs[lookup]
+        if hasattr(lookup_values, 'resolve_expression'):
+            return  # Keys of a subquery or an expression are unknown until it runs
+
+        horizontal_keys = OrderedDict()
+        for lookup_value in lookup_values:
+            horizontal_key = self._get_horizontal_key_from_lookup_value(lookup_value)
+            if horizontal_key is not None:
+                horizontal_keys[horizontal_key] = None
+        if self._horizontal_keys is not None:
+            # Chained filters, only keys in every list can match
+            key_field = self._get_key_field()
+            prepared_keys = {key_field.get_prep_value(key) for key in horizontal_keys}
+            horizontal_keys = OrderedDict(
+                (key, None) for key in self._horizontal_keys
+                if key_field.get_prep_value(key) in prepared_keys
+            )
+        if len(horizontal_keys) == 1:
+            self._horizontal_key, = horizontal_keys
+            self._horizontal_keys = None
+        else:
+            self._horizontal_keys = tuple(horizontal_keys)
+
     def _create_object_from_params(self, lookup, *args, **kwargs):
         self._set_horizontal_key_from_params(lookup)
         return super(HorizontalQuerySetMixin, self)._create_object_from_params(
@@ -36,24 +200,398 @@ class HorizontalQuerySetMixin(object):
         return super(HorizontalQuerySetMixin, self)._extract_model_params(defaults, **kwargs)
 
     def _filter_or_exclude(self, negate, *args, **kwargs):
-        self._set_horizontal_key_from_params(kwargs)
-        return super(HorizontalQuerySetMixin, self)._filter_or_exclude(negate, *args, **kwargs)
+        routing = get_routing_from_model(self.model)
+        for lookup in ('%s__in' % routing.key_attname, '%s__in' % routing.key_name):
+            lookup_values = kwargs.get(lookup)
+            if lookup_values is None or isinstance(lookup_values, (list, tuple)):
+                continue
+            if not hasattr(lookup_values, 'resolve_expression'):
+                kwargs[lookup] = list(lookup_values)  # Iterated by both the query and the keys
+        clone = super(HorizontalQuerySetMixin, self)._filter_or_exclude(negate, *args, **kwargs)
+        clone._set_horizontal_key_from_params(kwargs)
+        if not negate:
+            clone._set_horizontal_keys_from_params(kwargs)
+        return clone
 
     def create(self, **kwargs):
         self._set_horizontal_key_from_params(kwargs)
         return super(HorizontalQuerySetMixin, self).create(**kwargs)
 
+    def _partition_by_shard(self, objs):
+        """Return a list of (database, objs) pairs with the database for writing each object."""
+        prime(objs)
+        objs_by_index = OrderedDict()
+        for obj in objs:
+            objs_by_index.setdefault(obj._horizontal_database_index, []).append(obj)
+        objs_by_database = OrderedDict()
+        for index, index_objs in objs_by_index.items():
+            database = get_db_for_write_from_model_index(self.model, index)
+            objs_by_database.setdefault(database, []).extend(index_objs)
+        return list(objs_by_database.items())
+
+    @staticmethod
+    def _run_for_shards(func, shards, parallel):
+        if parallel:
+            return run_in_parallel(func, shards)
+        return [func(shard) for shard in shards]
+
+    def bulk_create(self, objs, batch_size=None, parallel=False, **kwargs):
+        """Insert objects into the shard of each object's horizontal key.
+
+        Indexes of the keys are resolved in a batch, then objects are inserted with batched
+        queries per shard, on a thread pool when ``parallel``. Each shard is inserted in its
+        own transaction.
+        """
+        if self._db:
+            return super(HorizontalQuerySetMixin, self).bulk_create(
+                objs, batch_size=batch_size, **kwargs)
+
+        objs = list(objs)
+        if not objs:
+            return objs
+
+        def create(shard):
+            database, shard_objs = shard
+            return self._clone().using(database).bulk_create(
+                shard_objs, batch_size=batch_size, **kwargs)
+
+        self._run_for_shards(create, self._partition_by_shard(objs), parallel)
+        return objs
+
+    def bulk_update(self, objs, fields, batch_size=None, parallel=False):
+        """Update fields of objects in the shard of each object's horizontal key.
+
+        Objects are partitioned like ``bulk_create()``. Requires Django 2.2 or later.
+        """
+        if not hasattr(DjangoQuerySet, 'bulk_update'):
+            raise NotSupportedError("bulk_update() requires Django 2.2 or later")
+        if self._db:
+            return super(HorizontalQuerySetMixin, self).bulk_update(
+                objs, fields, batch_size=batch_size)
+
+        objs = list(objs)
+        if not objs:
+            return
+
+        def update(shard):
+            database, shard_objs = shard
+            return self._clone().using(database).bulk_update(
+                shard_objs, fields, batch_size=batch_size)
+
+        self._run_for_shards(update, self._partition_by_shard(objs), parallel)
+
     def _clone(self, **kwargs):
         clone = super(HorizontalQuerySetMixin, self)._clone(**kwargs)
         clone._horizontal_key = self._horizontal_key
+        clone._horizontal_keys = self._horizontal_keys
+        clone._horizontal_all_shards = self._horizontal_all_shards
+        return clone
+
+    def all_shards(self):
+        """Return a new QuerySet that runs on every database of the horizontal group.
+
+        Needed to query without the horizontal key filter, the query runs on each shard
+        concurrently and the results are combined.
+        """
+        clone = self._clone()
+        clone._horizontal_all_shards = True
         return clone
 
+    def _is_horizontal_scatter(self):
+        return (
+            (self._horizontal_all_shards or self._horizontal_keys is not None)
+            and self._horizontal_key is None
+            and not self._db
+        )
+
+    def _is_horizontal_fanout(self):
+        return self._horizontal_keys is not None and self._horizontal_key is None and not self._db
+
+    def _trim_horizontal_keys(self, horizontal_keys):
+        """Restrict the values of ``key__in`` lookups in the query to the given keys."""
+        key_field = self._get_key_field()
+        prepared_keys = {key_field.get_prep_value(key) for key in horizontal_keys}
+        nodes = [self.query.where]
+        while nodes:
+            node = nodes.pop()
+            if node.connector != AND or node.negated:
+                continue
+            for position, child in enumerate(node.children):
+                if hasattr(child, 'children'):
+                    nodes.append(child)
+                elif (
+                    isinstance(child, In)
+                    and getattr(child.lhs, 'target', None) == key_field
+                    and not hasattr(child.rhs, 'resolve_expression')
+                ):
+                    node.children[position] = type(child)(
+                        child.lhs, [value for value in child.rhs if value in prepared_keys])
+
+    def _get_shard_querysets(self):
+        if self._for_write:
+            get_database = get_db_for_write_from_model_index
+        else:
+            get_database = get_db_for_read_from_model_index
+
+        if self._db:
+            return [self._clone()]
+
+        horizontal_keys = self._horizontal_keys
+        if self._horizontal_key is not None:
+            horizontal_keys = (self._horizontal_key, )
+        if horizontal_keys is not None:
+            if self._for_write:
+                wait_until_unfrozen(get_routing_from_model(self.model).group, horizontal_keys)
+            if self._for_write or get_config()['CREATE_INDEX_ON_READ']:
+                indexes = get_or_create_indexes(self.model, horizontal_keys)
+            else:
+                indexes = get_indexes(self.model, horizontal_keys)  # Keys without rows skipped
+            keys_by_index = OrderedDict()
+            for horizontal_key in horizontal_keys:
+                if horizontal_key in indexes:
+                    keys_by_index.setdefault(indexes[horizontal_key], []).append(horizontal_key)
+        elif not self._horizontal_all_shards:
+            raise ProgrammingError("Missing horizontal key field's filter")
+        else:
+            keys_by_index = OrderedDict(
+                (index, None) for index in get_routing_from_model(self.model).table.indexes)
+
+        if len(keys_by_index) > 1:
+            if self.query.group_by is not None:
+                raise NotSupportedError("Grouping across shards is not supported")
+            if self.query.distinct:
+                raise NotSupportedError("distinct() across shards is not supported")
+
+        querysets = []
+        for index, horizontal_keys in sorted(keys_by_index.items()):
+            queryset = self._clone()
+            queryset._horizontal_keys = None
+            queryset._horizontal_all_shards = False
+            if horizontal_keys is not None:
+                queryset._trim_horizontal_keys(horizontal_keys)
+            if queryset.query.low_mark:
+                # Each shard returns rows from the first one, the offset is applied after merged
+                high_mark = queryset.query.high_mark
+                queryset.query.clear_limits()
+                queryset.query.set_limits(high=high_mark)
+            horizontal_key = None
+            if horizontal_keys is not None and len(horizontal_keys) == 1:
+                horizontal_key = horizontal_keys[0]
+            querysets.append(queryset.using(get_database(self.model, index, horizontal_key)))
+        return querysets
+
+    def _get_ordering_value_getter(self, field_name):
+        if isinstance(field_name, OrderBy) and isinstance(field_name.expression, F):
+            descending = field_name.descending
+            field_name = field_name.expression.name
+        elif isinstance(field_name, F):
+            descending = False
+            field_name = field_name.name
+        elif not hasattr(field_name, 'resolve_expression') and field_name != '?':
+            descending = field_name.startswith('-')
+            field_name = field_name.lstrip('-')
+        else:
+            raise NotSupportedError("Ordering across shards by '%s' is not supported" % field_name)
+
+        if '__' in field_name:
+            raise NotSupportedError(
+                "Ordering across shards by related field '%s' is not supported" % field_name)
+
+        if field_name == 'pk':
+            attname = self.model._meta.pk.attname
+        else:
+            try:
+                attname = self.model._meta.get_field(field_name).attname
+            except FieldDoesNotExist:
+                attname = field_name  # Annotation
+
+        fields = getattr(self, '_fields', None) or ()
+
+        def get_value(row):
+            if isinstance(row, Model):
+                return getattr(row, attname)
+            for name in (field_name, attname):
+                if isinstance(row, dict):
+                    if name in row:
+                        return row[name]
+                elif name in fields:
+                    return row[fields.index(name)] if isinstance(row, tuple) else row
+            raise NotSupportedError(
+                "Ordering across shards needs '%s' in the selected fields" % field_name)
+
+        return get_value, descending
+
+    def _get_ordering_key(self, database):
+        query = self.query
+        if query.extra_order_by:
+            raise NotSupportedError("Ordering across shards by extra() is not supported")
+        if query.order_by:
+            ordering = query.order_by
+        elif query.default_ordering and self.model._meta.ordering:
+            ordering = self.model._meta.ordering
+        else:
+            return None
+
+        getters, descendings = [], []
+        for field_name in ordering:
+            getter, descending = self._get_ordering_value_getter(field_name)
+            getters.append(getter)
+            descendings.append(descending != (not query.standard_ordering))
+        descendings = tuple(descendings)
+        nulls_largest = connections[database].features.nulls_order_largest
+
+        def get_key(row):
+            return _OrderingKey(tuple(get(row) for get in getters), descendings, nulls_largest)
+
+        return get_key
+
+    def _merge_shard_rows(self, querysets, shard_rows):
+        """Combine rows of each shard in the order of the QuerySet and apply its limits.
+
+        Rows of each shard must be in the order already, so they are merged lazily and
+        only the heads of each shard are compared.
+        """
+        get_key = self._get_ordering_key(querysets[0].db) if querysets else None
+        if get_key is None:
+            rows = chain.from_iterable(shard_rows)
+        else:
+            rows = (
+                row for key, shard, position, row in heapq.merge(*[
+                    ((get_key(row), shard, position, row) for position, row in enumerate(rows))
+                    for shard, rows in enumerate(shard_rows)
+                ])
+            )
+
+        if self.query.low_mark or self.query.high_mark is not None:
+            rows = islice(rows, self.query.low_mark, self.query.high_mark)
+        return rows
+
+    def _fetch_all(self):
+        if self._result_cache is None and self._is_horizontal_scatter():
+            querysets = self._get_shard_querysets()
+            self._result_cache = list(
+                self._merge_shard_rows(querysets, run_in_parallel(list, querysets))
+            )
+        super(HorizontalQuerySetMixin, self)._fetch_all()
+
+    def iterator(self, *args, **kwargs):
+        if not self._is_horizontal_scatter():
+            return super(HorizontalQuerySetMixin, self).iterator(*args, **kwargs)
+        querysets = self._get_shard_querysets()
+        return self._merge_shard_rows(
+            querysets,
+            [queryset.iterator(*args, **kwargs) for queryset in querysets],
+        )
+
+    def _split_aggregates(self, args, kwargs):
+        """Return the partial aggregates for each shard and the functions combining them."""
+        if self.query.low_mark or self.query.high_mark is not None:
+            raise NotSupportedError("Aggregate across shards after slicing is not supported")
+        for arg in args:
+            try:
+                kwargs[arg.default_alias] = arg
+            except (AttributeError, TypeError):
+                raise TypeError("Complex aggregates require an alias")
+
+        partials = {}
+        combiners = {}
+        for alias, aggregate in kwargs.items():
+            if not getattr(aggregate, 'contains_aggregate', False):
+                raise TypeError("%s is not an aggregate expression" % alias)
+            aggregate_partials, combiners[alias] = _split_aggregate(alias, aggregate)
+            partials.update(aggregate_partials)
+        return partials, combiners
+
+    def aggregate(self, *args, **kwargs):
+        if not self._is_horizontal_scatter():
+            return super(HorizontalQuerySetMixin, self).aggregate(*args, **kwargs)
+
+        partials, combiners = self._split_aggregates(args, kwargs)
+        results = run_in_parallel(
+            lambda queryset: queryset.aggregate(**partials),
+            self._get_shard_querysets(),
+        )
+        return {alias: combine(results) for alias, combine in combiners.items()}
+
+    def _combine_counts(self, counts):
+        # Each shard counts up to the high mark, so the total is right after clamped
+        count = sum(counts)
+        if self.query.high_mark is not None:
+            count = min(count, self.query.high_mark)
+        return max(0, count - self.query.low_mark)
+
+    def count(self):
+        if self._result_cache is not None or not self._is_horizontal_scatter():
+            return super(HorizontalQuerySetMixin, self).count()
+        return self._combine_counts(
+            run_in_parallel(lambda queryset: queryset.count(), self._get_shard_querysets()))
+
+    def exists(self):
+        if self._result_cache is not None or not self._is_horizontal_scatter():
+            return super(HorizontalQuerySetMixin, self).exists()
+        return any(run_in_parallel(lambda queryset: queryset.exists(), self._get_shard_querysets()))
+
+    def update_by_shard(self, **kwargs):
+        """Update rows on each shard in its own transaction.
+
+        Return a dict of the number of updated rows by database.
+        """
+        assert self.query.can_filter(), "Cannot update a query once a slice has been taken."
+        self._for_write = True
+
+        def update(queryset):
+            with transaction.atomic(using=queryset.db):
+                return queryset.db, queryset.update(**kwargs)
+
+        return OrderedDict(run_in_parallel(update, self._get_shard_querysets()))
+    update_by_shard.alters_data = True
+    update_by_shard.queryset_only = True
+
+    def update(self, **kwargs):
+        if not self._is_horizontal_fanout():
+            return super(HorizontalQuerySetMixin, self).update(**kwargs)
+        return sum(self.update_by_shard(**kwargs).values())
+    update.alters_data = True
+
+    def delete_by_shard(self):
+        """Delete rows on each shard in its own transaction.
+
+        Return a dict of the result of ``delete()`` by database.
+        """
+        assert self.query.can_filter(), "Cannot use 'limit' or 'offset' with delete."
+        self._for_write = True
+
+        def delete(queryset):
+            with transaction.atomic(using=queryset.db):
+                return queryset.db, queryset.delete()
+
+        deleted = OrderedDict(run_in_parallel(delete, self._get_shard_querysets()))
+        self._result_cache = None
+        return deleted
+    delete_by_shard.alters_data = True
+    delete_by_shard.queryset_only = True
+
+    def delete(self):
+        if not self._is_horizontal_fanout():
+            return super(HorizontalQuerySetMixin, self).delete()
+
+        deleted, rows_count = 0, {}
+        for shard_deleted, shard_rows_count in self.delete_by_shard().values():
+            deleted += shard_deleted
+            for label, count in shard_rows_count.items():
+                rows_count[label] = rows_count.get(label, 0) + count
+        return deleted, rows_count
+    delete.alters_data = True
+    delete.queryset_only = True
+
     @property
     def db(self):
         if self._db:
             return self._db
 
         if self._horizontal_key is None:
+            if self._horizontal_all_shards or self._horizontal_keys is not None:
+                raise ProgrammingError("Not supported for the QuerySet across shards")
             raise ProgrammingError("Missing horizontal key field's filter")
 
         self._add_hints(horizontal_key=self._horizontal_key)
@@ -62,3 +600,60 @@ class HorizontalQuerySetMixin(object):
 
 class QuerySet(HorizontalQuerySetMixin, DjangoQuerySet):
     pass
+
+
+def prefetch_horizontal_objects(instances, *lookups):
+    """Prefetch reverse relations to horizontal models on instances from another database.
+
+    Like ``prefetch_related_objects()`` for relations to models partitioned by the relation
+    itself, e.g. ``somelargemodel_set`` of users. Instances are grouped by the shard of their
+    key and each shard is queried once. Lookups are related names or ``Prefetch`` objects.
+    """
+    instances = list(instances)
+    if not instances:
+        return
+
+    for lookup in lookups:
+        if not isinstance(lookup, Prefetch):
+            lookup = Prefetch(lookup)
+        if '__' in lookup.prefetch_through:
+            raise NotSupportedError(
+                "Prefetching nested lookup '%s' across shards is not supported"
+                % lookup.prefetch_through)
+
+        descriptor = getattr(instances[0].__class__, lookup.prefetch_through)
+        field = descriptor.field
+        if get_key_field_name_from_model(field.model) != field.name:
+            raise ValueError(
+                "'%s' is not a relation by the horizontal key of '%s'"
+                % (lookup.prefetch_through, field.model.__name__))
+
+        horizontal_keys = [getattr(instance, field.target_field.attname) for instance in instances]
+        queryset = lookup.queryset
+        if queryset is None:
+            queryset = field.model._default_manager.all()
+        related_objects = OrderedDict((key, []) for key in horizontal_keys)
+        for obj in queryset.filter(**{'%s__in' % field.name: horizontal_keys}):
+            related_objects[getattr(obj, field.attname)].append(obj)
+
+        if django.VERSION < (2, 0):
+            cache_name = field.related_query_name()
+        else:
+            cache_name = field.remote_field.get_cache_name()
+        for instance, horizontal_key in zip(instances, horizontal_keys):
+            objs = related_objects[horizontal_key]
+            for obj in objs:
+                if hasattr(field, 'set_cached_value'):
+                    field.set_cached_value(obj, instance)
+                else:
+                    setattr(obj, field.get_cache_name(), instance)
+
+            if lookup.to_attr:
+                setattr(instance, lookup.to_attr, objs)
+                continue
+            manager_queryset = getattr(instance, lookup.prefetch_through).get_queryset()
+            manager_queryset._result_cache = objs
+            manager_queryset._prefetch_done = True
+            if not hasattr(instance, '_prefetched_objects_cache'):
+                instance._prefetched_objects_cache = {}
+            instance._prefetched_objects_cache[cache_name] = manager_queryset
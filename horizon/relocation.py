@@ -0,0 +1,414 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.apps import apps
+from django.core.exceptions import ImproperlyConfigured
+from django.db import OperationalError, router, transaction
+from django.db.models import Count
+from django.db.utils import NotSupportedError
+from django.utils.encoding import force_text
+
+from .cache import monotonic
+from .freezing import freeze_key, unfreeze_key
+from .settings import get_config
+from .utils import (
+    get_metadata_model,
+    get_placement_from_group,
+    get_routing_from_model,
+    invalidate_index,
+    run_in_parallel,
+)
+
+logger = logging.getLogger(__name__)
+
+MoveResult = namedtuple('MoveResult', ('group', 'key', 'source', 'target', 'rows'))
+
+
+class Throttle(object):
+    """Sleep to keep the number of rows processed under ``rate`` per second."""
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.rows = 0
+        self.started_at = monotonic()
+
+    def wait(self, rows):
+        self.rows += rows
+        if not self.rate:
+            return
+        delay = self.started_at + float(self.rows) / self.rate - monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def get_group_models(group):
+    """Return the concrete models of the group, each after the models it refers to."""
+    models = []
+    for model in apps.get_models():
+        routing = get_routing_from_model(model)
+        if model._meta.proxy or routing is None or routing.key_attname is None:
+            continue
+        if routing.group == group:
+            models.append(model)
+    ordered = []
+    pending = list(models)
+    while pending:
+        for model in pending:
+            dependencies = set(model._meta.get_parent_list())
+            dependencies.update(
+                field.related_model for field in model._meta.local_concrete_fields
+                if field.is_relation and field.related_model is not model
+            )
+            if not dependencies.intersection(set(pending) - {model}):
+                break
+        else:
+            raise NotSupportedError("Circular relations between '%s' models" % group)
+        pending.remove(model)
+        ordered.append(model)
+    return ordered
+
+
+def check_movable(group):
+    """Raise ``NotSupportedError`` if keys of the group are not placed by their metadata."""
+    placement = get_placement_from_group(group)
+    if not placement.uses_metadata:
+        raise NotSupportedError(
+            "Keys of '%s' are placed by %s without metadata and cannot be moved"
+            % (group, type(placement).__name__))
+
+
+class KeyMover(object):
+    """Move every row of a horizontal key to another database index of its group.
+
+    Rows are copied in batches of ``batch_size`` while the key is still written to, at most
+    ``rate`` rows per second. Then writes of the key are frozen, rows changed in the
+    meantime are copied again and verified, the metadata index is updated in a transaction
+    and the index caches are invalidated. Writes stay frozen for ``settle`` more seconds
+    (``INDEX_CACHE_TIMEOUT`` by default) so that other processes drop their cached index,
+    then the index caches are invalidated again, the rows are checked to be still equal
+    and they are deleted from the source database.
+
+    The freeze lasts ``FREEZE_TIMEOUT`` seconds from the metadata update, so ``settle`` must
+    be shorter, and copying again must not take longer either. ``OperationalError`` is
+    raised otherwise, leaving the rows in the source database.
+
+    Other processes only see the freeze through ``FREEZE_CACHE`` and only drop their cached
+    index after ``INDEX_CACHE_TIMEOUT``, so either is required unless ``single_process``,
+    i.e. no other process uses the group while moving. Indexes read from a lagging
+    ``METADATA_READ`` replica must not be cached forever in the ``SHARED_INDEX_CACHE``, so
+    ``SHARED_INDEX_CACHE_TIMEOUT`` is required with both. ``ImproperlyConfigured`` is
+    raised otherwise.
+
+    Keys of groups placed without metadata, e.g. by ``ConsistentHashPlacement``, cannot be
+    moved and raise ``NotSupportedError``.
+    """
+
+    def __init__(self, group, batch_size=500, rate=None, settle=None, verify=True,
+                 single_process=False):
+        check_movable(group)
+        config = get_config()
+        if not single_process:
+            if not config['FREEZE_CACHE']:
+                raise ImproperlyConfigured(
+                    "Moving keys requires FREEZE_CACHE to hold writes of other processes")
+            if settle is None and not config['INDEX_CACHE_TIMEOUT']:
+                raise ImproperlyConfigured(
+                    "Moving keys requires INDEX_CACHE_TIMEOUT or settle for other processes "
+                    "to drop their cached indexes")
+        if (
+            config['METADATA_READ'] and config['SHARED_INDEX_CACHE'] and
+            config['SHARED_INDEX_CACHE_TIMEOUT'] is None
+        ):
+            raise ImproperlyConfigured(
+                "Moving keys with METADATA_READ requires SHARED_INDEX_CACHE_TIMEOUT, or an "
+                "index read from a lagging replica stays in the shared cache")
+        if settle is None:
+            settle = config['INDEX_CACHE_TIMEOUT'] or 0
+        if settle >= config['FREEZE_TIMEOUT']:
+            raise ImproperlyConfigured(
+                "Moving keys requires settle (%s) to be shorter than FREEZE_TIMEOUT (%s)"
+                % (settle, config['FREEZE_TIMEOUT']))
+        self.group = group
+        self.batch_size = batch_size
+        self.rate = rate
+        self.settle = settle
+        self.verify = verify
+        self.models = get_group_models(group)
+        self.metadata_model = get_metadata_model()
+
+    def get_database(self, index):
+        return get_routing_from_model(self.models[0]).write_databases[index]
+
+    def get_rows(self, model, database, pks):
+        attnames = [field.attname for field in model._meta.local_concrete_fields]
+        position = attnames.index(model._meta.pk.attname)
+        queryset = model._base_manager.using(database).filter(pk__in=pks)
+        return {row[position]: row for row in queryset.values_list(*attnames)}
+
+    def get_pks(self, model, database, key):
+        routing = get_routing_from_model(model)
+        return set(
+            model._base_manager.using(database)
+            .filter(**{routing.key_name: key})
+            .values_list('pk', flat=True)
+        )
+
+    def sync(self, key, source, target, throttle=None, dry_run=False):
+        """Make rows of the key in the target database equal to the source one.
+
+        Returns the number of rows that were (or with ``dry_run``, would be) changed.
+        """
+        changed = 0
+        for model in self.models:
+            source_pks = self.get_pks(model, source, key)
+            target_pks = self.get_pks(model, target, key)
+            if not dry_run and target_pks - source_pks:
+                model._base_manager.using(target).filter(pk__in=target_pks - source_pks).delete()
+            changed += len(target_pks - source_pks)
+
+            pks = sorted(source_pks)
+            for start in range(0, len(pks), self.batch_size):
+                batch = pks[start:start + self.batch_size]
+                source_rows = self.get_rows(model, source, batch)
+                target_rows = self.get_rows(model, target, batch)
+                missing = [pk for pk in source_rows if pk not in target_rows]
+                stale = [
+                    pk for pk in source_rows
+                    if pk in target_rows and target_rows[pk] != source_rows[pk]
+                ]
+                changed += len(missing) + len(stale)
+                if not dry_run:
+                    self.write_rows(model, target, source_rows, missing, stale)
+                if throttle is not None:
+                    throttle.wait(len(batch))
+        return changed
+
+    def write_rows(self, model, database, rows, missing, stale):
+        fields = model._meta.local_concrete_fields
+        objs = [model(**dict(zip([f.attname for f in fields], rows[pk]))) for pk in missing]
+        if model._meta.parents:
+            for obj in objs:  # Only the table of the model, parents are moved on their own
+                obj.save_base(raw=True, force_insert=True, using=database)
+        elif objs:
+            model._base_manager.using(database).bulk_create(objs)
+
+        for pk in stale:
+            model._base_manager.using(database).filter(pk=pk).update(**{
+                field.attname: value for field, value in zip(fields, rows[pk])
+                if not field.primary_key
+            })
+
+    def delete(self, key, database):
+        for model in reversed(self.models):
+            pks = sorted(self.get_pks(model, database, key))
+            for start in range(0, len(pks), self.batch_size):
+                model._base_manager.using(database).filter(
+                    pk__in=pks[start:start + self.batch_size]).delete()
+
+    def move(self, key, index):
+        return self.move_many([key], index)[0]
+
+    def move_many(self, keys, index):
+        """Move the keys together, with a single freeze and settle for all of them.
+
+        Returns a list of ``MoveResult`` in the order of the keys.
+        """
+        keys = [force_text(key) for key in keys]
+        sources = dict(
+            self.metadata_model.objects
+            .filter(group=self.group, key__in=keys)
+            .values_list('key', 'index')
+        )
+        for key in keys:
+            if key not in sources:
+                raise self.metadata_model.DoesNotExist(
+                    "Horizontal key '%s' of '%s' has no metadata" % (key, self.group))
+        moving = [key for key in keys if sources[key] != index]
+        rows = dict.fromkeys(keys, 0)
+
+        target = self.get_database(index)
+        throttle = Throttle(self.rate)
+        for key in moving:
+            source = self.get_database(sources[key])
+            logger.info("Move '%s' of '%s' from '%s' to '%s'", key, self.group, source, target)
+            rows[key] = self.sync(key, source, target, throttle=throttle)
+
+        for key in moving:
+            freeze_key(self.group, key)
+        frozen_at = monotonic()
+        try:
+            for key in moving:
+                source = self.get_database(sources[key])
+                rows[key] += self.sync(key, source, target)
+                if self.verify and self.sync(key, source, target, dry_run=True):
+                    raise OperationalError(
+                        "Rows of '%s' of '%s' differ after copy to '%s'"
+                        % (key, self.group, target))
+            if moving and monotonic() - frozen_at >= get_config()['FREEZE_TIMEOUT']:
+                raise OperationalError(
+                    "Freeze of '%s' keys of '%s' expired while copying to '%s'"
+                    % (len(moving), self.group, target))
+
+            for key in moving:
+                freeze_key(self.group, key)  # Held for settle from now on, however long copies took
+            if moving:
+                self.update_metadata(moving, sources, index)
+            for key in moving:
+                invalidate_index(self.group, key)
+
+            if moving and self.settle:
+                time.sleep(self.settle)
+            for key in moving:
+                invalidate_index(self.group, key)  # Cached again meanwhile from a stale read
+            written = [
+                key for key in moving
+                if self.sync(key, self.get_database(sources[key]), target, dry_run=True)
+            ]
+            if written:
+                raise OperationalError(
+                    "Rows of '%s' of '%s' were written to their old database while moving, "
+                    "not deleted" % ("', '".join(written), self.group))
+        finally:
+            for key in moving:
+                unfreeze_key(self.group, key)
+
+        for key in moving:
+            self.delete(key, self.get_database(sources[key]))
+        return [MoveResult(self.group, key, sources[key], index, rows[key]) for key in keys]
+
+    def update_metadata(self, keys, sources, index):
+        """Point the keys to ``index`` in a transaction, if they are still at their source."""
+        with transaction.atomic(using=router.db_for_write(self.metadata_model)):
+            current = dict(
+                self.metadata_model.objects
+                .select_for_update()
+                .filter(group=self.group, key__in=keys)
+                .values_list('key', 'index')
+            )
+            for key in keys:
+                if current.get(key) != sources[key]:
+                    raise OperationalError(
+                        "Index of '%s' of '%s' changed while moving" % (key, self.group))
+            self.metadata_model.objects.filter(group=self.group, key__in=keys).update(index=index)
+
+
+def move_keys(group, keys, index, **options):
+    """Move every row of the horizontal keys of the group to the database ``index``.
+
+    Returns a list of ``MoveResult``. See ``KeyMover`` for the options.
+    """
+    mover = KeyMover(group, **options)
+    return [mover.move(force_text(key), index) for key in keys]
+
+
+def get_index_counts(group):
+    """Return a dict of database index to the number of keys of the group."""
+    return dict(
+        get_metadata_model().objects
+        .filter(group=group)
+        .values_list('index')
+        .annotate(count=Count('pk'))
+        .order_by()
+    )
+
+
+def plan_rebalance(group, weights, limit=None):
+    """Return a list of ``(key, source, target)`` moves to spread keys by ``weights``.
+
+    ``weights`` is a dict of database index to weight, indexes missing from it are emptied.
+    Keys are taken from the indexes with more keys than their share, at most ``limit``.
+    """
+    counts = get_index_counts(group)
+    total = sum(counts.values())
+    total_weight = sum(weights.values())
+    targets = {index: int(round(float(total) * weight / total_weight))
+               for index, weight in weights.items()}
+
+    surplus = OrderedDict()
+    for index, count in sorted(counts.items()):
+        if count > targets.get(index, 0):
+            surplus[index] = count - targets.get(index, 0)
+    deficits = OrderedDict(
+        (index, target - counts.get(index, 0))
+        for index, target in sorted(targets.items()) if target > counts.get(index, 0)
+    )
+
+    metadata_model = get_metadata_model()
+    moves = []
+    for source, number in surplus.items():
+        keys = (
+            metadata_model.objects
+            .filter(group=group, index=source)
+            .order_by('key')
+            .values_list('key', flat=True)
+        )
+        for key in keys[:number]:
+            target = next((index for index, needed in deficits.items() if needed > 0), None)
+            if target is None or (limit is not None and len(moves) >= limit):
+                return moves
+            deficits[target] -= 1
+            moves.append((key, source, target))
+    return moves
+
+
+class Checkpoint(object):
+    """Plan and progress of a rebalance kept in a JSON file, to resume an interrupted run."""
+
+    def __init__(self, path):
+        self.path = path
+        self.group = None
+        self.moves = []
+        self.done = set()
+        self._lock = threading.Lock()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path) as f:
+            data = json.load(f)
+        self.group = data['group']
+        self.moves = [tuple(move) for move in data['moves']]
+        self.done = set(data['done'])
+        return True
+
+    def save(self):
+        with self._lock:
+            data = {'group': self.group, 'moves': self.moves, 'done': sorted(self.done)}
+            temporary_path = '%s.tmp' % self.path
+            with open(temporary_path, 'w') as f:
+                json.dump(data, f)
+            os.rename(temporary_path, self.path)
+
+    def mark_done(self, *keys):
+        with self._lock:
+            self.done.update(keys)
+        self.save()
+
+
+def rebalance(group, moves, checkpoint=None, keys_per_move=100, **options):
+    """Apply ``(key, source, target)`` moves with a worker thread per source and target pair.
+
+    Each worker moves its keys ``keys_per_move`` at a time, see ``KeyMover.move_many()``.
+    Keys marked done in the ``checkpoint`` are skipped, and moved keys are marked done.
+    Returns the number of moved keys. See ``KeyMover`` for the options.
+    """
+    streams = OrderedDict()
+    for key, source, target in moves:
+        if checkpoint is None or key not in checkpoint.done:
+            streams.setdefault((source, target), []).append(key)
+
+    def move_stream(stream):
+        (source, target), keys = stream
+        mover = KeyMover(group, **options)
+        for start in range(0, len(keys), keys_per_move):
+            batch = keys[start:start + keys_per_move]
+            mover.move_many(batch, target)
+            if checkpoint is not None:
+                checkpoint.mark_done(*batch)
+        return len(keys)
+
+    return sum(run_in_parallel(move_stream, streams.items()))
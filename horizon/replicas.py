@@ -0,0 +1,175 @@
+import hashlib
+import math
+import random
+import threading
+from bisect import bisect
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.utils.encoding import force_bytes, force_text
+
+from .cache import monotonic
+from .placement import get_cumulative_weights
+
+
+class BaseReplicaSelector(object):
+    """Select a database from the ``read`` members of an index of a group to read from.
+
+    Built from the ``GroupTable`` of the group, see ``horizon.routing.get_routing_table()``.
+    """
+
+    def __init__(self, table):
+        self.group = table.name
+        self.table = table
+        self.weights = {index: table.read_weights[index] for index in table.indexes}
+
+    def select(self, index, key=None):
+        raise NotImplementedError(
+            'subclasses of BaseReplicaSelector must provide a select() method')
+
+
+class RandomReplicaSelector(BaseReplicaSelector):
+    """Select a random replica in proportion to their weights."""
+
+    def __init__(self, table):
+        super(RandomReplicaSelector, self).__init__(table)
+        self._replicas, self._totals = {}, {}
+        for index, weights in self.weights.items():
+            self._replicas[index], self._totals[index] = get_cumulative_weights(weights)
+
+    def select(self, index, key=None):
+        replicas = self._replicas[index]
+        if len(replicas) == 1:
+            return replicas[0]
+        totals = self._totals[index]
+        return replicas[bisect(totals, random.random() * totals[-1])]
+
+
+class RoundRobinReplicaSelector(BaseReplicaSelector):
+    """Select replicas in turn, in proportion to their weights.
+
+    Uses smooth weighted round-robin, which spreads the turns of a heavier replica between
+    the others and accepts weights that are not integers.
+    """
+
+    def __init__(self, table):
+        super(RoundRobinReplicaSelector, self).__init__(table)
+        self._currents = {
+            index: dict.fromkeys(weights, 0) for index, weights in self.weights.items()
+        }
+        self._totals = {index: sum(weights.values()) for index, weights in self.weights.items()}
+        self._lock = threading.Lock()
+
+    def select(self, index, key=None):
+        weights, currents = self.weights[index], self._currents[index]
+        with self._lock:
+            for replica, weight in weights.items():
+                currents[replica] += weight
+            selected = max(currents, key=currents.get)
+            currents[selected] -= self._totals[index]
+        return selected
+
+
+class KeyAffineReplicaSelector(RandomReplicaSelector):
+    """Always select the same replica for a horizontal key, to keep its caches warm.
+
+    Uses rendezvous hashing weighted by the replica weights, so that adding or removing a
+    replica moves only the keys of that replica. Reads without a key select a random replica.
+    """
+
+    def select(self, index, key=None):
+        if key is None:
+            return super(KeyAffineReplicaSelector, self).select(index, key)
+
+        key = force_text(key)
+        weights = self.weights[index]
+        return max(
+            weights,
+            key=lambda replica: -weights[replica] / math.log(self.score(replica, key)),
+        )
+
+    @staticmethod
+    def score(replica, key):
+        """Return a hash of the replica and the key in the open interval (0, 1)."""
+        value = int(hashlib.md5(force_bytes('%s-%s' % (replica, key))).hexdigest()[:16], 16)
+        return float(value + 1) / (2 ** 64 + 1)
+
+
+class LatencyTracker(object):
+    """Exponentially weighted moving average of query durations per database alias.
+
+    Averages not updated for ``max_age`` seconds are discarded, so that a database that was
+    slow once is measured again rather than avoided for good.
+    """
+
+    def __init__(self, alpha=0.2, max_age=30):
+        self.alpha = alpha
+        self.max_age = max_age
+        self._latencies = {}
+        self._lock = threading.Lock()
+
+    def _is_stale(self, measured_at, now):
+        return self.max_age is not None and measured_at + self.max_age <= now
+
+    def record(self, alias, duration):
+        now = monotonic()
+        with self._lock:
+            latency, measured_at = self._latencies.get(alias, (None, None))
+            if latency is None or self._is_stale(measured_at, now):
+                self._latencies[alias] = (duration, now)
+            else:
+                self._latencies[alias] = (latency + self.alpha * (duration - latency), now)
+
+    def get(self, alias, default=None):
+        latency, measured_at = self._latencies.get(alias, (None, None))
+        if latency is None or self._is_stale(measured_at, monotonic()):
+            return default
+        return latency
+
+    def clear(self):
+        with self._lock:
+            self._latencies.clear()
+
+    def __call__(self, execute, sql, params, many, context):
+        started_at = monotonic()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.record(context['connection'].alias, monotonic() - started_at)
+
+
+latency_tracker = LatencyTracker()
+
+
+def _install_latency_tracker(connection):
+    execute_wrappers = getattr(connection, 'execute_wrappers', None)  # Django 2.0+
+    if execute_wrappers is not None and latency_tracker not in execute_wrappers:
+        connection.execute_wrappers.append(latency_tracker)
+
+
+class LatencyReplicaSelector(BaseReplicaSelector):
+    """Select the replica with the lowest recent query latency.
+
+    Latencies are measured on every query of the connections of the group, on Django 2.0
+    and later. Replicas without a recent measurement, see ``LatencyTracker.max_age``, are
+    selected first, so that every replica is measured again from time to time.
+    """
+
+    def __init__(self, table):
+        super(LatencyReplicaSelector, self).__init__(table)
+        connection_created.connect(
+            self.install_latency_tracker,
+            dispatch_uid='horizon.replicas.latency_tracker.%s' % self.group,
+        )
+        for alias in self.table.database_set:
+            _install_latency_tracker(connections[alias])
+
+    def install_latency_tracker(self, sender, connection, **kwargs):
+        if connection.alias in self.table.database_set:
+            _install_latency_tracker(connection)
+
+    def select(self, index, key=None):
+        return min(
+            self.weights[index],
+            key=lambda replica: latency_tracker.get(replica, 0),
+        )
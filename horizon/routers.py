@@ -3,19 +3,22 @@ import logging
 from django.apps import apps
 from django.db.utils import IntegrityError
 
+from .freezing import wait_until_unfrozen
+from .settings import get_config
 from .utils import (
-    get_config_from_model,
     get_db_for_read_from_model_index,
     get_db_for_write_from_model_index,
     get_group_from_model,
+    get_index,
     get_or_create_index,
+    get_routing_from_model,
 )
 
 logger = logging.getLogger(__name__)
 
 
 class HorizontalRouter(object):
-    def _get_horizontal_index(self, model, hints):
+    def _get_horizontal_index(self, model, hints, for_read=False):
         horizontal_group = get_group_from_model(model)
         if not horizontal_group:
             return
@@ -29,21 +32,44 @@ class HorizontalRouter(object):
 
         if not horizontal_key:
             raise IntegrityError("Missing 'horizontal_key'")
+        if for_read and not get_config()['CREATE_INDEX_ON_READ']:
+            index = get_index(model, horizontal_key)
+            if index is None:
+                # No rows of the key anywhere, any database of the group reads none of them
+                return get_routing_from_model(model).table.pickables[0]
+            return index
         return get_or_create_index(model, horizontal_key)
 
+    def _get_horizontal_key(self, model, hints):
+        horizontal_key = hints.get('horizontal_key', None)
+        if horizontal_key:
+            return horizontal_key
+
+        instance = hints.get('instance', None)
+        if instance and isinstance(instance, model):
+            return instance._horizontal_key
+
     def db_for_read(self, model, **hints):
-        horizontal_index = self._get_horizontal_index(model, hints)
+        horizontal_index = self._get_horizontal_index(model, hints, for_read=True)
         if horizontal_index is None:
             return
-        database = get_db_for_read_from_model_index(model, horizontal_index)
+        database = get_db_for_read_from_model_index(
+            model, horizontal_index, self._get_horizontal_key(model, hints))
         logger.debug("'%s' read from '%s'", model.__name__, database)
         return database
 
     def db_for_write(self, model, **hints):
+        horizontal_group = get_group_from_model(model)
+        horizontal_key = self._get_horizontal_key(model, hints) if horizontal_group else None
+        if horizontal_key is not None and wait_until_unfrozen(horizontal_group, [horizontal_key]):
+            instance = hints.get('instance', None)
+            if instance is not None:
+                instance.__dict__.pop('_horizontal_database_index', None)  # Moved meanwhile
+
         horizontal_index = self._get_horizontal_index(model, hints)
         if horizontal_index is None:
             return
-        database = get_db_for_write_from_model_index(model, horizontal_index)
+        database = get_db_for_write_from_model_index(model, horizontal_index, horizontal_key)
         logger.debug("'%s' read from '%s'", model.__name__, database)
         return database
 
@@ -70,5 +96,6 @@ class HorizontalRouter(object):
         else:
             return
 
-        if db in get_config_from_model(model).get('DATABASE_SET', []):
+        routing = get_routing_from_model(model)
+        if routing is not None and db in routing.database_set:
             return True
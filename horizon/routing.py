@@ -0,0 +1,196 @@
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
+from django.utils.lru_cache import lru_cache
+
+from .placement import get_pickable_weights, get_read_weights, get_weights
+from .settings import get_config
+
+try:
+    from sys import intern
+except ImportError:  # Python 2
+    pass
+
+try:
+    from types import MappingProxyType
+except ImportError:  # Python 2
+    MappingProxyType = dict
+
+_routings = []
+
+GroupTable = namedtuple(
+    'GroupTable',
+    ('name', 'indexes', 'writes', 'reads', 'read_weights', 'pickables', 'database_set'),
+)
+GroupTable.__doc__ = """Compiled routing of a horizontal group.
+
+``writes``, ``reads`` and ``read_weights`` are tuples indexed by database index, of the
+alias to write to, of the tuple of aliases to read from and of the read-only mapping of
+these aliases to their weights (``None`` for unused indexes).
+"""
+
+
+def _get_members(group_config):
+    members = {}
+    for index, member in group_config.get('DATABASES', {}).items():
+        members[int(index)] = member
+    return members
+
+
+def check_config(config, aliases):
+    """Return a list of error messages for the ``GROUPS`` and ``METADATA_READ`` of a config."""
+    errors = []
+    for name, group_config in sorted(config['GROUPS'].items()):
+        if not group_config.get('DATABASES'):
+            errors.append("Group '%s' has no DATABASES." % name)
+            continue
+        try:
+            members = _get_members(group_config)
+        except (TypeError, ValueError):
+            errors.append("Group '%s' has DATABASES keys that are not integers." % name)
+            continue
+
+        for index, member in sorted(members.items()):
+            if index < 0:
+                errors.append("Group '%s' has a negative database index %s." % (name, index))
+            member_aliases = []
+            if 'write' in member:
+                member_aliases.append(member['write'])
+            else:
+                errors.append("Group '%s' database %s has no 'write'." % (name, index))
+            if 'read' in member:
+                if not get_weights(member['read']):
+                    errors.append("Group '%s' database %s has no 'read'." % (name, index))
+                member_aliases.extend(member['read'])
+            for alias in sorted(set(member_aliases) - set(aliases)):
+                errors.append(
+                    "Group '%s' database %s refers to unknown database alias '%s'."
+                    % (name, index, alias))
+
+        pickables = get_pickable_weights(group_config)
+        if not pickables:
+            errors.append("Group '%s' has no PICKABLES." % name)
+        for index in pickables:
+            if index not in members:
+                errors.append(
+                    "Group '%s' PICKABLES refers to database %s which is not in DATABASES."
+                    % (name, index))
+
+    for alias in sorted(set(get_weights(config.get('METADATA_READ') or [])) - set(aliases)):
+        errors.append("METADATA_READ refers to unknown database alias '%s'." % alias)
+    return errors
+
+
+def compile_group(name, group_config):
+    members = _get_members(group_config)
+    size = max(members) + 1
+    writes = [None] * size
+    reads = [None] * size
+    read_weights = [None] * size
+    for index, member in members.items():
+        writes[index] = intern(str(member['write']))
+        read_weights[index] = MappingProxyType(OrderedDict(
+            (intern(str(alias)), weight) for alias, weight in get_read_weights(member).items()))
+        reads[index] = tuple(read_weights[index])
+    return GroupTable(
+        name=name,
+        indexes=tuple(sorted(members)),
+        writes=tuple(writes),
+        reads=tuple(reads),
+        read_weights=tuple(read_weights),
+        pickables=tuple(get_pickable_weights(group_config)),
+        database_set=frozenset(
+            alias for aliases in reads if aliases for alias in aliases
+        ) | frozenset(alias for alias in writes if alias),
+    )
+
+
+@lru_cache()
+def get_routing_table():
+    """Return the validated routing table of ``HORIZONTAL_CONFIG``, compiled once.
+
+    The table maps each group name to its ``GroupTable``. Raises ``ImproperlyConfigured``
+    if the config is not valid.
+    """
+    config = get_config()
+    errors = check_config(config, settings.DATABASES)
+    if errors:
+        raise ImproperlyConfigured(' '.join(errors))
+    return MappingProxyType({
+        name: compile_group(name, group_config)
+        for name, group_config in config['GROUPS'].items()
+    })
+
+
+class HorizontalRouting(object):
+    """Routing of a horizontal model, built once when the model class is prepared.
+
+    Holds the horizontal group and key field of the model, and resolves the group's config
+    and routing table on first use until the config is reloaded.
+    """
+
+    __slots__ = (
+        'group',
+        'key_name',
+        'key_attname',
+        '_config',
+        '_table',
+    )
+
+    def __init__(self, group, key_name, key_attname):
+        object.__setattr__(self, 'group', group)
+        object.__setattr__(self, 'key_name', key_name)
+        object.__setattr__(self, 'key_attname', key_attname)
+        self.reset()
+
+    @classmethod
+    def from_model(cls, model):
+        from .utils import get_group_from_model, get_key_field_name_from_model
+
+        key_name = get_key_field_name_from_model(model)
+        try:
+            key_attname = model._meta.get_field(key_name).attname
+        except FieldDoesNotExist:
+            key_attname = None  # Reported by the model checks
+        routing = cls(get_group_from_model(model), key_name, key_attname)
+        _routings.append(routing)
+        return routing
+
+    def __setattr__(self, name, value):
+        raise AttributeError("'%s' object is immutable" % self.__class__.__name__)
+
+    def reset(self):
+        object.__setattr__(self, '_config', None)
+        object.__setattr__(self, '_table', None)
+
+    @property
+    def config(self):
+        if self._config is None:
+            from .utils import get_config_from_group
+
+            object.__setattr__(self, '_config', get_config_from_group(self.group))
+        return self._config
+
+    @property
+    def table(self):
+        """The ``GroupTable`` of the group, ``None`` if the group is not configured."""
+        if self._table is None:
+            object.__setattr__(self, '_table', get_routing_table().get(self.group, False))
+        return self._table or None
+
+    @property
+    def write_databases(self):
+        return self.table.writes
+
+    @property
+    def database_set(self):
+        if self.table is None:
+            return frozenset()
+        return self.table.database_set
+
+
+def reset_routings():
+    get_routing_table.cache_clear()
+    for routing in _routings:
+        routing.reset()
@@ -4,6 +4,22 @@ from django.utils.lru_cache import lru_cache
 CONFIG_DEFAULTS = {
     'GROUPS': {},
     'METADATA_MODEL': None,
+    'METADATA_READ': None,
+    'INDEX_CACHE_SIZE': 10000,
+    'INDEX_CACHE_TIMEOUT': None,
+    'SHARED_INDEX_CACHE': None,
+    'SHARED_INDEX_CACHE_TIMEOUT': None,
+    'SHARED_INDEX_CACHE_VERSION': 1,
+    'CREATE_INDEX_ON_READ': True,
+    'EMPTY_INDEX_CACHE_TIMEOUT': 5,
+    'MAX_WORKERS': None,
+    'PIN_TIMEOUT': 5,
+    'PIN_BY': 'shard',
+    'FREEZE_CACHE': None,
+    'FREEZE_TIMEOUT': 30,
+    'METRICS_SINKS': [],
+    'WARMUP': False,
+    'WARMUP_LIMIT': None,
 }
 
 
@@ -13,17 +29,4 @@ def get_config():
 
     CONFIG = CONFIG_DEFAULTS.copy()
     CONFIG.update(USER_CONFIG)
-
-    for name, horizontal_group in CONFIG['GROUPS'].items():
-        horizontal_group['DATABASE_SET'] = set()
-        for key, member in horizontal_group['DATABASES'].items():
-            horizontal_group['DATABASE_SET'].add(member['write'])
-            horizontal_group['DATABASE_SET'].update(member.get('read', []))
-
-            if 'read' not in member:
-                member['read'] = [member['write']]
-
-        if 'PICKABLES' not in horizontal_group:
-            horizontal_group['PICKABLES'] = [int(i) for i in horizontal_group['DATABASES'].keys()]
-
     return CONFIG
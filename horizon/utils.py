@@ -1,13 +1,40 @@
+import functools
 import logging
 import random
+import threading
+from bisect import bisect
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from django.apps import apps
 from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.db import (
+    IntegrityError,
+    close_old_connections,
+    connections,
+    router,
+    transaction,
+)
+from django.dispatch import receiver
+from django.utils.encoding import force_text
+from django.utils.lru_cache import lru_cache
+from django.utils.module_loading import import_string
 
+from .cache import EMPTY, IndexCache, SharedIndexCache, SingleFlight, monotonic
+from .freezing import wait_until_unfrozen
+from .metrics import emit, get_metric_sinks
+from .pinning import get_pins, use_pins
+from .placement import get_cumulative_weights, get_weights
+from .routing import get_routing_table, reset_routings
 from .settings import get_config
 
 logger = logging.getLogger(__name__)
 
+_allocations = SingleFlight()
+
+_worker = threading.local()
+
 
 def get_metadata_model():
     try:
@@ -21,7 +48,31 @@ def get_metadata_model():
         )
 
 
+@lru_cache()
+def _get_metadata_read_weights():
+    return get_cumulative_weights(get_weights(get_config()['METADATA_READ'] or []))
+
+
+def get_metadata_read_database():
+    """Return a ``METADATA_READ`` alias picked by weight to look up metadata, or ``None``."""
+    aliases, totals = _get_metadata_read_weights()
+    if not aliases:
+        return None
+    if len(aliases) == 1:
+        return aliases[0]
+    return aliases[bisect(totals, random.random() * totals[-1])]
+
+
+def get_routing_from_model(model):
+    """Return the ``HorizontalRouting`` of a horizontal model, or ``None``."""
+    return getattr(model._meta, 'horizontal_routing', None)
+
+
 def get_group_from_model(model):
+    routing = get_routing_from_model(model)
+    if routing is not None:
+        return routing.group
+
     horizontal_group = getattr(model._meta, 'horizontal_group', None)
     if horizontal_group:
         return horizontal_group
@@ -33,6 +84,10 @@ def get_group_from_model(model):
 
 
 def get_key_field_name_from_model(model):
+    routing = get_routing_from_model(model)
+    if routing is not None:
+        return routing.key_name
+
     horizontal_key = getattr(model._meta, 'horizontal_key', None)
     if horizontal_key:
         return horizontal_key
@@ -50,32 +105,564 @@ def get_config_from_group(horizontal_group):
 
 
 def get_config_from_model(model):
+    routing = get_routing_from_model(model)
+    if routing is not None:
+        return routing.config
+
     horizontal_group = get_group_from_model(model)
     if not horizontal_group:
         return {}
     return get_config_from_group(horizontal_group)
 
 
-def get_db_for_read_from_model_index(model, index):
-    config = get_config_from_model(model)
-    return random.choice(config['DATABASES'][index]['read'])
+@lru_cache()
+def get_placement_from_group(horizontal_group):
+    config = get_config_from_group(horizontal_group)
+    placement_class = import_string(config.get('PLACEMENT', 'horizon.placement.RandomPlacement'))
+    return placement_class(horizontal_group, config, **config.get('PLACEMENT_OPTIONS', {}))
 
 
-def get_db_for_write_from_model_index(model, index):
-    config = get_config_from_model(model)
-    return config['DATABASES'][index]['write']
+@lru_cache()
+def get_replica_selector_from_group(horizontal_group):
+    config = get_config_from_group(horizontal_group)
+    selector_class = import_string(
+        config.get('REPLICA_SELECTOR', 'horizon.replicas.RandomReplicaSelector'))
+    return selector_class(
+        get_routing_table()[horizontal_group], **config.get('REPLICA_SELECTOR_OPTIONS', {}))
 
 
-def get_or_create_index(model, horizontal_key):
+def get_db_for_read_from_model_index(model, index, horizontal_key=None):
+    routing = get_routing_from_model(model)
+    pins = get_pins()
+    if pins is not None and pins.is_pinned(routing.group, index, horizontal_key):
+        database = routing.write_databases[index]
+    else:
+        database = get_replica_selector_from_group(routing.group).select(index, horizontal_key)
+    if get_metric_sinks():
+        emit('route', model=model, operation='read', index=index, database=database)
+    return database
+
+
+def get_db_for_write_from_model_index(model, index, horizontal_key=None):
+    routing = get_routing_from_model(model)
+    pins = get_pins()
+    if pins is not None:
+        pins.pin(routing.group, index, horizontal_key)
+    database = routing.write_databases[index]
+    if get_metric_sinks():
+        emit('route', model=model, operation='write', index=index, database=database)
+    return database
+
+
+@lru_cache()
+def get_executor():
+    """Return the thread pool of ``MAX_WORKERS`` threads shared by queries across shards."""
+    return ThreadPoolExecutor(max_workers=get_config()['MAX_WORKERS'])
+
+
+def call_in_worker(func, pins=None):
+    """Call ``func`` on a thread of the pool with ``pins``.
+
+    Connections of the thread are kept between calls as ``CONN_MAX_AGE`` allows.
+    """
+    _worker.active = True
+    close_old_connections()
+    try:
+        with use_pins(pins):
+            return func()
+    finally:
+        close_old_connections()
+
+
+def run_in_parallel(func, items):
+    """Call ``func`` with each of the items on the thread pool and return the results in order.
+
+    When the current thread is in a transaction, calls run in the current thread instead so
+    that they can see uncommitted changes, and so do calls from a thread of the pool, which
+    could otherwise wait for themselves. Calls share the write pins of the current thread.
+    """
+    items = list(items)
+    if (
+        len(items) < 2 or getattr(_worker, 'active', False) or
+        any(connection.in_atomic_block for connection in connections.all())
+    ):
+        return [func(item) for item in items]
+
+    pins = get_pins()
+    futures = [
+        get_executor().submit(call_in_worker, functools.partial(func, item), pins)
+        for item in items
+    ]
+    return [future.result() for future in futures]
+
+
+@lru_cache()
+def get_index_cache():
+    config = get_config()
+    return IndexCache(
+        max_size=config['INDEX_CACHE_SIZE'],
+        timeout=config['INDEX_CACHE_TIMEOUT'],
+    )
+
+
+@lru_cache()
+def get_shared_index_cache():
+    config = get_config()
+    if not config['SHARED_INDEX_CACHE']:
+        return None
+    return SharedIndexCache(
+        config['SHARED_INDEX_CACHE'],
+        timeout=config['SHARED_INDEX_CACHE_TIMEOUT'],
+        version=config['SHARED_INDEX_CACHE_VERSION'],
+    )
+
+
+def invalidate_index(horizontal_group, horizontal_key):
+    get_index_cache().delete(horizontal_group, horizontal_key)
+    shared_index_cache = get_shared_index_cache()
+    if shared_index_cache is not None:
+        shared_index_cache.delete(horizontal_group, horizontal_key)
+
+
+def clear_index_cache():
+    get_index_cache().clear()
+
+
+def warm_index_cache(groups=None, limit=None, chunk_size=2000):
+    """Load database indexes from the metadata store into the index cache of this process.
+
+    Loads the keys of ``groups`` (every group placed by metadata by default), the most
+    recently assigned first, at most ``limit`` keys per group. Stops once the index cache
+    holds ``INDEX_CACHE_SIZE`` keys, so that warming a group never evicts the keys of the
+    groups warmed before it. Rows are read in chunks of ``chunk_size``.
+    Returns the number of keys loaded.
+    """
+    config = get_config()
+    if groups is None:
+        groups = sorted(config['GROUPS'])
+    index_cache = get_index_cache()
+    room = None
+    if config['INDEX_CACHE_SIZE'] is not None:
+        room = max(config['INDEX_CACHE_SIZE'] - len(index_cache), 0)
+
     metadata_model = get_metadata_model()
+    loaded = 0
+    for horizontal_group in groups:
+        if not get_placement_from_group(horizontal_group).uses_metadata:
+            continue
+        group_limit = limit
+        if room is not None and (limit is None or limit > room):
+            group_limit = room
+        if group_limit == 0:
+            break
+        rows = []
+        queryset = metadata_model.objects.filter(group=horizontal_group).order_by('-pk')
+        if get_metadata_read_database() is not None:
+            queryset = queryset.using(get_metadata_read_database())
+        last_pk = None
+        while group_limit is None or len(rows) < group_limit:
+            chunk = queryset if last_pk is None else queryset.filter(pk__lt=last_pk)
+            size = chunk_size if group_limit is None else min(chunk_size, group_limit - len(rows))
+            chunk = list(chunk.values_list('pk', 'key', 'index')[:size])
+            rows.extend(chunk)
+            if len(chunk) < size:
+                break
+            last_pk = chunk[-1][0]
+
+        # Oldest first, so that the most recent keys are the last to be evicted
+        for pk, key, index in reversed(rows):
+            index_cache.set(horizontal_group, key, index)
+        loaded += len(rows)
+        if room is not None:
+            room -= len(rows)
+        logger.info("Warm %s indexes of '%s'", len(rows), horizontal_group)
+    return loaded
+
+
+def get_or_create_index(model, horizontal_key):
+    return _resolve_index(model, horizontal_key, create=True)
+
+
+def get_index(model, horizontal_key):
+    """Return the database index of the key, ``None`` if it has not been assigned one.
+
+    Unlike ``get_or_create_index()``, never creates metadata. Keys without metadata are
+    cached as such for ``EMPTY_INDEX_CACHE_TIMEOUT`` seconds.
+    """
+    return _resolve_index(model, horizontal_key, create=False)
+
+
+def _resolve_index(model, horizontal_key, create):
+    if not get_metric_sinks():
+        return _get_or_create_index(model, horizontal_key, create)[0]
+
+    started_at = monotonic()
+    index, source = _get_or_create_index(model, horizontal_key, create)
+    emit(
+        'index',
+        group=get_group_from_model(model),
+        counts={source: 1},
+        duration=monotonic() - started_at,
+    )
+    return index
+
+
+def _get_or_create_index(model, horizontal_key, create=True):
+    """Return the database index of the key and where it was found."""
     horizontal_group = get_group_from_model(model)
-    metadata, created = metadata_model.objects.get_or_create(
+    placement = get_placement_from_group(horizontal_group)
+    if not placement.uses_metadata:
+        return placement.pick(horizontal_key), 'placement'
+
+    index_cache = get_index_cache()
+    index = index_cache.get(horizontal_group, horizontal_key, empty=not create)
+    if index == EMPTY:
+        return None, 'local_cache'
+    if index is not None:
+        return index, 'local_cache'
+
+    shared_index_cache = get_shared_index_cache()
+    if shared_index_cache is not None:
+        index = shared_index_cache.get(horizontal_group, horizontal_key)
+        if index is not None:
+            index_cache.set(horizontal_group, horizontal_key, index)
+            return index, 'shared_cache'
+
+    if create:
+        index = _get_or_create_metadata_index(horizontal_group, horizontal_key)
+    else:
+        index = _get_metadata_indexes(horizontal_group, [horizontal_key]).get(
+            force_text(horizontal_key))
+        if index is None:
+            index_cache.set_empty(
+                horizontal_group, horizontal_key, get_config()['EMPTY_INDEX_CACHE_TIMEOUT'])
+            return None, 'metadata'
+    index_cache.set(horizontal_group, horizontal_key, index)
+    if shared_index_cache is not None:
+        shared_index_cache.set(horizontal_group, horizontal_key, index)
+    return index, 'metadata'
+
+
+def get_or_create_indexes(model, horizontal_keys):
+    """Return a dict of database indexes for many horizontal keys of the model.
+
+    Keys missing from the index caches are looked up with a single query, and keys without
+    metadata are assigned with a single multi-row insert.
+    """
+    return _resolve_indexes(model, horizontal_keys, create=True)
+
+
+def get_indexes(model, horizontal_keys):
+    """Return a dict of database indexes of the horizontal keys that have been assigned one.
+
+    Like ``get_or_create_indexes()``, but never creates metadata, see ``get_index()``.
+    """
+    return _resolve_indexes(model, horizontal_keys, create=False)
+
+
+def _resolve_indexes(model, horizontal_keys, create):
+    if not get_metric_sinks():
+        return _get_or_create_indexes(model, horizontal_keys, create)
+
+    started_at = monotonic()
+    counts = {}
+    indexes = _get_or_create_indexes(model, horizontal_keys, create, counts)
+    emit(
+        'index',
         group=get_group_from_model(model),
-        key=horizontal_key,
-        defaults={
-            'index': random.choice(get_config_from_group(horizontal_group)['PICKABLES'])
-        },
+        counts=counts,
+        duration=monotonic() - started_at,
     )
-    if created:
-        logger.info("Assign new index to '%s': %s", horizontal_group, metadata.index)
-    return metadata.index
+    return indexes
+
+
+def _get_or_create_indexes(model, horizontal_keys, create=True, counts=None):
+    """Return a dict of database indexes, counting the distinct keys found per source."""
+    horizontal_group = get_group_from_model(model)
+    placement = get_placement_from_group(horizontal_group)
+    if not placement.uses_metadata:
+        indexes = {key: placement.pick(key) for key in horizontal_keys}
+        if counts is not None:
+            counts['placement'] = len(indexes)
+        return indexes
+
+    index_cache = get_index_cache()
+    indexes = {}
+    empty_keys = 0
+    missing_keys = OrderedDict()
+    for horizontal_key in horizontal_keys:
+        index = index_cache.get(horizontal_group, horizontal_key, empty=not create)
+        if index == EMPTY:
+            empty_keys += 1
+        elif index is None:
+            missing_keys.setdefault(force_text(horizontal_key), []).append(horizontal_key)
+        else:
+            indexes[horizontal_key] = index
+    if counts is not None:
+        counts['local_cache'] = len(indexes) + empty_keys
+    if not missing_keys:
+        return indexes
+
+    found_indexes = {}
+    shared_index_cache = get_shared_index_cache()
+    if shared_index_cache is not None:
+        found_indexes.update(shared_index_cache.get_many(horizontal_group, missing_keys))
+        if counts is not None:
+            counts['shared_cache'] = len(found_indexes)
+
+    unresolved_keys = [key for key in missing_keys if key not in found_indexes]
+    if unresolved_keys:
+        if counts is not None:
+            counts['metadata'] = len(unresolved_keys)
+        if create:
+            resolved_indexes = _get_or_create_metadata_indexes(horizontal_group, unresolved_keys)
+        else:
+            resolved_indexes = _get_metadata_indexes(horizontal_group, unresolved_keys)
+        if shared_index_cache is not None and resolved_indexes:
+            shared_index_cache.set_many(horizontal_group, resolved_indexes)
+        found_indexes.update(resolved_indexes)
+
+    for key, horizontal_keys_for_key in missing_keys.items():
+        if key not in found_indexes:
+            index_cache.set_empty(
+                horizontal_group, key, get_config()['EMPTY_INDEX_CACHE_TIMEOUT'])
+            continue
+        index_cache.set(horizontal_group, key, found_indexes[key])
+        for horizontal_key in horizontal_keys_for_key:
+            indexes[horizontal_key] = found_indexes[key]
+    return indexes
+
+
+def prime(instances):
+    """Resolve database indexes of horizontal model instances in a batch per group.
+
+    Use before saving many instances so that each of them does not look up its
+    metadata one by one. Waits while keys of the instances are frozen by a move, and
+    resolves the indexes of these keys again.
+    """
+    instances_by_group = OrderedDict()
+    for instance in instances:
+        horizontal_group = get_group_from_model(instance)
+        instances_by_group.setdefault(horizontal_group, []).append(instance)
+
+    for horizontal_group, group_instances in instances_by_group.items():
+        moved_keys = wait_until_unfrozen(
+            horizontal_group, {instance._horizontal_key for instance in group_instances})
+        unresolved = []
+        for instance in group_instances:
+            if instance._horizontal_key in moved_keys:
+                instance.__dict__.pop('_horizontal_database_index', None)
+            if '_horizontal_database_index' not in instance.__dict__:
+                unresolved.append(instance)
+        if not unresolved:
+            continue
+
+        indexes = get_or_create_indexes(
+            unresolved[0],
+            [instance._horizontal_key for instance in unresolved],
+        )
+        for instance in unresolved:
+            instance._horizontal_database_index = indexes[instance._horizontal_key]
+
+
+def _pick_index(horizontal_group, horizontal_key):
+    return get_placement_from_group(horizontal_group).pick(horizontal_key)
+
+
+def _get_or_create_metadata_index(horizontal_group, horizontal_key):
+    """Return the index of the key from the metadata store, assigned if it has none.
+
+    Concurrent calls for the same key in this process wait for the first one.
+    """
+    key = force_text(horizontal_key)
+    return _allocations.do(
+        (horizontal_group, key),
+        lambda: _get_or_create_metadata_indexes(horizontal_group, [key])[key],
+    )
+
+
+def _get_metadata_indexes(horizontal_group, keys, fallback=True):
+    """Return a dict of the text keys with metadata to their index.
+
+    Looks up a ``METADATA_READ`` replica if any, then keys missing from it, e.g. assigned
+    after the replica's last update, on the primary unless ``fallback`` is false.
+    """
+    metadata_model = get_metadata_model()
+    keys = [force_text(key) for key in keys]
+    queryset = metadata_model.objects.filter(group=horizontal_group)
+    read_database = get_metadata_read_database()
+    if read_database is None:
+        return dict(queryset.filter(key__in=keys).values_list('key', 'index'))
+
+    indexes = dict(
+        queryset.using(read_database).filter(key__in=keys).values_list('key', 'index'))
+    missing_keys = [key for key in keys if key not in indexes]
+    if fallback and missing_keys:
+        indexes.update(
+            queryset.using(router.db_for_write(metadata_model))
+            .filter(key__in=missing_keys)
+            .values_list('key', 'index')
+        )
+    return indexes
+
+
+def _get_or_create_metadata_indexes(horizontal_group, keys):
+    keys = [force_text(key) for key in keys]
+    if get_metadata_read_database() is None and _inserts_returning_existing():
+        indexes = {}  # The insert returns the indexes of keys with metadata too
+    else:
+        indexes = _get_metadata_indexes(horizontal_group, keys)
+    new_indexes = OrderedDict(
+        (key, _pick_index(horizontal_group, key)) for key in keys if key not in indexes
+    )
+    if not new_indexes:
+        return indexes
+
+    assigned_indexes, created_keys = _insert_metadata_indexes(horizontal_group, new_indexes)
+    if created_keys is None:
+        logger.info(
+            "Assign new indexes to '%s' unless assigned concurrently: %d keys",
+            horizontal_group, len(new_indexes))
+    else:
+        for key in created_keys:
+            logger.info("Assign new index to '%s': %s", horizontal_group, new_indexes[key])
+        if created_keys and get_metric_sinks():
+            emit('index_created', group=horizontal_group, count=len(created_keys))
+    indexes.update(assigned_indexes)
+    return indexes
+
+
+def _get_metadata_connection():
+    metadata_model = get_metadata_model()
+    return metadata_model, router.db_for_write(metadata_model)
+
+
+def _inserts_returning_existing():
+    metadata_model, database = _get_metadata_connection()
+    return (
+        connections[database].vendor == 'postgresql'
+        and _is_plain_metadata_model(metadata_model)
+    )
+
+
+def _inserts_returning(connection, metadata_model):
+    if not _is_plain_metadata_model(metadata_model):
+        return False
+    if connection.vendor == 'postgresql':
+        return True
+    return connection.vendor == 'sqlite' and connection.Database.sqlite_version_info >= (3, 35)
+
+
+def _insert_metadata_indexes(horizontal_group, new_indexes):
+    """Insert metadata of keys which have none, unless assigned concurrently.
+
+    Returns a dict of the keys to their index, whoever assigned it, and the list of the keys
+    assigned by this call, or ``None`` if the backend cannot tell. Conflicting inserts are
+    skipped rather than rolled back, with a single query on PostgreSQL.
+    """
+    metadata_model, database = _get_metadata_connection()
+    connection = connections[database]
+    if _inserts_returning(connection, metadata_model):
+        rows = _insert_metadata_indexes_returning(
+            connection, metadata_model, horizontal_group, new_indexes)
+        indexes = {key: index for key, index, created in rows}
+        created_keys = [key for key, index, created in rows if created]
+    elif getattr(connection.features, 'supports_ignore_conflicts', False):  # Django 2.2+
+        metadata_model.objects.using(database).bulk_create([
+            metadata_model(group=horizontal_group, key=key, index=index)
+            for key, index in new_indexes.items()
+        ], ignore_conflicts=True)
+        indexes, created_keys = {}, None  # Inserted rows are not reported
+    else:
+        try:
+            with transaction.atomic(using=database):
+                metadata_model.objects.using(database).bulk_create([
+                    metadata_model(group=horizontal_group, key=key, index=index)
+                    for key, index in new_indexes.items()
+                ])
+        except IntegrityError:
+            # Some keys were assigned concurrently, fall back to one by one
+            indexes, created_keys = {}, []
+            for key, index in new_indexes.items():
+                metadata, created = metadata_model.objects.using(database).get_or_create(
+                    group=horizontal_group, key=key, defaults={'index': index})
+                indexes[key] = metadata.index
+                if created:
+                    created_keys.append(key)
+            return indexes, created_keys
+        return dict(new_indexes), list(new_indexes)
+
+    missing_keys = [key for key in new_indexes if key not in indexes]
+    if missing_keys:  # Skipped by the insert, or not returned
+        indexes.update(
+            metadata_model.objects.using(database)
+            .filter(group=horizontal_group, key__in=missing_keys)
+            .values_list('key', 'index')
+        )
+    return indexes, created_keys
+
+
+def _is_plain_metadata_model(metadata_model):
+    opts = metadata_model._meta
+    return opts.pk.auto_created and {
+        field.attname for field in opts.concrete_fields
+    } == {opts.pk.attname, 'group', 'key', 'index'}
+
+
+def _insert_metadata_indexes_returning(connection, metadata_model, horizontal_group, new_indexes):
+    """Return ``(key, index, created)`` rows of the keys, inserting those without metadata.
+
+    Only inserted rows are returned on SQLite. On PostgreSQL, rows already present are
+    returned as well, but keys assigned by a transaction committed during the query may be
+    missing.
+    """
+    opts = metadata_model._meta
+    quote_name = connection.ops.quote_name
+    names = {
+        'table': quote_name(opts.db_table),
+        'group': quote_name(opts.get_field('group').column),
+        'key': quote_name(opts.get_field('key').column),
+        'index': quote_name(opts.get_field('index').column),
+        'values': ', '.join(['(%s, %s, %s)'] * len(new_indexes)),
+        'keys': ', '.join(['%s'] * len(new_indexes)),
+    }
+    insert_sql = (
+        'INSERT INTO {table} ({group}, {key}, {index}) VALUES {values} '
+        'ON CONFLICT ({group}, {key}) DO NOTHING RETURNING {key}, {index}'
+    ).format(**names)
+    params = []
+    for key, index in new_indexes.items():
+        params.extend([horizontal_group, key, index])
+
+    if connection.vendor != 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(insert_sql, params)
+            return [(key, index, True) for key, index in cursor.fetchall()]
+
+    sql = (
+        'WITH new AS ({insert}) '
+        'SELECT {key}, {index}, true FROM new '
+        'UNION ALL '
+        'SELECT {key}, {index}, false FROM {table} WHERE {group} = %s AND {key} IN ({keys})'
+    ).format(insert=insert_sql, **names)
+    params.append(horizontal_group)
+    params.extend(new_indexes)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+@receiver(setting_changed)
+def reload_config(setting, **kwargs):
+    if setting == 'HORIZONTAL_CONFIG':
+        get_config.cache_clear()
+        if get_executor.cache_info().currsize:
+            get_executor().shutdown(wait=False)
+        get_executor.cache_clear()
+        get_index_cache.cache_clear()
+        get_shared_index_cache.cache_clear()
+        get_placement_from_group.cache_clear()
+        get_replica_selector_from_group.cache_clear()
+        get_metric_sinks.cache_clear()
+        _get_metadata_read_weights.cache_clear()
+        reset_routings()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import sys
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", 'benchmarks.settings')
+
+
+def print_results(data, baseline=None):
+    baseline_results = baseline['results'] if baseline else {}
+    for name, result in data['results'].items():
+        line = '%-32s %10.1f us/op' % (name, result['microseconds_per_operation'])
+        if result['queries_per_operation'] is not None:
+            line += ' %6.2f queries/op' % result['queries_per_operation']
+        if name in baseline_results:
+            line += ' %+7.1f%%' % (
+                100.0 * result['microseconds_per_operation']
+                / baseline_results[name]['microseconds_per_operation'] - 100)
+        print(line)
+
+
+def runbenchmarks():
+    parser = argparse.ArgumentParser(description='Run benchmarks of django-horizon.')
+    parser.add_argument('names', nargs='*', help='Benchmarks to run, all by default.')
+    parser.add_argument('--number', type=int, default=1000, help='Operations per benchmark.')
+    parser.add_argument('--output', help='Write the results to a JSON file.')
+    parser.add_argument('--compare', help='JSON file of earlier results to compare with.')
+    args = parser.parse_args()
+
+    import django
+    from django.conf import settings
+    from django.test.utils import get_runner
+
+    if hasattr(django, 'setup'):
+        django.setup()
+
+    from benchmarks.suite import BENCHMARKS, run_benchmarks
+
+    unknown_names = [name for name in args.names if name not in BENCHMARKS]
+    if unknown_names:
+        parser.error('unknown benchmarks: %s' % ', '.join(unknown_names))
+
+    test_runner = get_runner(settings)(verbosity=0, interactive=False)
+    old_config = test_runner.setup_databases()
+    try:
+        data = run_benchmarks(args.names, number=args.number)
+    finally:
+        test_runner.teardown_databases(old_config)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(data, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(data, f, indent=2)
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    runbenchmarks()
@@ -12,6 +12,7 @@ with open('HISTORY.rst') as history_file:
 
 requirements = [
     'Django>=1.11',
+    'futures; python_version < "3"',
 ]
 
 test_requirements = [
@@ -28,7 +29,7 @@ setup(
     author=horizon.__author__,
     author_email=horizon.__email__,
     url='https://github.com/uncovertruth/django-horizon',
-    packages=find_packages(exclude=('tests', 'docs')),
+    packages=find_packages(exclude=('tests', 'benchmarks', 'docs')),
     include_package_data=True,
     install_requires=requirements,
     license="MIT license",
@@ -1,7 +1,13 @@
 from django.test import TransactionTestCase
 
+from horizon.utils import clear_index_cache
+
 
 class HorizontalBaseTestCase(TransactionTestCase):
     """Base test case for horizonta."""
 
     multi_db = True
+
+    def setUp(self):
+        super(HorizontalBaseTestCase, self).setUp()
+        clear_index_cache()
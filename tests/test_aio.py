@@ -0,0 +1,165 @@
+import sys
+from unittest import skipUnless
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.db.models import Count, Max
+from django.db.utils import ProgrammingError
+
+from horizon.pinning import get_pins, pin_writes
+from horizon.utils import get_index_cache
+
+from .base import HorizontalBaseTestCase
+from .models import HorizontalMetadata, OneModel
+
+if sys.version_info >= (3, 6):
+    import asyncio
+
+    from horizon import aio
+else:
+    aio = None
+
+user_model = get_user_model()
+
+
+@skipUnless(aio, "Requires Python 3.6 or later")
+class AsyncTestCase(HorizontalBaseTestCase):
+    def setUp(self):
+        super(AsyncTestCase, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.user_a = user_model.objects.create_user('spam')
+        self.user_b = user_model.objects.create_user('egg')
+        HorizontalMetadata.objects.create(group='a', key=self.user_a.id, index=1)
+        HorizontalMetadata.objects.create(group='a', key=self.user_b.id, index=2)
+        OneModel.objects.create(user=self.user_a, spam='1')
+        OneModel.objects.create(user=self.user_b, spam='2')
+        OneModel.objects.create(user=self.user_b, spam='3')
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        super(AsyncTestCase, self).tearDown()
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def collect(self, aiterator):
+        rows = []
+        while True:
+            try:
+                rows.append(self.run_async(aiterator.__anext__()))
+            except StopAsyncIteration:
+                return rows
+
+    @property
+    def queryset(self):
+        return aio.AsyncQuerySet(OneModel)
+
+    def test_aget_or_create_index(self):
+        get_index_cache().clear()
+        self.assertEqual(1, self.run_async(aio.aget_or_create_index(OneModel, self.user_a.id)))
+        with patch.object(aio, 'run_in_executor') as run_in_executor:
+            self.assertEqual(
+                1, self.run_async(aio.aget_or_create_index(OneModel, self.user_a.id)))
+        run_in_executor.assert_not_called()
+
+    def test_aget_or_create_index_counts_once(self):
+        get_index_cache().clear()
+        self.run_async(aio.aget_or_create_index(OneModel, self.user_a.id))
+        self.assertEqual((0, 1), get_index_cache().info()[:2])
+        self.run_async(aio.aget_or_create_index(OneModel, self.user_a.id))
+        self.assertEqual((1, 1), get_index_cache().info()[:2])
+
+    def test_aget_or_create_indexes(self):
+        get_index_cache().clear()
+        self.assertEqual(
+            {self.user_a.id: 1, self.user_b.id: 2},
+            self.run_async(aio.aget_or_create_indexes(OneModel, [self.user_a.id, self.user_b.id])),
+        )
+
+    def test_aget(self):
+        obj = self.run_async(self.queryset.aget(user=self.user_a))
+        self.assertEqual('1', obj.spam)
+        self.assertIn(obj._state.db, ('a1-replica-1', 'a1-replica-2'))
+
+    def test_acreate(self):
+        obj = self.run_async(self.queryset.acreate(user=self.user_a, spam='4'))
+        self.assertEqual('a1-primary', obj._state.db)
+        self.assertEqual(2, OneModel.objects.filter(user=self.user_a).count())
+
+    def test_aget_or_create(self):
+        obj, created = self.run_async(self.queryset.aget_or_create(user=self.user_b, spam='5'))
+        self.assertTrue(created)
+        self.assertEqual('a2-primary', obj._state.db)
+
+    def test_aiterate(self):
+        rows = self.collect(self.queryset.filter(user=self.user_b).order_by('spam').aiterate())
+        self.assertEqual(['2', '3'], [row.spam for row in rows])
+
+    def test_aiterate_across_shards(self):
+        queryset = self.queryset.filter(
+            user__in=[self.user_a, self.user_b]).order_by('-spam').values_list('spam', flat=True)
+        self.assertEqual(['3', '2', '1'], self.collect(queryset.aiterate()))
+        self.assertEqual(['3', '2', '1'], list(queryset), "Result cache")
+
+    def test_acount(self):
+        self.assertEqual(3, self.run_async(self.queryset.all_shards().acount()))
+        self.assertEqual(2, self.run_async(self.queryset.all_shards()[1:].acount()))
+        self.assertEqual(1, self.run_async(self.queryset.filter(user=self.user_a).acount()))
+
+    def test_aexists(self):
+        self.assertTrue(self.run_async(self.queryset.all_shards().aexists()))
+        self.assertFalse(
+            self.run_async(self.queryset.all_shards().filter(spam='4').aexists()))
+
+    def test_aaggregate(self):
+        self.assertEqual(
+            {'count': 3, 'max': '3'},
+            self.run_async(
+                self.queryset.all_shards().aaggregate(count=Count('id'), max=Max('spam'))),
+        )
+
+    def test_aupdate(self):
+        self.assertEqual(
+            3, self.run_async(self.queryset.filter(
+                user__in=[self.user_a, self.user_b]).aupdate(egg='egg')))
+        self.assertEqual(3, OneModel.objects.all_shards().filter(egg='egg').count())
+
+    @skipUnless(sys.version_info >= (3, 7), "Requires contextvars")
+    def test_pins_of_concurrent_tasks(self):
+        seen_pins = {}
+
+        async def pinned():
+            with pin_writes() as pins:
+                seen_pins['pinned'] = pins
+                await asyncio.sleep(0.05)
+                await self.queryset.acreate(user=self.user_a, spam='4')
+                self.assertIs(pins, get_pins())
+            return await self.queryset.filter(user=self.user_a).acount()
+
+        async def unpinned():
+            await asyncio.sleep(0.01)
+            seen_pins['unpinned'] = get_pins()
+            return await aio.run_in_executor(get_pins)
+
+        async def main():
+            return await asyncio.gather(pinned(), unpinned())
+
+        count, worker_pins = self.run_async(main())
+        self.assertEqual(2, count)
+        self.assertEqual(1, len(seen_pins['pinned']))
+        self.assertIsNone(seen_pins['unpinned'])
+        self.assertIsNone(worker_pins)
+        self.assertIsNone(get_pins())
+
+    def test_missing_horizontal_key(self):
+        with self.assertRaises(ProgrammingError):
+            self.run_async(self.queryset.acount())
+
+    def test_manager(self):
+        manager = aio.AsyncHorizontalManager()
+        manager.model = OneModel
+        self.assertEqual(1, self.run_async(manager.filter(user=self.user_a).acount()))
+        self.assertTrue(hasattr(manager, 'aget'))
+        self.assertFalse(hasattr(manager, 'adelete'))
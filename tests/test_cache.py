@@ -0,0 +1,145 @@
+import threading
+import time
+from unittest.mock import patch
+
+from django.test import SimpleTestCase
+
+from horizon.cache import EMPTY, CacheInfo, IndexCache, SingleFlight
+
+
+class IndexCacheTestCase(SimpleTestCase):
+    def test_get_and_set(self):
+        cache = IndexCache()
+        self.assertIsNone(cache.get('a', 1))
+        cache.set('a', 1, 2)
+        self.assertEqual(2, cache.get('a', 1))
+        self.assertEqual(2, cache.get('a', '1'), "Keys are normalized to text")
+        self.assertIsNone(cache.get('b', 1), "Other group")
+
+    def test_evict_least_recently_used(self):
+        cache = IndexCache(max_size=2)
+        cache.set('a', 1, 1)
+        cache.set('a', 2, 2)
+        cache.get('a', 1)
+        cache.set('a', 3, 3)
+        self.assertEqual(2, len(cache))
+        self.assertEqual(1, cache.get('a', 1))
+        self.assertIsNone(cache.get('a', 2))
+        self.assertEqual(3, cache.get('a', 3))
+
+    def test_disabled(self):
+        cache = IndexCache(max_size=0)
+        cache.set('a', 1, 1)
+        self.assertIsNone(cache.get('a', 1))
+
+    def test_timeout(self):
+        cache = IndexCache(timeout=10)
+        with patch('horizon.cache.monotonic', return_value=100):
+            cache.set('a', 1, 1)
+        with patch('horizon.cache.monotonic', return_value=109):
+            self.assertEqual(1, cache.get('a', 1))
+        with patch('horizon.cache.monotonic', return_value=110):
+            self.assertIsNone(cache.get('a', 1))
+
+    def test_set_empty(self):
+        cache = IndexCache(timeout=60)
+        with patch('horizon.cache.monotonic', return_value=100):
+            cache.set_empty('a', 1, timeout=5)
+        with patch('horizon.cache.monotonic', return_value=104):
+            self.assertIsNone(cache.get('a', 1), "Missing for writes")
+            self.assertEqual(EMPTY, cache.get('a', 1, empty=True))
+        with patch('horizon.cache.monotonic', return_value=105):
+            self.assertIsNone(cache.get('a', 1, empty=True))
+
+        cache.set_empty('a', 1)
+        cache.set('a', 1, 2)
+        self.assertEqual(2, cache.get('a', 1, empty=True))
+
+    def test_peek(self):
+        cache = IndexCache(max_size=3)
+        cache.set('a', 1, 1)
+        cache.set('a', 2, 2)
+        cache.set_empty('a', 3)
+        self.assertEqual(1, cache.peek('a', 1))
+        self.assertIsNone(cache.peek('a', 3))
+        self.assertEqual(EMPTY, cache.peek('a', 3, empty=True))
+        self.assertEqual((0, 0), cache.info()[:2], "Not counted")
+
+        cache.set('a', 4, 4)
+        self.assertIsNone(cache.peek('a', 1), "Not marked as used")
+        self.assertEqual(2, cache.peek('a', 2))
+
+    def test_delete(self):
+        cache = IndexCache()
+        cache.set('a', 1, 1)
+        cache.delete('a', 1)
+        cache.delete('a', 2)
+        self.assertIsNone(cache.get('a', 1))
+
+    def test_info(self):
+        cache = IndexCache(max_size=10)
+        cache.set('a', 1, 1)
+        cache.get('a', 1)
+        cache.get('a', 2)
+        self.assertEqual(CacheInfo(hits=1, misses=1, max_size=10, size=1), cache.info())
+
+        cache.clear()
+        self.assertEqual(CacheInfo(hits=0, misses=0, max_size=10, size=0), cache.info())
+
+
+class SingleFlightTestCase(SimpleTestCase):
+    def test_do(self):
+        single_flight = SingleFlight()
+        self.assertEqual(1, single_flight.do('a', lambda: 1))
+        self.assertEqual(2, single_flight.do('a', lambda: 2), "Not cached")
+        self.assertEqual(0, len(single_flight))
+
+    def test_concurrent_calls(self):
+        single_flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def func():
+            calls.append(None)
+            release.wait()
+            return len(calls)
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(single_flight.do('a', func)))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, len(calls))
+        self.assertEqual([1] * 5, results)
+        self.assertEqual(0, len(single_flight))
+
+    def test_error(self):
+        single_flight = SingleFlight()
+        release = threading.Event()
+        errors = []
+
+        def func():
+            release.wait()
+            raise ValueError
+
+        def call():
+            try:
+                single_flight.do('a', func)
+            except ValueError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(2, len(errors))
+        self.assertEqual(0, len(single_flight))
@@ -0,0 +1,117 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, override_settings
+
+from horizon.metrics import (
+    Counters,
+    counters,
+    get_metric_sinks,
+    metric_recorded,
+    send_signal,
+)
+from horizon.utils import get_or_create_index, get_or_create_indexes
+
+from .base import HorizontalBaseTestCase
+from .models import HorizontalMetadata, OneModel
+
+user_model = get_user_model()
+
+events = []
+
+
+def record(event, **data):
+    events.append((event, data))
+
+
+METRICS_CONFIG = dict(
+    settings.HORIZONTAL_CONFIG,
+    METRICS_SINKS=['tests.test_metrics.record', 'horizon.metrics.counters'],
+)
+
+
+class MetricSinksTestCase(SimpleTestCase):
+    def test_no_sinks(self):
+        self.assertEqual((), get_metric_sinks())
+
+    @override_settings(HORIZONTAL_CONFIG=METRICS_CONFIG)
+    def test_sinks(self):
+        self.assertEqual((record, counters), get_metric_sinks())
+
+    def test_send_signal(self):
+        received = []
+
+        def receiver(sender, **kwargs):
+            received.append((sender, kwargs))
+
+        metric_recorded.connect(receiver)
+        try:
+            send_signal('index_created', group='a', count=1)
+        finally:
+            metric_recorded.disconnect(receiver)
+        self.assertEqual(
+            [('index_created', {'signal': metric_recorded, 'event': 'index_created',
+                                'group': 'a', 'count': 1})],
+            received,
+        )
+
+    def test_counters(self):
+        sink = Counters()
+        sink('route', model=OneModel, operation='read', index=1, database='a1-replica')
+        sink('route', model=OneModel, operation='read', index=1, database='a1-replica')
+        sink('index', group='a', counts={'local_cache': 2, 'metadata': 1}, duration=0.5)
+        sink('index_created', group='a', count=1)
+        snapshot = sink.snapshot()
+        self.assertEqual({('tests.OneModel', 'read'): 2}, snapshot['routes'])
+        self.assertEqual({('a1-replica', 'read'): 2}, snapshot['databases'])
+        self.assertEqual({('a', 'local_cache'): 2, ('a', 'metadata'): 1}, snapshot['indexes'])
+        self.assertEqual({'a': 1}, snapshot['created'])
+        self.assertEqual({'a': 0.5}, snapshot['durations'])
+
+        sink.reset()
+        self.assertEqual({}, sink.snapshot()['routes'])
+
+
+@override_settings(HORIZONTAL_CONFIG=METRICS_CONFIG)
+class MetricsTestCase(HorizontalBaseTestCase):
+    def setUp(self):
+        super(MetricsTestCase, self).setUp()
+        self.user = user_model.objects.create_user('spam')
+        del events[:]
+        counters.reset()
+
+    def test_index_sources(self):
+        get_or_create_index(OneModel, self.user.id)
+        get_or_create_index(OneModel, self.user.id)
+        self.assertEqual(
+            [('index_created', 1), ('index', {'metadata': 1}), ('index', {'local_cache': 1})],
+            [(event, data.get('count', data.get('counts'))) for event, data in events],
+        )
+        self.assertEqual('a', events[1][1]['group'])
+        self.assertGreaterEqual(events[1][1]['duration'], 0)
+
+    def test_indexes_sources(self):
+        other_user = user_model.objects.create_user('egg')
+        HorizontalMetadata.objects.create(group='a', key=other_user.id, index=2)
+        get_or_create_index(OneModel, other_user.id)
+        del events[:]
+
+        get_or_create_indexes(OneModel, [self.user.id, other_user.id])
+        self.assertEqual(
+            [('index_created', {'group': 'a', 'count': 1})],
+            [(event, data) for event, data in events if event == 'index_created'],
+        )
+        self.assertEqual({'local_cache': 1, 'metadata': 1}, events[-1][1]['counts'])
+
+    def test_routes(self):
+        HorizontalMetadata.objects.create(group='a', key=self.user.id, index=1)
+        OneModel.objects.create(user=self.user, spam='1')
+        list(OneModel.objects.filter(user=self.user))
+
+        snapshot = counters.snapshot()
+        self.assertEqual(1, snapshot['routes'][('tests.OneModel', 'write')])
+        self.assertEqual(1, snapshot['routes'][('tests.OneModel', 'read')])
+        self.assertEqual(1, snapshot['databases'][('a1-primary', 'write')])
+        self.assertEqual(1, sum(
+            count for (database, operation), count in snapshot['databases'].items()
+            if operation == 'read' and database.startswith('a1-')
+        ))
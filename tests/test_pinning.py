@@ -0,0 +1,136 @@
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from horizon.pinning import (
+    ReadYourWritesMiddleware,
+    WritePins,
+    get_pins,
+    pin_writes,
+)
+from horizon.routers import HorizontalRouter
+from horizon.utils import run_in_parallel
+
+from .base import HorizontalBaseTestCase
+from .models import HorizontalMetadata, ManyModel, OneModel
+
+user_model = get_user_model()
+
+
+class WritePinsTestCase(SimpleTestCase):
+    def test_pin_shard(self):
+        pins = WritePins(timeout=5)
+        pins.pin('a', 1, 'spam')
+        self.assertTrue(pins.is_pinned('a', 1, 'spam'))
+        self.assertTrue(pins.is_pinned('a', 1, 'egg'))
+        self.assertTrue(pins.is_pinned('a', 1))
+        self.assertFalse(pins.is_pinned('a', 2, 'spam'))
+        self.assertFalse(pins.is_pinned('b', 1, 'spam'))
+
+    def test_pin_key(self):
+        pins = WritePins(timeout=5, by_key=True)
+        pins.pin('a', 1, 1)
+        self.assertTrue(pins.is_pinned('a', 1, '1'))
+        self.assertFalse(pins.is_pinned('a', 1, 2))
+        self.assertTrue(pins.is_pinned('a', 1), "Reads without key")
+
+        pins.pin('a', 2)
+        self.assertTrue(pins.is_pinned('a', 2, 2), "Writes without key")
+
+    def test_timeout(self):
+        pins = WritePins(timeout=5)
+        with patch('horizon.pinning.monotonic', return_value=100):
+            pins.pin('a', 1)
+        with patch('horizon.pinning.monotonic', return_value=104.9):
+            self.assertTrue(pins.is_pinned('a', 1))
+        with patch('horizon.pinning.monotonic', return_value=105):
+            self.assertFalse(pins.is_pinned('a', 1))
+
+        pins = WritePins(timeout=None)
+        pins.pin('a', 1)
+        with patch('horizon.pinning.monotonic', return_value=10 ** 9):
+            self.assertTrue(pins.is_pinned('a', 1))
+
+    def test_pin_writes(self):
+        self.assertIsNone(get_pins())
+        with pin_writes() as pins:
+            self.assertIs(pins, get_pins())
+            self.assertEqual(5, pins.timeout)
+            self.assertFalse(pins.by_key)
+            with pin_writes(timeout=1) as nested_pins:
+                self.assertIs(pins, nested_pins)
+        self.assertIsNone(get_pins())
+
+    @override_settings(HORIZONTAL_CONFIG={'PIN_TIMEOUT': None, 'PIN_BY': 'key'})
+    def test_pin_writes_from_settings(self):
+        with pin_writes() as pins:
+            self.assertIsNone(pins.timeout)
+            self.assertTrue(pins.by_key)
+
+    def test_middleware(self):
+        def get_response(request):
+            self.assertIsNotNone(get_pins())
+            return HttpResponse()
+
+        middleware = ReadYourWritesMiddleware(get_response)
+        middleware(RequestFactory().get('/'))
+        self.assertIsNone(get_pins())
+
+
+class ReadYourWritesTestCase(HorizontalBaseTestCase):
+    def setUp(self):
+        super(ReadYourWritesTestCase, self).setUp()
+        self.router = HorizontalRouter()
+        self.user_a = user_model.objects.create_user('spam')
+        self.user_b = user_model.objects.create_user('egg')
+        self.user_c = user_model.objects.create_user('musubi')
+        HorizontalMetadata.objects.create(group='a', key=self.user_a.id, index=1)
+        HorizontalMetadata.objects.create(group='a', key=self.user_b.id, index=2)
+        HorizontalMetadata.objects.create(group='a', key=self.user_c.id, index=2)
+
+    def test_db_for_read(self):
+        with pin_writes():
+            self.assertIn(
+                self.router.db_for_read(OneModel, horizontal_key=self.user_b.id),
+                ['a2-replica'],
+            )
+            OneModel.objects.create(user=self.user_b, spam='1st')
+            self.assertEqual(
+                'a2-primary', self.router.db_for_read(OneModel, horizontal_key=self.user_b.id))
+            self.assertEqual(
+                'a2-primary', self.router.db_for_read(ManyModel, horizontal_key=self.user_c.id))
+            self.assertIn(
+                self.router.db_for_read(OneModel, horizontal_key=self.user_a.id),
+                ['a1-replica-1', 'a1-replica-2'],
+            )
+            self.assertEqual('a2-primary', OneModel.objects.filter(user=self.user_b).db)
+        self.assertEqual(
+            'a2-replica', self.router.db_for_read(OneModel, horizontal_key=self.user_b.id))
+
+    def test_db_for_read_by_key(self):
+        with pin_writes(by_key=True):
+            OneModel.objects.create(user=self.user_b, spam='1st')
+            self.assertEqual(
+                'a2-primary', self.router.db_for_read(OneModel, horizontal_key=self.user_b.id))
+            self.assertEqual(
+                'a2-replica', self.router.db_for_read(OneModel, horizontal_key=self.user_c.id))
+
+    def test_read_many_keys(self):
+        with pin_writes(by_key=True):
+            OneModel.objects.filter(user=self.user_b).update(spam='2nd')
+            querysets = OneModel.objects.filter(
+                user__in=[self.user_a, self.user_b, self.user_c])._get_shard_querysets()
+            self.assertEqual(['a1-replica-1', 'a2-primary'], sorted(
+                queryset.db.replace('a1-replica-2', 'a1-replica-1') for queryset in querysets))
+
+            querysets = OneModel.objects.filter(
+                user__in=[self.user_a, self.user_c])._get_shard_querysets()
+            self.assertEqual(['a1-replica-1', 'a2-replica'], sorted(
+                queryset.db.replace('a1-replica-2', 'a1-replica-1') for queryset in querysets))
+
+    def test_run_in_parallel(self):
+        with pin_writes() as pins:
+            self.assertEqual([pins, pins], run_in_parallel(lambda item: get_pins(), [1, 2]))
+        self.assertEqual([None, None], run_in_parallel(lambda item: get_pins(), [1, 2]))
@@ -0,0 +1,156 @@
+from collections import Counter
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from horizon.placement import (
+    BasePlacement,
+    ConsistentHashPlacement,
+    LeastPopulatedPlacement,
+    RandomPlacement,
+    get_cumulative_weights,
+    get_weights,
+)
+from horizon.utils import (
+    get_or_create_index,
+    get_or_create_indexes,
+    get_placement_from_group,
+)
+
+from .base import HorizontalBaseTestCase
+from .models import HorizontalMetadata, ManyModel, OneModel
+
+user_model = get_user_model()
+
+CONSISTENT_HASH_CONFIG = dict(
+    settings.HORIZONTAL_CONFIG,
+    GROUPS=dict(
+        settings.HORIZONTAL_CONFIG['GROUPS'],
+        a=dict(
+            settings.HORIZONTAL_CONFIG['GROUPS']['a'],
+            PLACEMENT='horizon.placement.ConsistentHashPlacement',
+            PLACEMENT_OPTIONS={'vnodes': 50},
+        ),
+    ),
+)
+
+
+class PlacementTestCase(SimpleTestCase):
+    def test_get_weights(self):
+        self.assertEqual([(2, 1), (3, 1)], list(get_weights([2, 3]).items()))
+        self.assertEqual([(1, 2), (2, 3)], list(get_weights({2: 3, 1: 2, 3: 0}).items()))
+
+    def test_get_cumulative_weights(self):
+        self.assertEqual(([1, 2], [2, 5]), get_cumulative_weights(get_weights({2: 3, 1: 2})))
+        self.assertEqual(([], []), get_cumulative_weights(get_weights([])))
+
+    def test_base_placement(self):
+        with self.assertRaises(NotImplementedError):
+            BasePlacement('a', {'PICKABLES': [1]}).pick(1)
+
+    def test_random_placement(self):
+        placement = RandomPlacement('a', {'PICKABLES': [2, 3]})
+        self.assertTrue(placement.uses_metadata)
+        self.assertEqual({2, 3}, {placement.pick(key) for key in range(100)})
+
+    def test_weighted_random_placement(self):
+        placement = RandomPlacement('a', {'PICKABLES': {1: 0, 2: 3, 3: 1}})
+        counts = Counter(placement.pick(key) for key in range(4000))
+        self.assertEqual({2, 3}, set(counts))
+        self.assertGreater(counts[2], counts[3] * 2)
+
+    def test_consistent_hash_placement(self):
+        placement = ConsistentHashPlacement('a', {'PICKABLES': [1, 2, 3]})
+        self.assertFalse(placement.uses_metadata)
+        self.assertEqual(placement.pick(1), placement.pick('1'), "Keys are normalized to text")
+        other_placement = ConsistentHashPlacement('a', {'PICKABLES': [1, 2, 3]})
+        self.assertEqual(
+            [placement.pick(key) for key in range(100)],
+            [other_placement.pick(key) for key in range(100)],
+        )
+
+        counts = Counter(placement.pick(key) for key in range(3000))
+        self.assertEqual({1, 2, 3}, set(counts))
+        for count in counts.values():
+            self.assertGreater(count, 600)
+
+    def test_weighted_consistent_hash_placement(self):
+        placement = ConsistentHashPlacement('a', {'PICKABLES': {2: 3, 3: 1}})
+        counts = Counter(placement.pick(key) for key in range(4000))
+        self.assertGreater(counts[2], counts[3] * 2)
+
+    def test_consistent_hash_placement_when_index_added(self):
+        placement = ConsistentHashPlacement('a', {'PICKABLES': [1, 2, 3]})
+        added_placement = ConsistentHashPlacement('a', {'PICKABLES': [1, 2, 3, 4]})
+        moved = [
+            key for key in range(1000) if placement.pick(key) != added_placement.pick(key)
+        ]
+        self.assertTrue(all(added_placement.pick(key) == 4 for key in moved))
+        self.assertLess(len(moved), 400)
+
+
+@override_settings(HORIZONTAL_CONFIG=CONSISTENT_HASH_CONFIG)
+class ConsistentHashPlacementTestCase(HorizontalBaseTestCase):
+    def setUp(self):
+        super(ConsistentHashPlacementTestCase, self).setUp()
+        self.users = [user_model.objects.create_user(name) for name in ('spam', 'egg', 'ham')]
+
+    def test_get_placement_from_group(self):
+        self.assertIsInstance(get_placement_from_group('a'), ConsistentHashPlacement)
+        self.assertIsInstance(get_placement_from_group('b'), RandomPlacement)
+
+    def test_get_or_create_index(self):
+        placement = get_placement_from_group('a')
+        with self.assertNumQueries(0):
+            for user in self.users:
+                self.assertEqual(placement.pick(user.id), get_or_create_index(OneModel, user.id))
+            self.assertEqual(
+                {user.id: placement.pick(user.id) for user in self.users},
+                get_or_create_indexes(ManyModel, [user.id for user in self.users]),
+            )
+        self.assertFalse(HorizontalMetadata.objects.exists())
+
+    def test_save(self):
+        placement = get_placement_from_group('a')
+        one = OneModel.objects.create(user=self.users[0], spam='1st')
+        self.assertEqual(placement.pick(self.users[0].id), one._horizontal_database_index)
+        self.assertFalse(HorizontalMetadata.objects.exists())
+        self.assertTrue(OneModel.objects.filter(user=self.users[0]).exists())
+
+
+class LeastPopulatedPlacementTestCase(TestCase):
+    def setUp(self):
+        super(LeastPopulatedPlacementTestCase, self).setUp()
+        for key in range(4):
+            HorizontalMetadata.objects.create(group='a', key=key, index=1)
+        HorizontalMetadata.objects.create(group='a', key=4, index=2)
+        HorizontalMetadata.objects.create(group='b', key=0, index=3)
+
+    def test_get_counts(self):
+        placement = LeastPopulatedPlacement('a', {'PICKABLES': [1, 2, 3]})
+        self.assertEqual({1: 4, 2: 1, 3: 0}, placement.get_counts())
+
+    def test_pick(self):
+        placement = LeastPopulatedPlacement('a', {'PICKABLES': [1, 2, 3]})
+        with self.assertNumQueries(1):
+            self.assertEqual([3, 2, 3, 2, 3], [placement.pick(key) for key in range(5, 10)])
+
+    def test_pick_by_weight(self):
+        placement = LeastPopulatedPlacement('a', {'PICKABLES': {1: 4, 2: 1}})
+        self.assertEqual([1, 2, 1], [placement.pick(key) for key in range(5, 8)])
+
+    def test_refresh_counts(self):
+        placement = LeastPopulatedPlacement('a', {'PICKABLES': [1, 2]}, timeout=0)
+        self.assertEqual(2, placement.pick(5))
+        HorizontalMetadata.objects.create(group='a', key=5, index=2)
+        HorizontalMetadata.objects.create(group='a', key=6, index=2)
+        HorizontalMetadata.objects.create(group='a', key=7, index=2)
+        with self.assertNumQueries(1):
+            self.assertEqual(1, placement.pick(8))
+
+        placement = LeastPopulatedPlacement('a', {'PICKABLES': [1, 2]})
+        placement.pick(8)
+        placement.clear()
+        with self.assertNumQueries(1):
+            placement.pick(9)
@@ -1,12 +1,24 @@
+from unittest import skipUnless
 from unittest.mock import patch
 
+import django
 from django.contrib.auth import get_user_model
-from django.db.utils import ProgrammingError
+from django.db import connections, transaction
+from django.db.models import Avg, Count, Max, Min, Prefetch, Q, StdDev, Sum
+from django.db.models.functions import Length
+from django.db.models.query import QuerySet as DjangoQuerySet
+from django.db.utils import NotSupportedError, ProgrammingError
+from django.test.utils import CaptureQueriesContext
 
-from horizon.query import QuerySet
+from horizon.query import QuerySet, prefetch_horizontal_objects
+from horizon.utils import (
+    clear_index_cache,
+    get_db_for_write_from_model_index,
+    get_executor,
+)
 
 from .base import HorizontalBaseTestCase
-from .models import OneModel
+from .models import HorizontalMetadata, ManyModel, OneModel
 
 user_model = get_user_model()
 
@@ -244,3 +256,435 @@ class QuerySetTestCase(HorizontalBaseTestCase):
         qs = OneModel.objects.filter(user=self.user)
         qs = qs.exclude(spam='1st')
         list(qs)
+
+
+class AllShardsQuerySetTestCase(HorizontalBaseTestCase):
+    def setUp(self):
+        super(AllShardsQuerySetTestCase, self).setUp()
+        self.users = []
+        for index, name in enumerate(('spam', 'egg', 'ham'), start=1):
+            user = user_model.objects.create_user(name)
+            HorizontalMetadata.objects.create(group='a', key=user.id, index=index)
+            OneModel.objects.create(user=user, spam='1st')
+            OneModel.objects.create(user=user, spam='2nd')
+            self.users.append(user)
+
+    def test_all(self):
+        ones = list(OneModel.objects.all_shards())
+        self.assertEqual(6, len(ones))
+        self.assertLessEqual(
+            {one._state.db for one in ones},
+            {'a1-replica-1', 'a1-replica-2', 'a2-replica', 'a3'},
+        )
+        self.assertSetEqual({user.id for user in self.users}, {one.user_id for one in ones})
+
+    def test_filter(self):
+        ones = OneModel.objects.all_shards().filter(spam='2nd')
+        self.assertEqual(3, len(ones))
+        self.assertEqual({'2nd'}, {one.spam for one in ones})
+
+    def test_get(self):
+        one = OneModel.objects.filter(user=self.users[1], spam='1st').get()
+        self.assertEqual(one, OneModel.objects.all_shards().get(pk=one.pk))
+
+    def test_iterator(self):
+        self.assertEqual(6, len(list(OneModel.objects.all_shards().iterator())))
+
+    def test_filter_with_horizontal_key(self):
+        ones = OneModel.objects.all_shards().filter(user=self.users[0])
+        self.assertEqual(2, len(ones))
+
+    def test_concurrently(self):
+        with patch('horizon.utils.get_executor', wraps=get_executor) as executor:
+            self.assertEqual(6, len(OneModel.objects.all_shards()))
+            self.assertEqual(3, executor.call_count)  # Once per shard
+
+    def test_in_current_thread_in_transaction(self):
+        with patch('horizon.utils.get_executor') as executor:
+            with transaction.atomic():
+                self.assertEqual(6, len(OneModel.objects.all_shards()))
+            executor.assert_not_called()
+
+    def test_not_supported_without_shard(self):
+        with self.assertRaises(ProgrammingError):
+            OneModel.objects.all_shards().update(spam='3rd')
+
+
+class AllShardsOrderingTestCase(HorizontalBaseTestCase):
+    def setUp(self):
+        super(AllShardsOrderingTestCase, self).setUp()
+        for index, spams in enumerate((('a', 'd'), ('b', 'e'), ('c', 'f')), start=1):
+            user = user_model.objects.create_user('user%d' % index)
+            HorizontalMetadata.objects.create(group='a', key=user.id, index=index)
+            for spam in spams:
+                OneModel.objects.create(user=user, spam=spam)
+
+    def test_order_by(self):
+        ones = OneModel.objects.all_shards().order_by('spam')
+        self.assertEqual(['a', 'b', 'c', 'd', 'e', 'f'], [one.spam for one in ones])
+
+        ones = OneModel.objects.all_shards().order_by('-spam')
+        self.assertEqual(['f', 'e', 'd', 'c', 'b', 'a'], [one.spam for one in ones])
+
+        ones = OneModel.objects.all_shards().order_by('spam').reverse()
+        self.assertEqual(['f', 'e', 'd', 'c', 'b', 'a'], [one.spam for one in ones])
+
+    def test_order_by_with_limits(self):
+        queryset = OneModel.objects.all_shards().order_by('spam')
+        self.assertEqual(['a', 'b', 'c', 'd'], [one.spam for one in queryset[:4]])
+        self.assertEqual(['e', 'd'], [one.spam for one in queryset.reverse()[1:3]])
+        self.assertEqual(['c', 'd', 'e', 'f'], [one.spam for one in queryset[2:]])
+        self.assertEqual('b', queryset[1].spam)
+        self.assertEqual('a', queryset.first().spam)
+        self.assertEqual('f', queryset.last().spam)
+
+    def test_push_down_limits(self):
+        with transaction.atomic(), CaptureQueriesContext(connections['a3']) as queries:
+            list(OneModel.objects.all_shards().order_by('spam')[1:3])
+        self.assertEqual(1, len(queries))
+        self.assertIn('LIMIT 3', queries[0]['sql'])
+        self.assertNotIn('OFFSET', queries[0]['sql'])
+
+    def test_iterator(self):
+        ones = OneModel.objects.all_shards().order_by('-spam')[:5].iterator()
+        self.assertEqual(['f', 'e', 'd', 'c', 'b'], [one.spam for one in ones])
+
+    def test_values(self):
+        queryset = OneModel.objects.all_shards().order_by('spam')
+        self.assertEqual(
+            [{'spam': 'a'}, {'spam': 'b'}],
+            list(queryset.values('spam')[:2]),
+        )
+        self.assertEqual(['a', 'b'], list(queryset.values_list('spam', flat=True)[:2]))
+        self.assertEqual([('b', None)], list(queryset.values_list('spam', 'egg')[1:2]))
+
+    def test_not_supported_ordering(self):
+        with self.assertRaises(NotSupportedError):
+            list(OneModel.objects.all_shards().order_by('?'))
+        with self.assertRaises(NotSupportedError):
+            list(OneModel.objects.all_shards().order_by('user__username'))
+        with self.assertRaises(NotSupportedError):
+            list(OneModel.objects.all_shards().order_by('spam').values_list('egg'))
+        with self.assertRaises(NotSupportedError):
+            list(OneModel.objects.all_shards().order_by('spam').values('egg'))
+
+
+class AllShardsAggregationTestCase(HorizontalBaseTestCase):
+    def setUp(self):
+        super(AllShardsAggregationTestCase, self).setUp()
+        for index, spams in enumerate((('x', 'xx'), ('xxx', ), ()), start=1):
+            user = user_model.objects.create_user('user%d' % index)
+            HorizontalMetadata.objects.create(group='a', key=user.id, index=index)
+            for spam in spams:
+                OneModel.objects.create(user=user, spam=spam)
+
+    def test_aggregate(self):
+        self.assertEqual(
+            {
+                'count': 3,
+                'egg__count': 0,
+                'sum': 6,
+                'avg': 2.0,
+                'spam__min': 'x',
+                'spam__max': 'xxx',
+            },
+            OneModel.objects.all_shards().aggregate(
+                Count('egg'),
+                Min('spam'),
+                Max('spam'),
+                count=Count('id'),
+                sum=Sum(Length('spam')),
+                avg=Avg(Length('spam')),
+            ),
+        )
+
+    def test_aggregate_filtered(self):
+        self.assertEqual(
+            {'count': 1, 'sum': None, 'avg': None, 'min': None},
+            OneModel.objects.all_shards().filter(spam='xx').aggregate(
+                count=Count('id'),
+                sum=Sum(Length('egg')),
+                avg=Avg(Length('egg')),
+                min=Min('egg'),
+            ),
+        )
+
+    @skipUnless(django.VERSION >= (2, 0), "Requires Django 2.0")
+    def test_aggregate_conditional(self):
+        self.assertEqual(
+            {'count': 2},
+            OneModel.objects.all_shards().aggregate(count=Count('id', filter=~Q(spam='x'))),
+        )
+
+    def test_aggregate_not_supported(self):
+        with self.assertRaises(NotSupportedError):
+            OneModel.objects.all_shards().aggregate(Count('spam', distinct=True))
+        with self.assertRaises(NotSupportedError):
+            OneModel.objects.all_shards().aggregate(stddev=StdDev(Length('spam')))
+        with self.assertRaises(TypeError):
+            OneModel.objects.all_shards().aggregate(spam=Length('spam'))
+
+    def test_not_supported_grouping(self):
+        with self.assertRaises(NotSupportedError):
+            list(OneModel.objects.all_shards().values('spam').annotate(count=Count('id')))
+        with self.assertRaises(NotSupportedError):
+            OneModel.objects.all_shards().values('spam').distinct().count()
+        with self.assertRaises(NotSupportedError):
+            list(OneModel.objects.all_shards().values('spam').distinct())
+
+    def test_count(self):
+        self.assertEqual(3, OneModel.objects.all_shards().count())
+        self.assertEqual(1, OneModel.objects.all_shards().filter(spam='xxx').count())
+        self.assertEqual(2, OneModel.objects.all_shards()[1:].count())
+        self.assertEqual(2, OneModel.objects.all_shards()[:2].count())
+        self.assertEqual(1, OneModel.objects.all_shards()[2:10].count())
+
+    def test_exists(self):
+        self.assertTrue(OneModel.objects.all_shards().exists())
+        self.assertFalse(OneModel.objects.all_shards().filter(spam='xxxx').exists())
+
+
+class BulkQuerySetTestCase(HorizontalBaseTestCase):
+    def setUp(self):
+        super(BulkQuerySetTestCase, self).setUp()
+        self.users = []
+        for index, name in enumerate(('spam', 'egg', 'ham'), start=1):
+            user = user_model.objects.create_user(name)
+            HorizontalMetadata.objects.create(group='a', key=user.id, index=index)
+            self.users.append(user)
+
+    def assert_created_in_shards(self, ones):
+        for one, database in zip(ones, ('a1-primary', 'a2-primary', 'a3') * 2):
+            self.assertEqual(database, one._state.db)
+            self.assertFalse(one._state.adding)
+            self.assertTrue(OneModel.objects.using(database).filter(pk=one.pk).exists())
+        self.assertEqual(len(ones), OneModel.objects.all_shards().count())
+
+    def test_bulk_create(self):
+        ones = [OneModel(user=user, spam=spam) for spam in ('1st', '2nd') for user in self.users]
+        with self.assertNumQueries(1, using='default'):  # Resolve indexes in a batch
+            with patch('horizon.query.get_db_for_write_from_model_index',
+                       wraps=get_db_for_write_from_model_index) as get_db:
+                self.assertEqual(ones, OneModel.objects.bulk_create(ones))
+        self.assertEqual(3, get_db.call_count)  # Once per shard
+        self.assert_created_in_shards(ones)
+
+    def test_bulk_create_in_parallel(self):
+        ones = [OneModel(user=user, spam='1st') for user in self.users]
+        with patch('horizon.utils.get_executor', wraps=get_executor) as executor:
+            OneModel.objects.bulk_create(ones, parallel=True)
+            self.assertEqual(3, executor.call_count)
+        self.assert_created_in_shards(ones)
+
+    def test_bulk_create_using_database(self):
+        ones = [OneModel(user=user, spam='1st') for user in self.users]
+        OneModel.objects.using('a3').bulk_create(ones)
+        self.assertEqual(3, OneModel.objects.using('a3').count())
+
+    @skipUnless(hasattr(DjangoQuerySet, 'bulk_update'), "Requires Django 2.2")
+    def test_bulk_update(self):
+        ones = [OneModel.objects.create(user=user, spam='1st') for user in self.users]
+        for one in ones:
+            one.egg = 'boiled'
+        OneModel.objects.bulk_update(ones, ['egg'], parallel=True)
+        for user in self.users:
+            self.assertEqual('boiled', OneModel.objects.get(user=user).egg)
+
+
+class MultipleKeysQuerySetTestCase(HorizontalBaseTestCase):
+    def setUp(self):
+        super(MultipleKeysQuerySetTestCase, self).setUp()
+        self.users = []
+        for index, name in zip((1, 1, 2, 3), ('spam', 'egg', 'ham', 'bacon')):
+            user = user_model.objects.create_user(name)
+            HorizontalMetadata.objects.create(group='a', key=user.id, index=index)
+            one = OneModel.objects.create(user=user, spam='1st')
+            ManyModel.objects.create(user=user, one=one)
+            self.users.append(user)
+
+    def test_update(self):
+        queryset = OneModel.objects.filter(user__in=self.users[:3])
+        self.assertEqual(3, queryset.update(egg='fried'))
+        self.assertEqual(
+            ['fried', 'fried', 'fried', None],
+            [OneModel.objects.get(user=user).egg for user in self.users],
+        )
+
+    def test_update_by_shard(self):
+        self.assertEqual(
+            {'a1-primary': 2, 'a2-primary': 1},
+            OneModel.objects.filter(user_id__in=[user.id for user in self.users[:3]])
+            .update_by_shard(egg='fried'),
+        )
+
+    def test_update_with_trimmed_keys(self):
+        with transaction.atomic(), CaptureQueriesContext(connections['a2-primary']) as queries:
+            OneModel.objects.filter(user__in=self.users[:3]).update(egg='fried')
+        update_queries = [query for query in queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(1, len(update_queries))
+        self.assertIn('IN (%d)' % self.users[2].id, update_queries[0]['sql'])
+
+    def test_delete(self):
+        deleted, rows_count = OneModel.objects.filter(user__in=self.users[1:]).delete()
+        self.assertEqual(6, deleted)
+        self.assertEqual({'tests.OneModel': 3, 'tests.ManyModel': 3}, rows_count)
+        self.assertEqual(1, OneModel.objects.all_shards().count())
+        self.assertEqual(1, ManyModel.objects.all_shards().count())
+
+    def test_delete_by_shard(self):
+        deleted = ManyModel.objects.filter(user__in=self.users).delete_by_shard()
+        self.assertEqual(['a1-primary', 'a2-primary', 'a3'], list(deleted))
+        self.assertEqual((2, {'tests.ManyModel': 2}), deleted['a1-primary'])
+        self.assertEqual((1, {'tests.ManyModel': 1}), deleted['a3'])
+
+    def test_single_key(self):
+        queryset = OneModel.objects.filter(user__in=[self.users[3]])
+        self.assertEqual(self.users[3].id, queryset._horizontal_key)
+        self.assertEqual(1, queryset.count())
+
+    def test_exclude(self):
+        with self.assertRaises(ProgrammingError):
+            OneModel.objects.exclude(user__in=self.users[:3]).update(egg='fried')
+        with self.assertRaises(ProgrammingError):
+            OneModel.objects.all().update_by_shard(egg='fried')
+
+    def test_filter(self):
+        clear_index_cache()
+        with self.assertNumQueries(1, using='default'):  # Resolve indexes in a batch
+            ones = list(OneModel.objects.filter(user__in=self.users).order_by('user_id'))
+        self.assertEqual([user.id for user in self.users], [one.user_id for one in ones])
+        self.assertEqual(
+            ['a2-replica'],
+            [one._state.db for one in ones if one.user_id == self.users[2].id],
+        )
+
+        with self.assertNumQueries(0, using='default'):
+            self.assertEqual(3, OneModel.objects.filter(user__in=self.users[1:]).count())
+            self.assertTrue(OneModel.objects.filter(user__in=self.users[1:]).exists())
+            self.assertEqual(
+                self.users[3].id,
+                OneModel.objects.filter(user__in=self.users[1:]).get(user=self.users[3]).user_id,
+            )
+
+    def test_filter_minimal_shards(self):
+        with transaction.atomic(), CaptureQueriesContext(connections['a3']) as queries:
+            list(OneModel.objects.filter(user__in=self.users[:3]))
+        self.assertEqual(0, len(queries), "No keys in the shard")
+
+        with transaction.atomic(), CaptureQueriesContext(connections['a2-replica']) as queries:
+            list(OneModel.objects.filter(user__in=self.users[:3]))
+        self.assertEqual(1, len(queries))
+        self.assertIn('IN (%d)' % self.users[2].id, queries[0]['sql'])
+
+    def test_filter_with_no_keys(self):
+        self.assertEqual([], list(OneModel.objects.filter(user__in=[])))
+        self.assertEqual(0, OneModel.objects.filter(user__in=[]).count())
+
+    def test_filter_chained(self):
+        queryset = OneModel.objects.filter(user__in=self.users[:2])
+        chained = queryset.filter(user__in=self.users[1:3])
+        self.assertEqual([self.users[1].id], [one.user_id for one in chained])
+        self.assertEqual(1, chained.count())
+        self.assertEqual(2, queryset.count(), "Not changed by chaining")
+
+        chained = queryset.filter(user__in=self.users[:3]).filter(user_id__in=[
+            user.id for user in self.users[1:]])
+        self.assertEqual([self.users[1].id], [one.user_id for one in chained])
+
+        queryset = OneModel.objects.filter(user__in=self.users[1:])
+        self.assertEqual(
+            [self.users[2].id, self.users[3].id],
+            [one.user_id for one in queryset.filter(user__in=self.users[2:]).order_by('user_id')],
+        )
+        self.assertEqual(0, queryset.filter(user__in=self.users[:1]).count())
+
+    def test_filter_with_generator(self):
+        queryset = OneModel.objects.filter(user__in=(user for user in self.users[1:]))
+        self.assertEqual(3, queryset.count())
+        self.assertEqual(3, len(queryset._horizontal_keys))
+
+    def test_filter_with_subquery(self):
+        OneModel.objects.filter(user=self.users[3]).update(spam='2nd')
+        users = OneModel.objects.all_shards().filter(spam='1st').values('user_id')
+        queryset = OneModel.objects.filter(user__in=users)
+        self.assertIsNone(queryset._horizontal_keys)
+        self.assertEqual(3, queryset.all_shards().count())
+
+        queryset = OneModel.objects.filter(user__in=self.users[2:]).filter(user__in=users)
+        self.assertEqual([self.users[2].id], [one.user_id for one in queryset])
+
+    def test_update_chained(self):
+        queryset = OneModel.objects.filter(user__in=self.users[:3]).filter(
+            user__in=self.users[2:])
+        self.assertEqual(1, queryset.update(egg='fried'))
+        self.assertEqual(
+            [None, None, 'fried', None],
+            [OneModel.objects.get(user=user).egg for user in self.users],
+        )
+
+        queryset = OneModel.objects.filter(user__in=self.users[:2]).filter(
+            user__in=self.users[1:])
+        self.assertEqual(1, queryset.update(egg='boiled'))
+        self.assertEqual(
+            [None, 'boiled', 'fried', None],
+            [OneModel.objects.get(user=user).egg for user in self.users],
+        )
+
+    def test_delete_chained(self):
+        queryset = ManyModel.objects.filter(user__in=self.users[:3]).filter(
+            user__in=self.users[1:])
+        self.assertEqual(
+            (2, {'tests.ManyModel': 2}),
+            queryset.delete(),
+        )
+        self.assertEqual(
+            [self.users[0].id, self.users[3].id],
+            sorted(many.user_id for many in ManyModel.objects.all_shards()),
+        )
+
+
+class PrefetchHorizontalObjectsTestCase(HorizontalBaseTestCase):
+    def setUp(self):
+        super(PrefetchHorizontalObjectsTestCase, self).setUp()
+        for name, index, spams in (
+            ('spam', 1, ('1st', '2nd')),
+            ('egg', 1, ('3rd', )),
+            ('ham', 2, ()),
+            ('bacon', 3, ('4th', )),
+        ):
+            user = user_model.objects.create_user(name)
+            HorizontalMetadata.objects.create(group='a', key=user.id, index=index)
+            for spam in spams:
+                OneModel.objects.create(user=user, spam=spam)
+        self.users = list(user_model.objects.order_by('id'))
+
+    def test_prefetch(self):
+        clear_index_cache()
+        with self.assertNumQueries(1, using='default'):  # Resolve indexes in a batch
+            prefetch_horizontal_objects(self.users, 'onemodel_set')
+
+        with self.assertNumQueries(0, using='default'):
+            self.assertEqual(
+                [['1st', '2nd'], ['3rd'], [], ['4th']],
+                [sorted(one.spam for one in user.onemodel_set.all()) for user in self.users],
+            )
+            for user in self.users:
+                for one in user.onemodel_set.all():
+                    self.assertIs(user, one.user)
+
+    def test_prefetch_with_queryset(self):
+        prefetch_horizontal_objects(
+            self.users,
+            Prefetch('onemodel_set', OneModel.objects.exclude(spam='2nd'), to_attr='ones'),
+        )
+        self.assertEqual(
+            [['1st'], ['3rd'], [], ['4th']],
+            [[one.spam for one in user.ones] for user in self.users],
+        )
+
+    def test_prefetch_not_by_horizontal_key(self):
+        ones = list(OneModel.objects.filter(user=self.users[0]))
+        with self.assertRaises(ValueError):
+            prefetch_horizontal_objects(ones, 'manymodel_set')
+        with self.assertRaises(NotSupportedError):
+            prefetch_horizontal_objects(self.users, 'onemodel_set__manymodel_set')
@@ -0,0 +1,434 @@
+import json
+import os
+import shutil
+import tempfile
+from io import StringIO
+from unittest.mock import patch
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.db import OperationalError
+from django.db.utils import NotSupportedError
+from django.test import SimpleTestCase, override_settings
+
+from horizon.freezing import freeze_key, is_frozen, unfreeze_key
+from horizon.relocation import (
+    Checkpoint,
+    KeyMover,
+    Throttle,
+    get_group_models,
+    get_index_counts,
+    move_keys,
+    plan_rebalance,
+    rebalance,
+)
+from horizon.routers import HorizontalRouter
+from horizon.utils import (
+    get_index_cache,
+    get_or_create_index,
+    prime,
+    run_in_parallel,
+)
+
+from .base import HorizontalBaseTestCase
+from .models import (
+    ConcreteModel,
+    HorizontalMetadata,
+    ManyModel,
+    OneModel,
+    ProxiedModel,
+    ProxyBaseModel,
+)
+
+user_model = get_user_model()
+
+MOVER_CONFIG = dict(settings.HORIZONTAL_CONFIG, FREEZE_CACHE='horizon', INDEX_CACHE_TIMEOUT=0.01)
+UNSAFE_MOVER_CONFIG = dict(MOVER_CONFIG, FREEZE_CACHE=None, INDEX_CACHE_TIMEOUT=None)
+CONSISTENT_HASH_MOVER_CONFIG = dict(
+    MOVER_CONFIG,
+    GROUPS=dict(
+        MOVER_CONFIG['GROUPS'],
+        a=dict(
+            MOVER_CONFIG['GROUPS']['a'],
+            PLACEMENT='horizon.placement.ConsistentHashPlacement',
+        ),
+    ),
+)
+
+
+@override_settings(HORIZONTAL_CONFIG=MOVER_CONFIG)
+class KeyMoverTestCase(HorizontalBaseTestCase):
+    def setUp(self):
+        super(KeyMoverTestCase, self).setUp()
+        self.user_a = user_model.objects.create_user('spam')
+        self.user_b = user_model.objects.create_user('egg')
+        HorizontalMetadata.objects.create(group='a', key=self.user_a.id, index=1)
+        HorizontalMetadata.objects.create(group='a', key=self.user_b.id, index=1)
+        HorizontalMetadata.objects.create(group='b', key=self.user_a.id, index=1)
+        self.ones = [
+            OneModel.objects.create(user=self.user_a, spam=str(i)) for i in range(5)
+        ]
+        self.manys = [ManyModel.objects.create(user=self.user_a, one=one) for one in self.ones]
+        self.other = OneModel.objects.create(user=self.user_b, spam='other')
+
+    def test_get_group_models(self):
+        self.assertEqual([OneModel, ManyModel], get_group_models('a'))
+        models = get_group_models('b')
+        self.assertEqual({ProxyBaseModel, ProxiedModel, ConcreteModel}, set(models))
+        self.assertLess(models.index(ProxyBaseModel), models.index(ProxiedModel))
+
+    def test_move_keys(self):
+        self.assertEqual(1, get_or_create_index(OneModel, self.user_a.id))
+        results = move_keys('a', [self.user_a.id], 2, batch_size=2)
+        self.assertEqual(1, len(results))
+        self.assertEqual(('a', str(self.user_a.id), 1, 2, 10), tuple(results[0]))
+
+        self.assertEqual(2, HorizontalMetadata.objects.get(group='a', key=self.user_a.id).index)
+        self.assertEqual(2, get_or_create_index(OneModel, self.user_a.id))
+        self.assertEqual(5, OneModel.objects.using('a2-primary').filter(user=self.user_a).count())
+        self.assertEqual(5, ManyModel.objects.using('a2-primary').filter(user=self.user_a).count())
+        self.assertEqual(
+            {(one.pk, one.spam) for one in self.ones},
+            set(OneModel.objects.filter(user=self.user_a).values_list('pk', 'spam')),
+        )
+        self.assertFalse(OneModel.objects.using('a1-primary').filter(user=self.user_a).exists())
+        self.assertFalse(ManyModel.objects.using('a1-primary').filter(user=self.user_a).exists())
+        self.assertTrue(OneModel.objects.using('a1-primary').filter(pk=self.other.pk).exists())
+        self.assertFalse(is_frozen('a', self.user_a.id))
+
+    def test_move_inherited_models(self):
+        ProxyBaseModel.objects.create(user=self.user_a, sushi='maguro')
+        ProxiedModel.objects.create(
+            user=self.user_a, sushi='tsuna', tempura='momiji', karaage='chicken')
+        ConcreteModel.objects.create(user=self.user_a, pizza='a', potate='b', coke='c')
+        move_keys('b', [self.user_a.id], 3)
+
+        self.assertEqual(2, ProxyBaseModel.objects.using('b3').filter(user=self.user_a).count())
+        proxied = ProxiedModel.objects.using('b3').get(user=self.user_a)
+        self.assertEqual(('tsuna', 'momiji'), (proxied.sushi, proxied.tempura))
+        self.assertTrue(ConcreteModel.objects.using('b3').filter(user=self.user_a).exists())
+        for model in (ProxyBaseModel, ProxiedModel, ConcreteModel):
+            self.assertFalse(model.objects.using('b1-primary').exists())
+
+    def test_move_to_same_index(self):
+        self.assertEqual(0, move_keys('a', [self.user_a.id], 1)[0].rows)
+        self.assertEqual(5, OneModel.objects.using('a1-primary').filter(user=self.user_a).count())
+
+    def test_sync(self):
+        mover = KeyMover('a')
+        key = str(self.user_a.id)
+        self.assertEqual(10, mover.sync(key, 'a1-primary', 'a2-primary'))
+        self.assertEqual(0, mover.sync(key, 'a1-primary', 'a2-primary', dry_run=True))
+
+        OneModel.objects.using('a1-primary').filter(pk=self.ones[0].pk).update(egg='changed')
+        ManyModel.objects.using('a1-primary').filter(pk=self.manys[1].pk).delete()
+        OneModel.objects.using('a1-primary').create(user=self.user_a, spam='new')
+        self.assertEqual(3, mover.sync(key, 'a1-primary', 'a2-primary', dry_run=True))
+        self.assertEqual(3, mover.sync(key, 'a1-primary', 'a2-primary'))
+        self.assertEqual(0, mover.sync(key, 'a1-primary', 'a2-primary', dry_run=True))
+        self.assertEqual(
+            'changed', OneModel.objects.using('a2-primary').get(pk=self.ones[0].pk).egg)
+        self.assertEqual(4, ManyModel.objects.using('a2-primary').count())
+
+    def test_writes_are_frozen_while_moving(self):
+        mover = KeyMover('a')
+        frozen = []
+
+        def sync(*args, **kwargs):
+            frozen.append(is_frozen('a', self.user_a.id))
+            return KeyMover.sync(mover, *args, **kwargs)
+
+        with patch.object(mover, 'sync', side_effect=sync):
+            mover.move(str(self.user_a.id), 2)
+        self.assertEqual([False, True, True, True], frozen)
+
+    def test_metadata_changed_while_moving(self):
+        mover = KeyMover('a')
+
+        def freeze(group, key):
+            HorizontalMetadata.objects.filter(group=group, key=key).update(index=3)
+
+        with patch('horizon.relocation.freeze_key', side_effect=freeze):
+            with self.assertRaises(OperationalError):
+                mover.move(str(self.user_a.id), 2)
+        self.assertEqual(5, OneModel.objects.using('a1-primary').filter(user=self.user_a).count())
+
+    def test_invalidated_after_settle(self):
+        with patch('horizon.relocation.invalidate_index') as invalidate_index:
+            with patch('horizon.relocation.time.sleep') as sleep:
+                sleep.side_effect = lambda seconds: invalidate_index.assert_called_once_with(
+                    'a', str(self.user_a.id))
+                KeyMover('a', settle=1).move(str(self.user_a.id), 2)
+        sleep.assert_called_once_with(1)
+        self.assertEqual(2, invalidate_index.call_count)
+
+    def test_written_to_source_while_moving(self):
+        def sleep(seconds):  # A process routing by a stale cached index
+            OneModel.objects.using('a1-primary').create(user=self.user_a, spam='stale')
+
+        with patch('horizon.relocation.time.sleep', side_effect=sleep):
+            with self.assertRaises(OperationalError):
+                KeyMover('a', settle=1).move(str(self.user_a.id), 2)
+        self.assertEqual(6, OneModel.objects.using('a1-primary').filter(user=self.user_a).count())
+        self.assertFalse(is_frozen('a', self.user_a.id))
+
+    def test_freeze_expired_while_copying(self):
+        mover = KeyMover('a')
+        with patch('horizon.relocation.monotonic', side_effect=[0, 0, 30]):
+            with self.assertRaises(OperationalError):
+                mover.move(str(self.user_a.id), 2)
+        self.assertEqual(1, HorizontalMetadata.objects.get(group='a', key=self.user_a.id).index)
+        self.assertEqual(5, OneModel.objects.using('a1-primary').filter(user=self.user_a).count())
+
+    def test_bulk_writes_wait_until_unfrozen(self):
+        one = OneModel.objects.get(user=self.user_a, pk=self.ones[0].pk)
+        self.assertEqual(1, one._horizontal_database_index)
+
+        def sleep(seconds):  # Moved by another process meanwhile
+            HorizontalMetadata.objects.filter(group='a', key=self.user_a.id).update(index=2)
+            get_index_cache().clear()
+            unfreeze_key('a', self.user_a.id)
+
+        freeze_key('a', self.user_a.id)
+        with patch('horizon.freezing.time.sleep', side_effect=sleep):
+            OneModel.objects.bulk_create([OneModel(user=self.user_a, spam='new')])
+        self.assertTrue(OneModel.objects.using('a2-primary').filter(spam='new').exists())
+
+        freeze_key('a', self.user_a.id)
+        with patch('horizon.freezing.time.sleep', side_effect=sleep) as wait:
+            OneModel.objects.filter(user__in=[self.user_a, self.user_b]).update(egg='updated')
+            wait.assert_called_once_with(0.05)
+
+        freeze_key('a', self.user_a.id)
+        with patch('horizon.freezing.time.sleep', side_effect=sleep):
+            prime([one])
+        self.assertEqual(2, one._horizontal_database_index)
+
+    def test_command(self):
+        out = StringIO()
+        call_command('horizon_move_keys', 'a', '3', str(self.user_a.id), rate=1000, stdout=out)
+        self.assertIn("Moved '%s' from 1 to 3 (10 rows copied)" % self.user_a.id, out.getvalue())
+        self.assertEqual(5, OneModel.objects.using('a3').count())
+
+        with self.assertRaises(CommandError):
+            call_command('horizon_move_keys', 'a', '3', 'unknown', stdout=out)
+
+    @override_settings(HORIZONTAL_CONFIG=CONSISTENT_HASH_MOVER_CONFIG)
+    def test_placed_without_metadata(self):
+        with self.assertRaises(NotSupportedError):
+            KeyMover('a')
+        with self.assertRaises(CommandError):
+            call_command('horizon_move_keys', 'a', '3', str(self.user_a.id))
+        with self.assertRaises(CommandError):
+            call_command('horizon_rebalance', 'a', dry_run=True)
+        KeyMover('b')
+
+    def test_requires_cross_process_invalidation(self):
+        for config, options in (
+            (dict(MOVER_CONFIG, FREEZE_CACHE=None), {}),
+            (dict(MOVER_CONFIG, INDEX_CACHE_TIMEOUT=None), {}),
+            (dict(MOVER_CONFIG, FREEZE_CACHE=None), {'settle': 1}),
+        ):
+            with override_settings(HORIZONTAL_CONFIG=config):
+                with self.assertRaises(ImproperlyConfigured):
+                    KeyMover('a', **options)
+        with override_settings(HORIZONTAL_CONFIG=dict(MOVER_CONFIG, INDEX_CACHE_TIMEOUT=None)):
+            self.assertEqual(1, KeyMover('a', settle=1).settle)
+            with self.assertRaises(ImproperlyConfigured):
+                KeyMover('a', settle=30)  # Not shorter than FREEZE_TIMEOUT
+        with override_settings(HORIZONTAL_CONFIG=dict(MOVER_CONFIG, INDEX_CACHE_TIMEOUT=60)):
+            with self.assertRaises(ImproperlyConfigured):
+                KeyMover('a')
+        with override_settings(HORIZONTAL_CONFIG=dict(
+            MOVER_CONFIG, METADATA_READ=['default-replica'], SHARED_INDEX_CACHE='horizon',
+        )):
+            with self.assertRaises(ImproperlyConfigured):
+                KeyMover('a')
+            with override_settings(HORIZONTAL_CONFIG=dict(
+                MOVER_CONFIG, METADATA_READ=['default-replica'], SHARED_INDEX_CACHE='horizon',
+                SHARED_INDEX_CACHE_TIMEOUT=60,
+            )):
+                KeyMover('a')
+        with override_settings(HORIZONTAL_CONFIG=UNSAFE_MOVER_CONFIG):
+            self.assertEqual(0, KeyMover('a', single_process=True).settle)
+            with self.assertRaises(CommandError):
+                call_command('horizon_move_keys', 'a', '3', str(self.user_a.id))
+            call_command(
+                'horizon_move_keys', 'a', '3', str(self.user_a.id), single_process=True,
+                stdout=StringIO())
+        self.assertEqual(5, OneModel.objects.using('a3').count())
+
+
+@override_settings(  # Writes from many threads lock tables of shared in-memory SQLite databases
+    HORIZONTAL_CONFIG=dict(MOVER_CONFIG, MAX_WORKERS=1),
+)
+class RebalanceTestCase(HorizontalBaseTestCase):
+    def setUp(self):
+        super(RebalanceTestCase, self).setUp()
+        self.users = [user_model.objects.create_user('user%d' % i) for i in range(6)]
+        for user in self.users:
+            HorizontalMetadata.objects.create(group='a', key=user.id, index=1)
+            OneModel.objects.create(user=user, spam='spam')
+        self.keys = sorted(str(user.id) for user in self.users)
+        self.directory = tempfile.mkdtemp()
+        self.checkpoint_path = os.path.join(self.directory, 'checkpoint.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(RebalanceTestCase, self).tearDown()
+
+    def test_plan_rebalance(self):
+        self.assertEqual([
+            (self.keys[0], 1, 2),
+            (self.keys[1], 1, 2),
+            (self.keys[2], 1, 3),
+            (self.keys[3], 1, 3),
+        ], plan_rebalance('a', {1: 1, 2: 1, 3: 1}))
+        self.assertEqual(
+            [(key, 1, 2) for key in self.keys[:3]],
+            plan_rebalance('a', {1: 1, 2: 1}),
+        )
+        self.assertEqual(
+            [(key, 1, 3) for key in self.keys],
+            plan_rebalance('a', {3: 1}),
+            "Empty indexes without weight",
+        )
+        self.assertEqual(1, len(plan_rebalance('a', {1: 1, 2: 1, 3: 1}, limit=1)))
+        self.assertEqual([], plan_rebalance('a', {1: 1}))
+
+    def test_rebalance(self):
+        checkpoint = Checkpoint(self.checkpoint_path)
+        checkpoint.group = 'a'
+        checkpoint.moves = plan_rebalance('a', {1: 1, 2: 1, 3: 1})
+        with patch('horizon.relocation.run_in_parallel', wraps=run_in_parallel) as parallel, \
+                patch('horizon.relocation.time.sleep') as sleep:
+            self.assertEqual(4, rebalance(
+                'a', checkpoint.moves, checkpoint=checkpoint, keys_per_move=2, settle=1))
+        self.assertEqual(2, sleep.call_count, "A settle for each batch of keys")
+        self.assertEqual(
+            [((1, 2), self.keys[:2]), ((1, 3), self.keys[2:4])],
+            list(parallel.call_args[0][1]),
+            "A stream for each source and target",
+        )
+
+        self.assertEqual({1: 2, 2: 2, 3: 2}, get_index_counts('a'))
+        for index, database in ((1, 'a1-primary'), (2, 'a2-primary'), (3, 'a3')):
+            self.assertEqual(2, OneModel.objects.using(database).count())
+
+        with open(self.checkpoint_path) as f:
+            self.assertEqual(self.keys[:4], json.load(f)['done'])
+
+    def test_resume(self):
+        checkpoint = Checkpoint(self.checkpoint_path)
+        checkpoint.group = 'a'
+        checkpoint.moves = plan_rebalance('a', {1: 1, 2: 1, 3: 1})
+        checkpoint.done = {self.keys[0], self.keys[2]}
+        checkpoint.save()
+
+        checkpoint = Checkpoint(self.checkpoint_path)
+        self.assertTrue(checkpoint.load())
+        with patch.object(KeyMover, 'move_many') as move_many:
+            self.assertEqual(2, rebalance('a', checkpoint.moves, checkpoint=checkpoint))
+        self.assertEqual(
+            sorted([([self.keys[1]], 2), ([self.keys[3]], 3)]),
+            sorted(call[0] for call in move_many.call_args_list),
+        )
+        self.assertEqual(set(self.keys[:4]), checkpoint.done)
+        self.assertFalse(Checkpoint(os.path.join(self.directory, 'none.json')).load())
+
+    def test_command(self):
+        out = StringIO()
+        call_command('horizon_rebalance', 'a', weights='1=1,2=2', dry_run=True, stdout=out)
+        self.assertIn("Move '%s' from 1 to 2" % self.keys[3], out.getvalue())
+        self.assertEqual({1: 6}, get_index_counts('a'))
+
+        call_command(
+            'horizon_rebalance', 'a', checkpoint=self.checkpoint_path, limit=3, stdout=out)
+        self.assertIn("Moved 3 keys", out.getvalue())
+        self.assertEqual({1: 3, 2: 2, 3: 1}, get_index_counts('a'))
+
+        call_command('horizon_rebalance', 'a', checkpoint=self.checkpoint_path, stdout=out)
+        self.assertIn("Resume 0 of 3 moves", out.getvalue())
+        with self.assertRaises(CommandError):
+            call_command(
+                'horizon_rebalance', 'a', checkpoint=self.checkpoint_path, limit=1, stdout=out)
+
+        with self.assertRaises(CommandError):
+            call_command('horizon_rebalance', 'b', checkpoint=self.checkpoint_path, stdout=out)
+        with self.assertRaises(CommandError):
+            call_command('horizon_rebalance', 'wrong', stdout=out)
+        with self.assertRaises(CommandError):
+            call_command('horizon_rebalance', 'a', '--weights', '1:1', stdout=out)
+        with override_settings(HORIZONTAL_CONFIG=UNSAFE_MOVER_CONFIG):
+            with self.assertRaises(CommandError):
+                call_command('horizon_rebalance', 'a', stdout=out)
+        with patch('horizon.management.commands.horizon_rebalance.plan_rebalance',
+                   return_value=[('unknown', 1, 2)]):
+            with self.assertRaises(CommandError):
+                call_command('horizon_rebalance', 'a', stdout=out)
+
+
+class FreezeTestCase(HorizontalBaseTestCase):
+    def tearDown(self):
+        unfreeze_key('a', 1)
+        super(FreezeTestCase, self).tearDown()
+
+    def test_freeze_key(self):
+        self.assertFalse(is_frozen('a', 1))
+        freeze_key('a', 1)
+        self.assertTrue(is_frozen('a', 1))
+        self.assertTrue(is_frozen('a', '1'))
+        self.assertFalse(is_frozen('a', 2))
+        self.assertFalse(is_frozen('b', 1))
+        unfreeze_key('a', 1)
+        self.assertFalse(is_frozen('a', 1))
+
+        freeze_key('a', 1, timeout=0)
+        self.assertFalse(is_frozen('a', 1), "Expired")
+
+    @override_settings(HORIZONTAL_CONFIG=dict(settings.HORIZONTAL_CONFIG, FREEZE_CACHE='horizon'))
+    def test_freeze_key_in_shared_cache(self):
+        freeze_key('a', 1)
+        with patch('horizon.freezing._frozen_keys', {}):
+            self.assertTrue(is_frozen('a', 1))
+        unfreeze_key('a', 1)
+        self.assertFalse(is_frozen('a', 1))
+
+    @override_settings(HORIZONTAL_CONFIG=dict(settings.HORIZONTAL_CONFIG, FREEZE_TIMEOUT=0.1))
+    def test_db_for_write(self):
+        user = user_model.objects.create_user('spam')
+        HorizontalMetadata.objects.create(group='a', key=user.id, index=1)
+        router = HorizontalRouter()
+        freeze_key('a', user.id, timeout=10)
+        with self.assertRaises(OperationalError):
+            router.db_for_write(OneModel, horizontal_key=user.id)
+        self.assertIn(router.db_for_read(OneModel, horizontal_key=user.id), [
+            'a1-replica-1', 'a1-replica-2',
+        ])
+
+        one = OneModel(user=user)
+        self.assertEqual(1, one._horizontal_database_index)
+        HorizontalMetadata.objects.filter(group='a', key=user.id).update(index=2)
+        get_index_cache().clear()
+        with patch('horizon.routers.wait_until_unfrozen', return_value=True):
+            self.assertEqual('a2-primary', router.db_for_write(OneModel, instance=one))
+
+
+class ThrottleTestCase(SimpleTestCase):
+    def test_wait(self):
+        with patch('horizon.relocation.monotonic', return_value=100):
+            throttle = Throttle(rate=10)
+            with patch('horizon.relocation.time.sleep') as sleep:
+                throttle.wait(5)
+                sleep.assert_called_once_with(0.5)
+        with patch('horizon.relocation.monotonic', return_value=101):
+            with patch('horizon.relocation.time.sleep') as sleep:
+                throttle.wait(5)
+                sleep.assert_not_called()
+
+    def test_unlimited(self):
+        with patch('horizon.relocation.time.sleep') as sleep:
+            Throttle().wait(1000)
+            sleep.assert_not_called()
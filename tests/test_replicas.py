@@ -0,0 +1,181 @@
+from collections import Counter
+from unittest.mock import patch
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test import SimpleTestCase, override_settings
+
+from horizon.cache import monotonic
+from horizon.replicas import (
+    BaseReplicaSelector,
+    KeyAffineReplicaSelector,
+    LatencyReplicaSelector,
+    RandomReplicaSelector,
+    RoundRobinReplicaSelector,
+    latency_tracker,
+)
+from horizon.routers import HorizontalRouter
+from horizon.routing import compile_group, get_routing_table
+from horizon.utils import get_replica_selector_from_group
+
+from .base import HorizontalBaseTestCase
+from .models import HorizontalMetadata, OneModel
+
+CONFIG = {
+    'DATABASES': {
+        1: {'write': 'p1', 'read': ['r1', 'r2', 'r3']},
+        2: {'write': 'p2', 'read': {'r4': 3, 'r5': 1}},
+        3: {'write': 'p3'},
+    },
+}
+TABLE = compile_group('a', CONFIG)
+
+KEY_AFFINE_CONFIG = dict(
+    settings.HORIZONTAL_CONFIG,
+    GROUPS=dict(
+        settings.HORIZONTAL_CONFIG['GROUPS'],
+        a=dict(
+            settings.HORIZONTAL_CONFIG['GROUPS']['a'],
+            REPLICA_SELECTOR='horizon.replicas.KeyAffineReplicaSelector',
+        ),
+    ),
+)
+
+
+class ReplicaSelectorTestCase(SimpleTestCase):
+    def test_base_replica_selector(self):
+        with self.assertRaises(NotImplementedError):
+            BaseReplicaSelector(TABLE).select(1)
+
+    def test_random_replica_selector(self):
+        selector = RandomReplicaSelector(TABLE)
+        self.assertEqual({'r1', 'r2', 'r3'}, {selector.select(1) for _ in range(100)})
+        self.assertEqual('p3', selector.select(3))
+
+        counts = Counter(selector.select(2) for _ in range(4000))
+        self.assertGreater(counts['r4'], counts['r5'] * 2)
+
+    def test_round_robin_replica_selector(self):
+        selector = RoundRobinReplicaSelector(TABLE)
+        self.assertEqual(
+            ['r1', 'r2', 'r3', 'r1', 'r2'],
+            [selector.select(1) for _ in range(5)],
+        )
+        self.assertEqual(
+            ['r4', 'r4', 'r5', 'r4', 'r4', 'r4', 'r5', 'r4'],
+            [selector.select(2) for _ in range(8)],
+        )
+
+    def test_round_robin_replica_selector_with_fractional_weights(self):
+        selector = RoundRobinReplicaSelector(compile_group('a', {'DATABASES': {
+            1: {'write': 'p1', 'read': {'r1': 0.5, 'r2': 1.5}},
+        }}))
+        counts = Counter(selector.select(1) for _ in range(100))
+        self.assertEqual({'r1': 25, 'r2': 75}, counts)
+
+    def test_key_affine_replica_selector(self):
+        selector = KeyAffineReplicaSelector(TABLE)
+        for key in range(20):
+            self.assertEqual(selector.select(1, key), selector.select(1, str(key)))
+        self.assertEqual(
+            {'r1', 'r2', 'r3'},
+            {selector.select(1, key) for key in range(100)},
+        )
+
+        removed_selector = KeyAffineReplicaSelector(compile_group('a', {'DATABASES': {
+            1: {'write': 'p1', 'read': ['r1', 'r2']},
+        }}))
+        for key in range(100):
+            if selector.select(1, key) != 'r3':
+                self.assertEqual(selector.select(1, key), removed_selector.select(1, key))
+
+        counts = Counter(selector.select(2, key) for key in range(4000))
+        self.assertAlmostEqual(0.75, counts['r4'] / 4000, delta=0.03)
+
+    def test_key_affine_replica_selector_without_key(self):
+        selector = KeyAffineReplicaSelector(TABLE)
+        self.assertEqual({'r1', 'r2', 'r3'}, {selector.select(1) for _ in range(100)})
+
+
+class LatencyReplicaSelectorTestCase(HorizontalBaseTestCase):
+    def setUp(self):
+        super(LatencyReplicaSelectorTestCase, self).setUp()
+        latency_tracker.clear()
+
+    def tearDown(self):
+        for group in ('a', 'b'):
+            connection_created.disconnect(
+                dispatch_uid='horizon.replicas.latency_tracker.%s' % group)
+        for alias in connections:
+            if latency_tracker in connections[alias].execute_wrappers:
+                connections[alias].execute_wrappers.remove(latency_tracker)
+        latency_tracker.clear()
+        super(LatencyReplicaSelectorTestCase, self).tearDown()
+
+    def test_latency_tracker(self):
+        latency_tracker.record('r1', 1.0)
+        latency_tracker.record('r1', 2.0)
+        self.assertAlmostEqual(1.2, latency_tracker.get('r1'))
+        self.assertIsNone(latency_tracker.get('r2'))
+
+    def test_latency_tracker_max_age(self):
+        with patch('horizon.replicas.monotonic', return_value=100):
+            latency_tracker.record('r1', 1.0)
+        with patch('horizon.replicas.monotonic', return_value=129):
+            self.assertEqual(1.0, latency_tracker.get('r1'))
+        with patch('horizon.replicas.monotonic', return_value=130):
+            self.assertIsNone(latency_tracker.get('r1'), "Stale")
+            latency_tracker.record('r1', 0.1)
+            self.assertEqual(0.1, latency_tracker.get('r1'), "New average")
+
+    def test_select(self):
+        selector = LatencyReplicaSelector(TABLE._replace(database_set=frozenset()))
+        latency_tracker.record('r1', 0.3)
+        latency_tracker.record('r2', 0.1)
+        self.assertEqual('r3', selector.select(1), "Not measured yet")
+
+        latency_tracker.record('r3', 0.2)
+        self.assertEqual('r2', selector.select(1))
+
+        with patch('horizon.replicas.monotonic', return_value=monotonic() + 60):
+            latency_tracker.record('r2', 0.1)
+            latency_tracker.record('r3', 0.2)
+            self.assertEqual('r1', selector.select(1), "Slow once, measured again")
+
+    def test_measure_queries(self):
+        LatencyReplicaSelector(get_routing_table()['b'])
+        self.assertIn(latency_tracker, connections['b3'].execute_wrappers)
+        self.assertNotIn(latency_tracker, connections['a3'].execute_wrappers)
+
+        with connections['b3'].cursor() as cursor:
+            cursor.execute('SELECT 1')
+        self.assertIsNotNone(latency_tracker.get('b3'))
+
+    def test_measure_new_connections_of_group(self):
+        selector = LatencyReplicaSelector(get_routing_table()['b'])
+        self.assertEqual('b', selector.group)
+        for alias in ('a3', 'b3'):
+            connection = connections[alias]
+            if latency_tracker in connection.execute_wrappers:
+                connection.execute_wrappers.remove(latency_tracker)
+            connection_created.send(sender=connection.__class__, connection=connection)
+        self.assertIn(latency_tracker, connections['b3'].execute_wrappers)
+        self.assertNotIn(latency_tracker, connections['a3'].execute_wrappers)
+
+
+@override_settings(HORIZONTAL_CONFIG=KEY_AFFINE_CONFIG)
+class ReplicaSelectorRouterTestCase(HorizontalBaseTestCase):
+    def test_get_replica_selector_from_group(self):
+        self.assertIsInstance(get_replica_selector_from_group('a'), KeyAffineReplicaSelector)
+        self.assertIsInstance(get_replica_selector_from_group('b'), RandomReplicaSelector)
+
+    def test_db_for_read(self):
+        router = HorizontalRouter()
+        HorizontalMetadata.objects.create(group='a', key=1, index=1)
+        selector = get_replica_selector_from_group('a')
+        database = router.db_for_read(OneModel, horizontal_key=1)
+        self.assertEqual(selector.select(1, 1), database)
+        for _ in range(10):
+            self.assertEqual(database, router.db_for_read(OneModel, horizontal_key=1))
+            self.assertEqual(database, router.db_for_read(OneModel, instance=OneModel(user_id=1)))
@@ -1,6 +1,8 @@
 from unittest.mock import patch
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.test import override_settings
 
 from horizon.routers import HorizontalRouter
 
@@ -272,3 +274,52 @@ class HorizontalRouterReadWriteTestCase(HorizontalBaseTestCase):
             list(user_model.objects.filter())
             mock_db_for_read.assert_any_call(user_model)
             self.assertIsNone(self.router.db_for_read(user_model))
+
+    def test_db_for_read_from_index_cache(self):
+        self.router.db_for_read(OneModel, horizontal_key=self.user_a.id)
+        with self.assertNumQueries(0, using='default'):
+            self.assertIn(
+                self.router.db_for_read(OneModel, horizontal_key=self.user_a.id),
+                ['a1-replica-1', 'a1-replica-2'],
+            )
+
+
+@override_settings(HORIZONTAL_CONFIG=dict(settings.HORIZONTAL_CONFIG, CREATE_INDEX_ON_READ=False))
+class HorizontalRouterReadWithoutMetadataTestCase(HorizontalBaseTestCase):
+    def setUp(self):
+        super(HorizontalRouterReadWithoutMetadataTestCase, self).setUp()
+        self.router = HorizontalRouter()
+        self.user_a = user_model.objects.create_user('spam')
+        self.user_b = user_model.objects.create_user('egg')
+        HorizontalMetadata.objects.create(group='a', key=self.user_a.id, index=2)
+
+    def test_db_for_read(self):
+        self.assertEqual(
+            'a2-replica', self.router.db_for_read(OneModel, horizontal_key=self.user_a.id))
+        self.assertIn(
+            self.router.db_for_read(OneModel, horizontal_key=self.user_b.id),
+            ['a1-replica-1', 'a1-replica-2'],
+        )
+        self.assertFalse(HorizontalMetadata.objects.filter(key=self.user_b.id).exists())
+        with self.assertNumQueries(0, using='default'):
+            self.router.db_for_read(OneModel, horizontal_key=self.user_b.id)
+
+    def test_read_then_write(self):
+        self.assertEqual([], list(OneModel.objects.filter(user=self.user_b)))
+        self.assertEqual(0, OneModel.objects.filter(user=self.user_b).count())
+        self.assertFalse(HorizontalMetadata.objects.filter(key=self.user_b.id).exists())
+
+        obj = OneModel.objects.create(user=self.user_b, spam='1')
+        index = HorizontalMetadata.objects.get(key=self.user_b.id).index
+        self.assertEqual(index, obj._horizontal_database_index)
+        self.assertEqual([obj], list(OneModel.objects.filter(user=self.user_b)))
+
+    def test_filter_keys(self):
+        OneModel.objects.create(user=self.user_a, spam='1')
+        self.assertEqual(
+            ['1'],
+            list(OneModel.objects.filter(
+                user__in=[self.user_a, self.user_b]).values_list('spam', flat=True)),
+        )
+        self.assertFalse(HorizontalMetadata.objects.filter(key=self.user_b.id).exists())
+        self.assertEqual(0, OneModel.objects.filter(user__in=[self.user_b, 0]).count())
@@ -0,0 +1,120 @@
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase, override_settings
+
+from horizon.models import check_horizontal_config
+from horizon.routing import HorizontalRouting, check_config, get_routing_table
+from horizon.utils import (
+    get_config,
+    get_config_from_group,
+    get_routing_from_model,
+)
+
+from .models import (
+    ConcreteModel,
+    HorizontalMetadata,
+    ManyModel,
+    OneModel,
+    ProxiedModel,
+    ProxyBaseModel,
+)
+
+
+class HorizontalRoutingTestCase(SimpleTestCase):
+    def test_attached_at_class_prepared(self):
+        for model, group in (
+            (OneModel, 'a'),
+            (ManyModel, 'a'),
+            (ProxyBaseModel, 'b'),
+            (ProxiedModel, 'b'),
+            (ConcreteModel, 'b'),
+        ):
+            routing = get_routing_from_model(model)
+            self.assertIsInstance(routing, HorizontalRouting)
+            self.assertEqual(group, routing.group)
+            self.assertEqual('user', routing.key_name)
+            self.assertEqual('user_id', routing.key_attname)
+            self.assertIs(routing, get_routing_from_model(model()))
+        self.assertIsNone(get_routing_from_model(HorizontalMetadata))
+
+    def test_immutable(self):
+        routing = get_routing_from_model(OneModel)
+        with self.assertRaises(AttributeError):
+            routing.group = 'b'
+
+    def test_databases(self):
+        routing = get_routing_from_model(OneModel)
+        self.assertEqual(get_config_from_group('a'), routing.config)
+        self.assertEqual((1, 2, 3), routing.table.indexes)
+        self.assertEqual((None, 'a1-primary', 'a2-primary', 'a3'), routing.write_databases)
+        self.assertEqual(
+            (None, ('a1-replica-1', 'a1-replica-2'), ('a2-replica', ), ('a3', )),
+            routing.table.reads,
+        )
+        self.assertEqual({'a3': 1}, routing.table.read_weights[3])
+        self.assertIn('a2-replica', routing.database_set)
+        self.assertEqual((2, 3), get_routing_from_model(ConcreteModel).table.pickables)
+
+    def test_reset_when_config_changed(self):
+        routing = get_routing_from_model(OneModel)
+        self.assertEqual('a1-primary', routing.write_databases[1])
+        with override_settings(HORIZONTAL_CONFIG={'GROUPS': {'a': {'DATABASES': {
+            4: {'write': 'a3'},
+        }}}}):
+            self.assertEqual((None, None, None, None, 'a3'), routing.write_databases)
+            self.assertEqual(('a3', ), routing.table.reads[4])
+            self.assertIsNone(get_routing_from_model(ConcreteModel).table)
+            self.assertEqual(frozenset(), get_routing_from_model(ConcreteModel).database_set)
+        self.assertEqual('a1-primary', routing.write_databases[1])
+
+
+class RoutingTableTestCase(SimpleTestCase):
+    def test_get_routing_table(self):
+        table = get_routing_table()
+        self.assertIs(table, get_routing_table())
+        self.assertEqual({'a', 'b'}, set(table))
+        self.assertEqual(
+            {'b1-primary', 'b1-replica-1', 'b1-replica-2', 'b2-primary', 'b2-replica', 'b3'},
+            table['b'].database_set,
+        )
+        with self.assertRaises(TypeError):
+            table['c'] = table['a']
+        with self.assertRaises(AttributeError):
+            table['a'].writes = ()
+
+    def test_user_settings_not_changed(self):
+        self.assertNotIn('DATABASE_SET', settings.HORIZONTAL_CONFIG['GROUPS']['a'])
+        self.assertNotIn('read', settings.HORIZONTAL_CONFIG['GROUPS']['a']['DATABASES'][3])
+
+    def test_check_config(self):
+        config = {'GROUPS': {
+            'a': {'DATABASES': {
+                1: {'write': 'a1-primary', 'read': []},
+                2: {'write': 'unknown', 'read': ['a2-replica', 'unknown-replica']},
+            }, 'PICKABLES': [1, 3]},
+            'b': {'DATABASES': {}},
+            'c': {'DATABASES': {1: {'read': ['b3']}}, 'PICKABLES': {1: 0}},
+        }, 'METADATA_READ': {'default-replica': 1, 'unknown-replica': 1}}
+        self.assertEqual([
+            "Group 'a' database 1 has no 'read'.",
+            "Group 'a' database 2 refers to unknown database alias 'unknown'.",
+            "Group 'a' database 2 refers to unknown database alias 'unknown-replica'.",
+            "Group 'a' PICKABLES refers to database 3 which is not in DATABASES.",
+            "Group 'b' has no DATABASES.",
+            "Group 'c' database 1 has no 'write'.",
+            "Group 'c' has no PICKABLES.",
+            "METADATA_READ refers to unknown database alias 'unknown-replica'.",
+        ], check_config(config, settings.DATABASES))
+        self.assertEqual([], check_config(get_config(), settings.DATABASES))
+
+    @override_settings(HORIZONTAL_CONFIG={'GROUPS': {'a': {'DATABASES': {1: {'write': 'x'}}}}})
+    def test_invalid_config(self):
+        with self.assertRaisesMessage(ImproperlyConfigured, "unknown database alias 'x'"):
+            get_routing_table()
+        self.assertEqual(['horizon.E004'], [error.id for error in check_horizontal_config()])
+
+    @override_settings(HORIZONTAL_CONFIG={'GROUPS': {'a': {'DATABASES': {1: {'write': 'x'}}}}})
+    def test_invalid_config_on_ready(self):
+        with self.assertRaisesMessage(ImproperlyConfigured, "unknown database alias 'x'"):
+            apps.get_app_config('horizon').ready()
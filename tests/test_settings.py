@@ -4,6 +4,7 @@ SECRET_KEY = 'fake-key'
 INSTALLED_APPS = [
     'django.contrib.auth',
     'django.contrib.contenttypes',
+    'horizon',
     'tests',
 ]
 
@@ -16,6 +17,13 @@ DATABASES = {
             'NAME': 'file:memorydb_default?mode=memory&cache=shared',
         },
     },
+    'default-replica': {
+        'NAME': 'default-replica',
+        'ENGINE': 'django.db.backends.sqlite3',
+        'TEST': {
+            'MIRROR': 'default',
+        },
+    },
     'a1-primary': {
         'NAME': 'a1-primary',
         'ENGINE': 'django.db.backends.sqlite3',
@@ -101,6 +109,15 @@ DATABASES = {
         },
     },
 }
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'horizon': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'horizon',
+    },
+}
 DATABASE_ROUTERS = (
     'horizon.routers.HorizontalRouter',
 )
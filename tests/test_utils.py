@@ -1,19 +1,40 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, patch
+
+from django.apps import apps
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache import caches
 from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError, connections
 from django.test import TestCase, override_settings
 
 from horizon.utils import (
+    clear_index_cache,
     get_config,
     get_config_from_group,
     get_config_from_model,
     get_db_for_read_from_model_index,
     get_db_for_write_from_model_index,
     get_group_from_model,
+    get_index,
+    get_index_cache,
+    get_indexes,
     get_key_field_name_from_model,
     get_metadata_model,
+    get_metadata_read_database,
     get_or_create_index,
+    get_or_create_indexes,
+    get_shared_index_cache,
+    invalidate_index,
+    prime,
+    run_in_parallel,
+    warm_index_cache,
 )
 
+from .base import HorizontalBaseTestCase
 from .models import (
     ConcreteModel,
     HorizontalMetadata,
@@ -25,8 +46,15 @@ from .models import (
 
 user_model = get_user_model()
 
+SHARED_INDEX_CACHE_CONFIG = dict(settings.HORIZONTAL_CONFIG, SHARED_INDEX_CACHE='horizon')
+METADATA_READ_CONFIG = dict(settings.HORIZONTAL_CONFIG, METADATA_READ=['default-replica'])
+
 
 class UtilsTestCase(TestCase):
+    def setUp(self):
+        super(UtilsTestCase, self).setUp()
+        clear_index_cache()
+
     def get_metadata_model(self):
         self.assertEqual(get_metadata_model(), HorizontalMetadata)
 
@@ -79,18 +107,8 @@ class UtilsTestCase(TestCase):
                     },
                     3: {
                         'write': 'a3',
-                        'read': ['a3'],  # Complete db for read
                     },
                 },
-                'PICKABLES': [1, 2, 3],  # Complete pickables
-                'DATABASE_SET': {
-                    'a1-primary',
-                    'a1-replica-1',
-                    'a1-replica-2',
-                    'a2-primary',
-                    'a2-replica',
-                    'a3',
-                },
             },
             config_for_mqny,
         )
@@ -131,3 +149,326 @@ class UtilsTestCase(TestCase):
 
         many_index = get_or_create_index(ManyModel, user.id)
         self.assertEqual(one_index, many_index)
+
+    def test_get_or_create_index_from_cache(self):
+        user = user_model.objects.create_user('spam')
+        index = get_or_create_index(OneModel, user.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(index, get_or_create_index(OneModel, user.id))
+            self.assertEqual(index, get_or_create_index(ManyModel, user.id))
+        self.assertEqual(2, get_index_cache().info().hits)
+
+    def test_invalidate_index(self):
+        user = user_model.objects.create_user('spam')
+        HorizontalMetadata.objects.create(group='a', key=user.id, index=1)
+        self.assertEqual(1, get_or_create_index(OneModel, user.id))
+
+        HorizontalMetadata.objects.filter(group='a', key=user.id).update(index=2)
+        self.assertEqual(1, get_or_create_index(OneModel, user.id), "Cached")
+
+        invalidate_index('a', user.id)
+        self.assertEqual(2, get_or_create_index(OneModel, user.id))
+
+    def test_invalidate_index_when_metadata_changed(self):
+        user = user_model.objects.create_user('spam')
+        metadata = HorizontalMetadata.objects.create(group='a', key=user.id, index=1)
+        self.assertEqual(1, get_or_create_index(OneModel, user.id))
+
+        metadata.index = 3
+        metadata.save()
+        self.assertEqual(3, get_or_create_index(OneModel, user.id))
+
+    def test_get_or_create_indexes(self):
+        users = [user_model.objects.create_user(name) for name in ('spam', 'egg', 'ham')]
+        HorizontalMetadata.objects.create(group='b', key=users[0].id, index=1)
+
+        connection = connections['default']
+        if connection.Database.sqlite_version_info >= (3, 35):
+            num_queries = 2  # Select, insert returning inserted rows
+        elif getattr(connection.features, 'supports_ignore_conflicts', False):
+            num_queries = 3  # Select, insert ignoring conflicts, select
+        else:
+            num_queries = 4  # Select, insert in a savepoint
+        with self.assertNumQueries(num_queries):
+            indexes = get_or_create_indexes(ConcreteModel, [user.id for user in users])
+        self.assertEqual(1, indexes[users[0].id])
+        for user in users[1:]:
+            self.assertIn(indexes[user.id], [2, 3])  # PICKABLES
+            self.assertEqual(
+                indexes[user.id],
+                HorizontalMetadata.objects.get(group='b', key=user.id).index,
+            )
+
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                indexes,
+                get_or_create_indexes(ProxiedModel, [user.id for user in users]),
+            )
+            for user in users:
+                self.assertEqual(indexes[user.id], get_or_create_index(ProxyBaseModel, user.id))
+
+    def test_get_or_create_indexes_with_concurrent_assignment(self):
+        user = user_model.objects.create_user('spam')
+        with patch.object(
+            HorizontalMetadata.objects,
+            'filter',
+            return_value=HorizontalMetadata.objects.none(),
+        ):  # Assigned by another process after lookup
+            HorizontalMetadata.objects.create(group='a', key=user.id, index=3)
+            self.assertEqual({user.id: 3}, get_or_create_indexes(OneModel, [user.id]))
+
+    def test_get_or_create_index_with_concurrent_assignment(self):
+        user = user_model.objects.create_user('spam')
+        with patch.object(
+            HorizontalMetadata.objects,
+            'filter',
+            return_value=HorizontalMetadata.objects.none(),
+        ):  # Assigned by another process after lookup
+            HorizontalMetadata.objects.create(group='a', key=user.id, index=3)
+            with patch('horizon.utils.logger') as mock_logger:
+                self.assertEqual(3, get_or_create_index(OneModel, user.id))
+            mock_logger.info.assert_not_called()
+        self.assertEqual(1, HorizontalMetadata.objects.filter(key=user.id).count())
+
+    def test_get_or_create_index_with_concurrent_assignment_without_returning(self):
+        user = user_model.objects.create_user('spam')
+        with patch.object(
+            connections['default'].Database, 'sqlite_version_info', (3, 34, 0),
+        ), patch.object(
+            HorizontalMetadata.objects,
+            'filter',
+            return_value=HorizontalMetadata.objects.none(),
+        ):
+            HorizontalMetadata.objects.create(group='a', key=user.id, index=3)
+            with patch('horizon.utils.logger') as mock_logger:
+                self.assertEqual(3, get_or_create_index(OneModel, user.id))
+        for call in mock_logger.info.call_args_list:
+            self.assertNotIn("Assign new index to", call[0][0])  # Unknown or not created
+
+    def test_get_or_create_indexes_on_postgresql(self):
+        users = [user_model.objects.create_user(name) for name in ('spam', 'egg')]
+        connection = MagicMock(vendor='postgresql', ops=connections['default'].ops)
+        cursor = connection.cursor.return_value.__enter__.return_value
+        cursor.fetchall.return_value = [(str(users[1].id), 2, True), (str(users[0].id), 1, False)]
+        with patch('horizon.utils.connections', {'default': connection}), \
+                patch('horizon.utils._pick_index', return_value=2), \
+                self.assertNumQueries(0):
+            indexes = get_or_create_indexes(OneModel, [user.id for user in users])
+        self.assertEqual({users[0].id: 1, users[1].id: 2}, indexes)
+
+        cursor.execute.assert_called_once_with(
+            'WITH new AS ('
+            'INSERT INTO "tests_horizontalmetadata" ("group", "key", "index") '
+            'VALUES (%s, %s, %s), (%s, %s, %s) '
+            'ON CONFLICT ("group", "key") DO NOTHING RETURNING "key", "index"'
+            ') '
+            'SELECT "key", "index", true FROM new '
+            'UNION ALL '
+            'SELECT "key", "index", false FROM "tests_horizontalmetadata" '
+            'WHERE "group" = %s AND "key" IN (%s, %s)',
+            [
+                'a', str(users[0].id), 2, 'a', str(users[1].id), 2,
+                'a', str(users[0].id), str(users[1].id),
+            ],
+        )
+
+    def test_get_or_create_index_once_for_concurrent_calls(self):
+        user = user_model.objects.create_user('spam')
+        with patch(
+            'horizon.utils._get_or_create_metadata_indexes',
+            side_effect=lambda group, keys: time.sleep(0.1) or {keys[0]: 2},
+        ) as mock_get_or_create_metadata_indexes:
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                indexes = list(executor.map(
+                    lambda _: get_or_create_index(OneModel, user.id), range(4)))
+        self.assertEqual([2] * 4, indexes)
+        mock_get_or_create_metadata_indexes.assert_called_once_with('a', [str(user.id)])
+
+    def test_get_index(self):
+        user = user_model.objects.create_user('spam')
+        with self.assertNumQueries(1):
+            self.assertIsNone(get_index(OneModel, user.id))
+        with self.assertNumQueries(0):
+            self.assertIsNone(get_index(OneModel, user.id), "Cached as empty")
+        self.assertFalse(HorizontalMetadata.objects.filter(key=user.id).exists())
+
+        index = get_or_create_index(OneModel, user.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(index, get_index(OneModel, user.id))
+
+    def test_get_indexes(self):
+        user_a = user_model.objects.create_user('spam')
+        user_b = user_model.objects.create_user('egg')
+        HorizontalMetadata.objects.create(group='a', key=user_a.id, index=3)
+        with self.assertNumQueries(1):
+            self.assertEqual({user_a.id: 3}, get_indexes(OneModel, [user_a.id, user_b.id]))
+        with self.assertNumQueries(0):
+            self.assertEqual({user_a.id: 3}, get_indexes(OneModel, [user_a.id, user_b.id]))
+        self.assertFalse(HorizontalMetadata.objects.filter(key=user_b.id).exists())
+
+        indexes = get_or_create_indexes(OneModel, [user_a.id, user_b.id])
+        self.assertEqual(indexes, get_indexes(OneModel, [user_a.id, user_b.id]))
+
+    def test_prime(self):
+        users = [user_model.objects.create_user(name) for name in ('spam', 'egg')]
+        HorizontalMetadata.objects.create(group='a', key=users[0].id, index=1)
+        HorizontalMetadata.objects.create(group='a', key=users[1].id, index=2)
+        instances = [
+            OneModel(user=users[0], spam='1st'),
+            OneModel(user=users[1], spam='2nd'),
+            ManyModel(user=users[0]),
+        ]
+        with self.assertNumQueries(1):
+            prime(instances)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                [1, 2, 1],
+                [instance._horizontal_database_index for instance in instances],
+            )
+
+
+@override_settings(HORIZONTAL_CONFIG=SHARED_INDEX_CACHE_CONFIG)
+class SharedIndexCacheTestCase(TestCase):
+    def setUp(self):
+        super(SharedIndexCacheTestCase, self).setUp()
+        caches['horizon'].clear()
+        clear_index_cache()
+        self.user = user_model.objects.create_user('spam')
+        HorizontalMetadata.objects.create(group='a', key=self.user.id, index=2)
+
+    def test_get_or_create_index_from_shared_cache(self):
+        self.assertEqual(2, get_or_create_index(OneModel, self.user.id))
+        self.assertEqual(2, get_shared_index_cache().get('a', self.user.id))
+
+        clear_index_cache()
+        with self.assertNumQueries(0):
+            self.assertEqual(2, get_or_create_index(OneModel, self.user.id))
+        self.assertEqual(2, get_index_cache().get('a', self.user.id), "Filled local cache")
+
+    def test_invalidate_index(self):
+        get_or_create_index(OneModel, self.user.id)
+        invalidate_index('a', self.user.id)
+        self.assertIsNone(get_index_cache().get('a', self.user.id))
+        self.assertIsNone(get_shared_index_cache().get('a', self.user.id))
+
+    def test_versioned_keys(self):
+        get_or_create_index(OneModel, self.user.id)
+        with override_settings(
+            HORIZONTAL_CONFIG=dict(SHARED_INDEX_CACHE_CONFIG, SHARED_INDEX_CACHE_VERSION=2),
+        ):
+            self.assertIsNone(get_shared_index_cache().get('a', self.user.id))
+
+
+@override_settings(HORIZONTAL_CONFIG=METADATA_READ_CONFIG)
+class MetadataReadTestCase(HorizontalBaseTestCase):
+    def setUp(self):
+        super(MetadataReadTestCase, self).setUp()
+        self.user_a = user_model.objects.create_user('spam')
+        self.user_b = user_model.objects.create_user('egg')
+        HorizontalMetadata.objects.create(group='a', key=self.user_a.id, index=2)
+
+    def test_get_metadata_read_database(self):
+        self.assertEqual('default-replica', get_metadata_read_database())
+        with override_settings(HORIZONTAL_CONFIG=dict(
+                METADATA_READ_CONFIG, METADATA_READ={'default': 1, 'default-replica': 3})):
+            with patch('horizon.utils.random.random', return_value=0.2):
+                self.assertEqual('default', get_metadata_read_database())
+            with patch('horizon.utils.random.random', return_value=0.3):
+                self.assertEqual('default-replica', get_metadata_read_database())
+        with override_settings(HORIZONTAL_CONFIG=dict(METADATA_READ_CONFIG, METADATA_READ=None)):
+            self.assertIsNone(get_metadata_read_database())
+
+    def test_get_or_create_index_from_replica(self):
+        with self.assertNumQueries(0, using='default'), \
+                self.assertNumQueries(1, using='default-replica'):
+            self.assertEqual(2, get_or_create_index(OneModel, self.user_a.id))
+
+    def test_get_or_create_index_falls_back_to_primary(self):
+        with patch('horizon.utils.get_metadata_read_database', return_value='a3'):
+            # A replica without the rows, lagging behind
+            self.assertEqual(2, get_index(OneModel, self.user_a.id))
+            index = get_or_create_index(OneModel, self.user_b.id)
+        self.assertEqual(index, HorizontalMetadata.objects.get(key=self.user_b.id).index)
+
+    def test_get_or_create_indexes_from_replica(self):
+        with self.assertNumQueries(1, using='default-replica'):
+            indexes = get_or_create_indexes(OneModel, [self.user_a.id, self.user_b.id])
+        self.assertEqual(2, indexes[self.user_a.id])
+        self.assertEqual(
+            indexes[self.user_b.id], HorizontalMetadata.objects.get(key=self.user_b.id).index)
+
+
+@override_settings(HORIZONTAL_CONFIG=dict(settings.HORIZONTAL_CONFIG, MAX_WORKERS=1))
+class RunInParallelTestCase(HorizontalBaseTestCase):
+    def test_run_in_parallel(self):
+        self.assertEqual([2, 4, 6], run_in_parallel(lambda item: item * 2, [1, 2, 3]))
+        threads = run_in_parallel(lambda item: threading.get_ident(), [1, 2, 3])
+        self.assertEqual(1, len(set(threads)))  # Shared by the calls
+        self.assertNotIn(threading.get_ident(), threads)
+        self.assertEqual(threads[:2], run_in_parallel(lambda item: threading.get_ident(), [1, 2]))
+
+    def test_run_in_parallel_from_worker(self):
+        self.assertEqual(
+            [[1, 2], [2, 4]],
+            run_in_parallel(lambda item: run_in_parallel(lambda x: x * item, [1, 2]), [1, 2]),
+        )
+
+
+class WarmIndexCacheTestCase(TestCase):
+    def setUp(self):
+        super(WarmIndexCacheTestCase, self).setUp()
+        for key in range(1, 8):
+            HorizontalMetadata.objects.create(group='a', key=key, index=key % 3 + 1)
+        HorizontalMetadata.objects.create(group='b', key=1, index=2)
+        clear_index_cache()
+
+    def test_warm_index_cache(self):
+        with self.assertNumQueries(4):
+            self.assertEqual(8, warm_index_cache(chunk_size=3))
+        with self.assertNumQueries(0):
+            self.assertEqual(2, get_or_create_index(OneModel, 1))
+            self.assertEqual(2, get_or_create_index(OneModel, 7))
+
+    def test_warm_index_cache_of_groups(self):
+        self.assertEqual(1, warm_index_cache(['b']))
+        self.assertEqual(2, get_index_cache().get('b', 1))
+        self.assertIsNone(get_index_cache().get('a', 1))
+
+    def test_warm_recent_keys(self):
+        self.assertEqual(3, warm_index_cache(['a'], limit=3, chunk_size=2))
+        self.assertEqual(
+            [None, None, None, None, 3, 1, 2],
+            [get_index_cache().get('a', key) for key in range(1, 8)],
+        )
+
+    @override_settings(HORIZONTAL_CONFIG=dict(settings.HORIZONTAL_CONFIG, INDEX_CACHE_SIZE=2))
+    def test_warm_up_to_cache_size(self):
+        self.assertEqual(2, warm_index_cache(['a']))
+        self.assertEqual(2, len(get_index_cache()))
+        self.assertEqual(2, get_index_cache().get('a', 7))
+
+    @override_settings(HORIZONTAL_CONFIG=dict(settings.HORIZONTAL_CONFIG, INDEX_CACHE_SIZE=3))
+    def test_warm_up_to_cache_size_across_groups(self):
+        get_or_create_index(OneModel, 1)
+        self.assertEqual(2, warm_index_cache(['b', 'a'], limit=1))
+        self.assertEqual(3, len(get_index_cache()))
+        self.assertEqual(2, get_index_cache().get('b', 1))
+        self.assertEqual(2, get_index_cache().get('a', 7))
+        self.assertEqual(0, warm_index_cache(['a']))
+
+    def test_warm_on_ready(self):
+        config = apps.get_app_config('horizon')
+        with patch('horizon.utils.warm_index_cache') as mock_warm_index_cache:
+            config.ready()
+            mock_warm_index_cache.assert_not_called()
+
+            with override_settings(HORIZONTAL_CONFIG=dict(
+                    settings.HORIZONTAL_CONFIG, WARMUP=['a'], WARMUP_LIMIT=100)):
+                config.ready()
+            mock_warm_index_cache.assert_called_once_with(['a'], limit=100)
+
+            mock_warm_index_cache.side_effect = DatabaseError
+            with override_settings(HORIZONTAL_CONFIG=dict(settings.HORIZONTAL_CONFIG, WARMUP=True)):
+                with self.assertLogs('horizon.apps', 'WARNING'):
+                    config.ready()
+            mock_warm_index_cache.assert_called_with(None, limit=None)